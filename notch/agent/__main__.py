@@ -18,8 +18,10 @@
 
 import eventlet
 
-# XXX monkey-patching os causes a deadlock.
-eventlet.monkey_patch(all=False, os=False, socket=True, select=True)
+# XXX monkey-patching os causes a deadlock. Threads are green, so that
+# IOLoop.add_callback() wakes the IOLoop when called from a greenthread.
+eventlet.monkey_patch(all=False, os=False, socket=True, select=True,
+                      thread=True)
 
 
 import logging
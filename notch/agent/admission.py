@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Admission control for device requests.
+
+Requests are admitted when they arrive, up to a limit of pending requests
+for the agent and for each device; beyond those, they are refused at once.
+Admitted requests wait for a worker and then for their device's session
+(see bind()), and the time they waited is managed in the style of CoDel
+(Nichols & Jacobson): once waits have stayed above a target delay for an
+interval, requests are shed as they leave the queue, at a rate increasing
+until waits drop below the target again. Clients receive
+errors.OverloadedError, and may retry elsewhere.
+"""
+
+import math
+import time
+
+import eventlet.corolocal
+
+import errors
+
+
+# Default maximum number of requests pending (waiting or executing).
+DEFAULT_MAX_PENDING = 1024
+# Default maximum number of requests pending for one device.
+DEFAULT_MAX_DEVICE_PENDING = 64
+# Default acceptable queueing delay, in seconds.
+DEFAULT_TARGET_DELAY = 2.0
+# Default seconds the delay may exceed the target before requests are shed.
+DEFAULT_INTERVAL = 10.0
+
+# The ticket bound to each greenthread (see bind()).
+_bound = eventlet.corolocal.local()
+
+
+def bind(ticket):
+    """Binds a ticket to the greenthread executing its request.
+
+    The ticket is started (see start_bound()) when the request acquires its
+    device's session, so that the wait for the session is part of its
+    queueing delay.
+
+    Args:
+      ticket: A Ticket, or None to unbind the greenthread's ticket.
+    """
+    _bound.ticket = ticket
+
+
+def start_bound():
+    """Starts the ticket bound to this greenthread, if any.
+
+    Raises:
+      errors.OverloadedError: The request was shed. It is done.
+    """
+    ticket = getattr(_bound, 'ticket', None)
+    if ticket is not None:
+        ticket.start()
+
+
+class Ticket(object):
+    """An admitted request.
+
+    Attributes:
+      device_name: A string, the device requested, or None.
+      admitted: A float, the time the request was admitted.
+      queued: A float, the time the request's queueing delay began.
+    """
+
+    def __init__(self, control, device_name, admitted):
+        self._control = control
+        self.device_name = device_name
+        self.admitted = admitted
+        self.queued = admitted
+        self._started = False
+        self._done = False
+
+    def restart(self):
+        """Restarts the queueing delay, excluding the time waited so far.
+
+        Used once the request has waited behind requests it must follow
+        (e.g., earlier calls to its device in a JSON-RPC batch).
+        """
+        self.queued = time.time()
+
+    def start(self):
+        """Records that the request is leaving the queue to execute.
+
+        Raises:
+          errors.OverloadedError: The request was shed. It is done.
+        """
+        if self._started or self._done:
+            return
+        self._started = True
+        self._control._start(self)
+
+    def done(self):
+        """Records that the request has finished. Idempotent."""
+        if not self._done:
+            self._done = True
+            self._control._done(self)
+
+
+class AdmissionControl(object):
+    """Bounds the requests pending, and sheds those queued too long.
+
+    Used by greenthreads only.
+
+    Attributes:
+      max_pending: An int, the maximum number of requests pending, or None.
+      max_device_pending: An int, the maximum number of requests pending
+        for one device, or None.
+      target_delay: A float, the acceptable queueing delay in seconds, or 0
+        not to shed requests.
+      interval: A float, the seconds queueing delays may exceed the target
+        before requests are shed.
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING,
+                 max_device_pending=DEFAULT_MAX_DEVICE_PENDING,
+                 target_delay=DEFAULT_TARGET_DELAY,
+                 interval=DEFAULT_INTERVAL):
+        self.max_pending = max_pending
+        self.max_device_pending = max_device_pending
+        self.target_delay = target_delay
+        self.interval = interval
+        self._pending = 0
+        self._waiting = 0
+        # Pending request counts, keyed by device name.
+        self._device_pending = {}
+        # CoDel state: the time delays first stayed above target until (or
+        # None), whether requests are being shed, the time of the next
+        # shedding and the number shed since shedding began.
+        self._first_above = None
+        self._shedding = False
+        self._shed_next = 0.0
+        self._shed_count = 0
+        self._stats = {'admitted': 0,
+                       'rejected': 0,
+                       'rejected_device': 0,
+                       'shed': 0,
+                       'delay_max': 0.0}
+
+    def admit(self, device_name=None):
+        """Admits a request.
+
+        Args:
+          device_name: A string, the device requested, or None.
+
+        Returns:
+          A Ticket. Callers must call its start() method when the request
+          begins executing, and its done() method when it finishes.
+
+        Raises:
+          errors.OverloadedError: Too many requests are pending.
+        """
+        if self.max_pending and self._pending >= self.max_pending:
+            self._stats['rejected'] += 1
+            raise errors.OverloadedError(
+                '%d requests pending; retry later' % self._pending)
+        device_pending = self._device_pending.get(device_name, 0)
+        if (device_name is not None and self.max_device_pending and
+            device_pending >= self.max_device_pending):
+            self._stats['rejected_device'] += 1
+            raise errors.OverloadedError(
+                '%d requests pending for %s; retry later'
+                % (device_pending, device_name))
+        self._pending += 1
+        self._waiting += 1
+        if device_name is not None:
+            self._device_pending[device_name] = device_pending + 1
+        self._stats['admitted'] += 1
+        return Ticket(self, device_name, time.time())
+
+    def stats(self):
+        """Returns the admission statistics.
+
+        Returns:
+          A dict of counters; requests 'admitted', 'rejected' (too many
+          pending), 'rejected_device' (too many pending for the device),
+          'shed' (queued too long) and 'delay_max' (the longest queueing
+          delay seen). Also includes the number of requests 'pending' and
+          'waiting' now, the number of 'devices' with requests pending,
+          whether requests are being shed ('shedding') and the settings.
+        """
+        result = dict(self._stats)
+        result['pending'] = self._pending
+        result['waiting'] = self._waiting
+        result['devices'] = len(self._device_pending)
+        result['shedding'] = self._shedding
+        result['max_pending'] = self.max_pending
+        result['max_device_pending'] = self.max_device_pending
+        result['target_delay'] = self.target_delay
+        result['interval'] = self.interval
+        return result
+
+    def _start(self, ticket):
+        self._waiting -= 1
+        now = time.time()
+        delay = max(0.0, now - ticket.queued)
+        if delay > self._stats['delay_max']:
+            self._stats['delay_max'] = delay
+        if self._should_shed(delay, now):
+            self._stats['shed'] += 1
+            ticket.done()
+            raise errors.OverloadedError(
+                'Request queued for %.1f sec; retry later' % delay)
+
+    def _done(self, ticket):
+        if not ticket._started:
+            self._waiting -= 1
+        self._pending -= 1
+        if ticket.device_name is not None:
+            count = self._device_pending.get(ticket.device_name, 1) - 1
+            if count > 0:
+                self._device_pending[ticket.device_name] = count
+            else:
+                self._device_pending.pop(ticket.device_name, None)
+
+    def _control_law(self, t):
+        """Returns the time of the next shedding after t."""
+        return t + self.interval / math.sqrt(self._shed_count)
+
+    def _should_shed(self, delay, now):
+        """Returns True if a request leaving the queue should be shed.
+
+        Args:
+          delay: A float, the seconds the request was queued.
+          now: A float, the time now.
+        """
+        if not self.target_delay:
+            return False
+        if delay < self.target_delay or not self._waiting:
+            # Below target, or the queue is empty behind this request.
+            self._first_above = None
+            ok_to_shed = False
+        elif self._first_above is None:
+            self._first_above = now + self.interval
+            ok_to_shed = False
+        else:
+            ok_to_shed = now >= self._first_above
+        if self._shedding:
+            if not ok_to_shed:
+                self._shedding = False
+                return False
+            elif now >= self._shed_next:
+                self._shed_count += 1
+                self._shed_next = self._control_law(self._shed_next)
+                return True
+            return False
+        elif ok_to_shed:
+            self._shedding = True
+            # Resume near the last shedding rate if it ended recently.
+            if (self._shed_count > 2 and
+                now - self._shed_next < 8 * self.interval):
+                self._shed_count -= 2
+            else:
+                self._shed_count = 1
+            self._shed_next = self._control_law(now)
+            return True
+        return False
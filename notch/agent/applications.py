@@ -23,6 +23,7 @@ import tornado.wsgi
 
 import controller
 import handlers
+import tp
 
 
 # URLs for common pages.
@@ -32,18 +33,37 @@ BASE_URLS = [(r'/', handlers.HomeHandler),
 # The JSON-RPC v2.0 interface.
 JSON_RPC2_URL = r'/JSONRPC2'
 
+# Streamed responses (Tornado HTTP server only).
+STREAM_URL = r'/stream/(\w+)'
+
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """Applies the gzip content encoding, to JSON-RPC responses also."""
+
+    CONTENT_TYPES = tornado.web.GZipContentEncoding.CONTENT_TYPES | set([
+        'application/json-rpc'])
+
+
+# Output transforms; responses are gzipped for clients which accept it.
+TRANSFORMS = [GZipContentEncoding, tornado.web.ChunkedTransferEncoding]
+
 
 class NotchTornadoApplication(tornado.web.Application):
 
     def __init__(self, configuration):
         urls = BASE_URLS + [
-            (JSON_RPC2_URL, handlers.NotchSyncJsonRpcHandler)]
+            (JSON_RPC2_URL, handlers.NotchSyncJsonRpcHandler),
+            (STREAM_URL, handlers.StreamHandler)]
         # Initialise the controller and start the maintenance task.
         self.controller = controller.Controller(configuration)
         eventlet.spawn_n(self.controller.run_maintenance)
 
-        settings = dict(controller=self.controller)
-        tornado.web.Application.__init__(self, urls, **settings)
+        # Device requests run in worker threads, off the IOLoop.
+        self.workers = tp.ThreadPool(max_threads=self.controller.rpc_workers)
+
+        settings = dict(controller=self.controller, workers=self.workers)
+        tornado.web.Application.__init__(self, urls, transforms=TRANSFORMS,
+                                         **settings)
 
 
 class NotchWSGIApplication(tornado.wsgi.WSGIApplication):
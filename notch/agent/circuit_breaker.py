@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Circuit breakers for unreachable devices.
+
+Connecting to a dead device waits for the connect timeout at each of its
+addresses, tying up a worker for each request. Once connections to a
+device have failed failure_threshold times in a row, its circuit opens:
+connection attempts fail at once with the last error. While open, the
+device is probed in the background, after a backoff which doubles with
+each failed probe; the first successful probe closes the circuit.
+"""
+
+import logging
+import time
+
+import eventlet
+
+import errors
+
+
+# Default number of consecutive connection failures opening a circuit.
+DEFAULT_FAILURE_THRESHOLD = 3
+# Default seconds before the first probe of an open circuit.
+DEFAULT_INITIAL_BACKOFF = 15.0
+# Default maximum seconds between probes.
+DEFAULT_MAX_BACKOFF = 600.0
+
+# Circuit states.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Circuit(object):
+    """The connection state of a device with failed connections.
+
+    Attributes:
+      state: A string, CLOSED, OPEN or HALF_OPEN (a probe is running).
+      failures: An int, the number of consecutive connection failures.
+      error: An errors.ConnectError, the last connection error.
+      opened: A float, the time the circuit opened, or None.
+      backoff: A float, the seconds from the last failure to the next probe.
+      next_probe: A float, the time of the next probe, or None.
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.error = None
+        self.opened = None
+        self.backoff = None
+        self.next_probe = None
+        self.timer = None
+
+    def as_dict(self):
+        """Returns the circuit's state as a dict, for RPC clients."""
+        return {'state': self.state,
+                'failures': self.failures,
+                'error': self.error and self.error.name,
+                'message': self.error and str(self.error),
+                'opened': self.opened,
+                'next_probe': self.next_probe}
+
+
+class CircuitBreaker(object):
+    """Fails connections to devices which have repeatedly failed to connect.
+
+    Used by greenthreads only.
+
+    Attributes:
+      probe_callback: A callable taking a device name, which connects to
+        and disconnects from the device without consulting the breaker. It
+        raises errors.ConnectError if the device is still unreachable.
+      failure_threshold: An int, the consecutive failures opening a
+        circuit, or 0 never to open circuits.
+      initial_backoff: A float, the seconds before the first probe.
+      max_backoff: A float, the maximum seconds between probes.
+    """
+
+    def __init__(self, probe_callback,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 initial_backoff=DEFAULT_INITIAL_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.probe_callback = probe_callback
+        self.failure_threshold = failure_threshold
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        # Circuit objects for devices whose last connection failed, keyed
+        # by device name.
+        self._circuits = {}
+        self._stats = {'opened': 0,
+                       'closed': 0,
+                       'rejected': 0,
+                       'probes': 0}
+
+    def check(self, device_name):
+        """Checks that the device's circuit is closed.
+
+        Raises:
+          errors.ConnectError: The circuit is open. The error is of the
+            class of the last connection error.
+        """
+        circuit = self._circuits.get(device_name)
+        if circuit is None or circuit.state == CLOSED:
+            return
+        self._stats['rejected'] += 1
+        error = circuit.error.__class__(
+            '%s (device unreachable; next probe in %.0f sec)'
+            % (circuit.error, max(0.0, circuit.next_probe - time.time())))
+        raise error
+
+    def success(self, device_name):
+        """Records a successful connection to the device."""
+        circuit = self._circuits.pop(device_name, None)
+        if circuit is None:
+            return
+        if circuit.timer is not None:
+            circuit.timer.cancel()
+        if circuit.state != CLOSED:
+            self._stats['closed'] += 1
+            logging.info('CIRCUIT_CLOSED %s', device_name)
+
+    def failure(self, device_name, error):
+        """Records a failed connection to the device.
+
+        Args:
+          device_name: A string, the device's name.
+          error: An errors.ConnectError, the connection error.
+        """
+        if isinstance(error, errors.SessionLimitError):
+            # The device is reachable, merely busy.
+            self.success(device_name)
+            return
+        circuit = self._circuits.setdefault(device_name, Circuit())
+        circuit.failures += 1
+        circuit.error = error
+        if circuit.state == CLOSED:
+            if (self.failure_threshold and
+                circuit.failures >= self.failure_threshold):
+                self._open(device_name, circuit)
+        elif circuit.state == HALF_OPEN:
+            self._open(device_name, circuit)
+
+    def reset(self, device_name=None):
+        """Closes the device's circuit, or all circuits."""
+        if device_name is None:
+            names = self._circuits.keys()
+        else:
+            names = [device_name]
+        for name in names:
+            self.success(name)
+
+    def stats(self):
+        """Returns the circuit breaker statistics.
+
+        Returns:
+          A dict of counters; circuits 'opened' and 'closed', connections
+          'rejected' by open circuits and 'probes' made. 'devices' holds
+          the circuits of devices with failed connections, keyed by device
+          name (see Circuit.as_dict), and 'open' their number not closed.
+        """
+        result = dict(self._stats)
+        result['devices'] = dict((name, circuit.as_dict())
+                                 for name, circuit in self._circuits.items())
+        result['open'] = len([c for c in self._circuits.values()
+                              if c.state != CLOSED])
+        result['failure_threshold'] = self.failure_threshold
+        return result
+
+    def _open(self, device_name, circuit):
+        if circuit.state == CLOSED:
+            circuit.opened = time.time()
+            circuit.backoff = self.initial_backoff
+            self._stats['opened'] += 1
+            logging.warn('CIRCUIT_OPEN %s after %d failures: %s',
+                         device_name, circuit.failures, circuit.error)
+        else:
+            circuit.backoff = min(self.max_backoff, circuit.backoff * 2)
+        circuit.state = OPEN
+        circuit.next_probe = time.time() + circuit.backoff
+        circuit.timer = eventlet.spawn_after(
+            circuit.backoff, self._probe, device_name, circuit)
+
+    def _probe(self, device_name, circuit):
+        """Probes the device of an open circuit."""
+        if (self._circuits.get(device_name) is not circuit or
+            circuit.state != OPEN):
+            return
+        circuit.state = HALF_OPEN
+        circuit.timer = None
+        self._stats['probes'] += 1
+        try:
+            self.probe_callback(device_name)
+        except errors.ConnectError, e:
+            logging.debug('CIRCUIT_PROBE_FAIL %s: %s', device_name, e)
+            if self._circuits.get(device_name) is circuit:
+                self.failure(device_name, e)
+            return
+        # Let requests find out about other problems.
+        # pylint: disable-msg=W0703
+        except Exception, e:
+            logging.error('CIRCUIT_PROBE_ERROR %s: [%s] %s', device_name,
+                          e.__class__.__name__, e)
+        if self._circuits.get(device_name) is circuit:
+            self.success(device_name)
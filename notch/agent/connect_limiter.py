@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Limits on device connection establishment.
+
+Connecting (TCP, SSH key exchange and authentication) is the most costly
+part of a request. After an agent restart or a network outage, every
+session reconnects at once; unchecked, the handshakes starve each other
+of CPU and all time out. The ConnectLimiter bounds the connections being
+established by the agent and to each address prefix (i.e., site), and
+spaces the connection attempts to each device.
+"""
+
+import collections
+import time
+
+import eventlet
+import eventlet.event
+import eventlet.timeout
+import ipaddr
+
+import errors
+
+
+# Default maximum number of connections being established at once.
+DEFAULT_MAX_CONNECTING = 32
+# Default maximum number of connections being established to one prefix.
+DEFAULT_MAX_PREFIX_CONNECTING = 8
+# Default prefix lengths grouping device addresses into sites.
+DEFAULT_IPV4_PREFIX_LENGTH = 24
+DEFAULT_IPV6_PREFIX_LENGTH = 64
+# Default connection attempts per second to one device, and the number of
+# attempts a device may make without waiting.
+DEFAULT_DEVICE_RATE = 0.5
+DEFAULT_DEVICE_BURST = 3
+# Default maximum seconds to wait to begin connecting.
+DEFAULT_MAX_WAIT = 60.0
+
+
+class TokenBucket(object):
+    """A token bucket, limiting the rate of an event.
+
+    Attributes:
+      rate: A float, the tokens added per second.
+      burst: An int, the maximum number of tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def take(self):
+        """Takes a token, returning the seconds to wait until it is due."""
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    @property
+    def full(self):
+        """True if the bucket has refilled."""
+        return (self._tokens + (time.time() - self._updated) * self.rate >=
+                self.burst)
+
+
+class ConnectLimiter(object):
+    """Limits concurrent and repeated connection attempts.
+
+    Connection attempts take a slot, waiting in turn for one to be free.
+    Waiters are granted slots in the order they arrived, though a waiter
+    whose prefix is at its limit does not hold up those behind it.
+
+    Used by greenthreads only.
+
+    Attributes:
+      max_connecting: An int, the maximum number of slots taken at once.
+      max_prefix_connecting: An int, the maximum number of slots taken at
+        once for addresses in one prefix.
+      ipv4_prefix_length: An int, the length of IPv4 prefixes.
+      ipv6_prefix_length: An int, the length of IPv6 prefixes.
+      device_rate: A float, the attempts per second allowed for a device,
+        or 0 for no limit.
+      device_burst: An int, the attempts a device may make without waiting.
+      max_wait: A float, the maximum seconds to wait for a slot.
+    """
+
+    def __init__(self, max_connecting=DEFAULT_MAX_CONNECTING,
+                 max_prefix_connecting=DEFAULT_MAX_PREFIX_CONNECTING,
+                 ipv4_prefix_length=DEFAULT_IPV4_PREFIX_LENGTH,
+                 ipv6_prefix_length=DEFAULT_IPV6_PREFIX_LENGTH,
+                 device_rate=DEFAULT_DEVICE_RATE,
+                 device_burst=DEFAULT_DEVICE_BURST,
+                 max_wait=DEFAULT_MAX_WAIT):
+        self.max_connecting = max_connecting
+        self.max_prefix_connecting = max_prefix_connecting
+        self.ipv4_prefix_length = ipv4_prefix_length
+        self.ipv6_prefix_length = ipv6_prefix_length
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        self.max_wait = max_wait
+        self._connecting = 0
+        # Slots taken, keyed by prefix.
+        self._prefix_connecting = {}
+        # (prefix, eventlet.event.Event) pairs, in arrival order.
+        self._waiters = collections.deque()
+        # TokenBucket objects, keyed by device name.
+        self._buckets = {}
+        self._stats = {'granted': 0,
+                       'waited': 0,
+                       'timeouts': 0,
+                       'rate_limited': 0,
+                       'wait_time': 0.0,
+                       'wait_time_max': 0.0}
+
+    def prefix(self, address):
+        """Returns the prefix (a string) containing the address."""
+        address = ipaddr.IPAddress(str(address))
+        if address.version == 4:
+            length = self.ipv4_prefix_length
+        else:
+            length = self.ipv6_prefix_length
+        return str(ipaddr.IPNetwork('%s/%d' % (address, length)).network)
+
+    def acquire(self, device_name, address, charge=True):
+        """Waits for a slot to connect to the device at the address.
+
+        Callers must call release() with the same address afterwards.
+
+        Args:
+          device_name: A string, the device's name.
+          address: An ipaddr.IPAddress or string, the address connected to.
+          charge: A boolean. If False, the attempt is not charged to the
+            device's rate limit; e.g., for the further addresses tried by
+            one connection.
+
+        Raises:
+          errors.ConnectError: No slot was free within max_wait seconds.
+        """
+        start = time.time()
+        prefix = self.prefix(address)
+        timer = eventlet.timeout.Timeout(self.max_wait)
+        try:
+            try:
+                if charge:
+                    delay = self._device_delay(device_name)
+                else:
+                    delay = 0.0
+                if delay > 0:
+                    self._stats['rate_limited'] += 1
+                    eventlet.sleep(delay)
+                if self._waiters or not self._free(prefix):
+                    self._stats['waited'] += 1
+                    self._wait(prefix, address)
+                else:
+                    self._take(prefix)
+            except eventlet.timeout.Timeout, e:
+                if e is not timer:
+                    raise
+                self._stats['timeouts'] += 1
+                raise errors.ConnectError(
+                    'Timed out after %.1f sec waiting to connect to %s'
+                    % (self.max_wait, device_name))
+        finally:
+            timer.cancel()
+        self._record_wait(time.time() - start)
+
+    def release(self, address):
+        """Frees the slot taken to connect to the address."""
+        prefix = self.prefix(address)
+        self._connecting -= 1
+        count = self._prefix_connecting.get(prefix, 1) - 1
+        if count > 0:
+            self._prefix_connecting[prefix] = count
+        else:
+            self._prefix_connecting.pop(prefix, None)
+        self._grant()
+
+    def stats(self):
+        """Returns the limiter statistics.
+
+        Returns:
+          A dict of counters; slots 'granted', attempts which 'waited' for
+          a slot, 'timeouts' (attempts which gave up waiting), attempts
+          'rate_limited' (delayed by the device rate limit), and the total
+          'wait_time' and 'wait_time_max'. Also includes the number of
+          'connecting' and 'waiting' attempts now, and the limits.
+        """
+        result = dict(self._stats)
+        result['connecting'] = self._connecting
+        result['waiting'] = len(self._waiters)
+        result['prefixes'] = len(self._prefix_connecting)
+        result['max_connecting'] = self.max_connecting
+        result['max_prefix_connecting'] = self.max_prefix_connecting
+        return result
+
+    def _device_delay(self, device_name):
+        """Returns the seconds the device must wait to attempt connection."""
+        if not self.device_rate:
+            return 0.0
+        bucket = self._buckets.get(device_name)
+        if bucket is None:
+            if len(self._buckets) >= 1024:
+                # Forget devices which have not connected lately.
+                for name, other in self._buckets.items():
+                    if other.full:
+                        del self._buckets[name]
+            bucket = self._buckets[device_name] = TokenBucket(
+                self.device_rate, self.device_burst)
+        return bucket.take()
+
+    def _free(self, prefix):
+        """Returns True if a slot for the prefix is free."""
+        return (self._connecting < self.max_connecting and
+                self._prefix_connecting.get(prefix, 0) <
+                self.max_prefix_connecting)
+
+    def _take(self, prefix):
+        self._connecting += 1
+        self._prefix_connecting[prefix] = (
+            self._prefix_connecting.get(prefix, 0) + 1)
+        self._stats['granted'] += 1
+
+    def _wait(self, prefix, address):
+        """Waits in turn for a slot."""
+        waiter = (prefix, eventlet.event.Event())
+        self._waiters.append(waiter)
+        try:
+            waiter[1].wait()
+        except BaseException:
+            if waiter[1].ready():
+                # Granted as the wait ended; pass the slot on.
+                self.release(address)
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _grant(self):
+        """Grants free slots to waiters, in order."""
+        for waiter in list(self._waiters):
+            if self._connecting >= self.max_connecting:
+                break
+            prefix, event = waiter
+            if self._free(prefix):
+                self._waiters.remove(waiter)
+                self._take(prefix)
+                event.send()
+
+    def _record_wait(self, wait_time):
+        self._stats['wait_time'] += wait_time
+        if wait_time > self._stats['wait_time_max']:
+            self._stats['wait_time_max'] = wait_time
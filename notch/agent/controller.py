@@ -21,22 +21,50 @@ the RPC server. Routine maintenance activities are also located here.
 """
 
 import eventlet
-
+import eventlet.event
+import eventlet.greenpool
+import eventlet.queue
+import eventlet.semaphore
+
+import functools
+import hashlib
+import heapq
+import itertools
 import logging
+import re
+import sys
 from eventlet.green import time
 
 import notch.agent.errors
 
+import admission
+import circuit_breaker
+import connect_limiter
 import credential
 import device_factory
 import device_manager
 import lru
+import result_cache
 import session
 
 
-# Maximum number of active sessions held in LRU at any one time.
-# TODO(afort): Make configurable.
+# Default maximum number of active sessions held in LRU at any one time.
+# Set the max_active_sessions attribute in the options section to override.
 MAX_ACTIVE_SESSIONS = 512
+# Default number of worker threads executing device requests made over
+# JSON-RPC. Set the rpc_workers attribute in the options section to override.
+RPC_WORKERS = 64
+# Default maximum number of calls in one JSON-RPC batch executed at once.
+# Set the rpc_batch_concurrency attribute in the options section to override.
+RPC_BATCH_CONCURRENCY = 16
+# Default maximum number of device requests made at once by all fan-out
+# (e.g., command_matching) requests. Set the fanout_concurrency attribute in
+# the options section to override.
+FANOUT_CONCURRENCY = 128
+# Device API methods whose identical concurrent requests are executed once.
+# Set the coalesce_requests attribute in the options section to False to
+# execute every request.
+COALESCED_METHODS = frozenset(['command', 'get_config'])
 # Default session check window period in seconds.
 DEFAULT_SESSION_CHECK_PERIOD_S = 10.0
 
@@ -49,6 +77,22 @@ class Controller(object):
         session.SessionKey namedtuples.
       config: A dict, holding the configuration.
       device_manager: A device_manager.DeviceManager instance.
+      rpc_workers: An int, the number of worker threads to execute device
+        requests made by RPC handlers.
+      rpc_batch_concurrency: An int, the maximum number of calls in one
+        JSON-RPC batch request executed at once.
+      fanout_concurrency: An int, the maximum number of device requests
+        made at once by all fan-out requests (see request_matching).
+      result_cache: A result_cache.ResultCache of command responses, or None
+        if the result_cache option is not set.
+      coalesce_requests: A boolean. If True, identical concurrent requests
+        for COALESCED_METHODS are executed once (see request).
+      admission: An admission.AdmissionControl, admitting the requests made
+        by RPC handlers.
+      connect_limiter: A connect_limiter.ConnectLimiter, limiting the
+        connection attempts of all devices.
+      circuit_breaker: A circuit_breaker.CircuitBreaker, failing connection
+        attempts to unreachable devices.
     """
 
     def __init__(self, config=None):
@@ -59,11 +103,25 @@ class Controller(object):
         """
         self.config = config or {}
         self._get_timers_from_config(config)
-        self.sessions = lru.LruDict(populate_callback=self.create_session,
-                                    expire_callback=self.expire_session,
-                                    maximum_size=MAX_ACTIVE_SESSIONS)
+        self._get_options_from_config(config)
+        self.sessions = lru.LruDict(
+            populate_callback=self.create_session,
+            expire_callback=self.expire_session,
+            eviction_cost_callback=self.session_eviction_cost,
+            maximum_size=self._max_active_sessions)
         self.device_manager = device_manager.DeviceManager(self.config)
         self.load_credentials()
+        self._fanout_slots = eventlet.semaphore.Semaphore(
+            self.fanout_concurrency)
+        # eventlet.event.Event objects (or None, with no waiters) for the
+        # coalesced requests being executed, keyed by request.
+        self._in_flight = {}
+        self._coalesced = 0
+        # A heap of (idle deadline, sequence, session.Session) tuples, and
+        # the ids of sessions presently on the heap.
+        self._idle_deadlines = []
+        self._idle_scheduled = set()
+        self._idle_sequence = itertools.count()
         self._stopped = eventlet.event.Event()
         self.__current_maint_thread = None
 
@@ -89,16 +147,166 @@ class Controller(object):
             except ValueError:
                 pass
 
+    def _get_options_from_config(self, config):
+        self._max_active_sessions = MAX_ACTIVE_SESSIONS
+        self.rpc_workers = RPC_WORKERS
+        self.rpc_batch_concurrency = RPC_BATCH_CONCURRENCY
+        self.fanout_concurrency = FANOUT_CONCURRENCY
+        self._session_max_queue_length = None
+        self._session_max_wait_time = None
+        self._session_pool_sizes = {}
+        self._session_channel_limits = {}
+        self.result_cache = None
+        self.coalesce_requests = True
+        admission_kwargs = {}
+        limiter_kwargs = {}
+        breaker_kwargs = {}
+        options = self.config.get('options')
+        if options:
+            try:
+                self._max_active_sessions = int(
+                    options.get('max_active_sessions', MAX_ACTIVE_SESSIONS))
+            except ValueError:
+                logging.error('Invalid max_active_sessions in options section;'
+                              ' using %d', MAX_ACTIVE_SESSIONS)
+            try:
+                self.rpc_workers = max(1, int(
+                    options.get('rpc_workers', RPC_WORKERS)))
+            except (TypeError, ValueError):
+                logging.error('Invalid rpc_workers in options section; '
+                              'using %d', RPC_WORKERS)
+            try:
+                self.rpc_batch_concurrency = max(1, int(
+                    options.get('rpc_batch_concurrency',
+                                RPC_BATCH_CONCURRENCY)))
+            except (TypeError, ValueError):
+                logging.error('Invalid rpc_batch_concurrency in options '
+                              'section; using %d', RPC_BATCH_CONCURRENCY)
+            try:
+                self.fanout_concurrency = max(1, int(
+                    options.get('fanout_concurrency', FANOUT_CONCURRENCY)))
+            except (TypeError, ValueError):
+                logging.error('Invalid fanout_concurrency in options '
+                              'section; using %d', FANOUT_CONCURRENCY)
+            try:
+                if options.get('session_max_queue_length') is not None:
+                    self._session_max_queue_length = int(
+                        options['session_max_queue_length'])
+                if options.get('session_max_wait_time') is not None:
+                    self._session_max_wait_time = float(
+                        options['session_max_wait_time'])
+            except ValueError:
+                logging.error('Invalid session queue limits in options '
+                              'section; using defaults')
+            pool_sizes = options.get('session_pool_sizes') or {}
+            for device_name, size in pool_sizes.iteritems():
+                try:
+                    self._session_pool_sizes[device_name] = int(size)
+                except (TypeError, ValueError):
+                    logging.error('Invalid session pool size %r for device '
+                                  '%r in options section', size, device_name)
+            channel_limits = options.get('session_channel_limits') or {}
+            for device_name, limit in channel_limits.iteritems():
+                try:
+                    self._session_channel_limits[device_name] = int(limit)
+                except (TypeError, ValueError):
+                    logging.error('Invalid session channel limit %r for '
+                                  'device %r in options section',
+                                  limit, device_name)
+            self.coalesce_requests = bool(
+                options.get('coalesce_requests', True))
+            admission_options = options.get('admission') or {}
+            for name, convert in (('max_pending', int),
+                                  ('max_device_pending', int),
+                                  ('target_delay', float),
+                                  ('interval', float)):
+                if admission_options.get(name) is None:
+                    continue
+                try:
+                    admission_kwargs[name] = convert(admission_options[name])
+                except (TypeError, ValueError):
+                    logging.error('Invalid admission %s in options section; '
+                                  'using default', name)
+            limiter_options = options.get('connect_limits') or {}
+            for name, convert in (('max_connecting', int),
+                                  ('max_prefix_connecting', int),
+                                  ('ipv4_prefix_length', int),
+                                  ('ipv6_prefix_length', int),
+                                  ('device_rate', float),
+                                  ('device_burst', int),
+                                  ('max_wait', float)):
+                if limiter_options.get(name) is None:
+                    continue
+                try:
+                    limiter_kwargs[name] = convert(limiter_options[name])
+                except (TypeError, ValueError):
+                    logging.error('Invalid connect_limits %s in options '
+                                  'section; using default', name)
+            breaker_options = options.get('circuit_breaker') or {}
+            for name, convert in (('failure_threshold', int),
+                                  ('initial_backoff', float),
+                                  ('max_backoff', float)):
+                if breaker_options.get(name) is None:
+                    continue
+                try:
+                    breaker_kwargs[name] = convert(breaker_options[name])
+                except (TypeError, ValueError):
+                    logging.error('Invalid circuit_breaker %s in options '
+                                  'section; using default', name)
+            cache_options = options.get('result_cache')
+            if cache_options:
+                try:
+                    self.result_cache = result_cache.ResultCache(
+                        cache_options.get('ttls') or [],
+                        maximum_bytes=int(cache_options.get(
+                            'maximum_bytes',
+                            result_cache.DEFAULT_MAXIMUM_BYTES)))
+                except (AttributeError, TypeError, ValueError), e:
+                    logging.error('Invalid result_cache in options section; '
+                                  'results will not be cached. %s', e)
+        self.admission = admission.AdmissionControl(**admission_kwargs)
+        self.connect_limiter = connect_limiter.ConnectLimiter(
+            **limiter_kwargs)
+        self.circuit_breaker = circuit_breaker.CircuitBreaker(
+            self._probe_device, **breaker_kwargs)
+
+    def schedule_idle_check(self, session):
+        """Schedules the session's idle timeout check.
+
+        Sessions are checked at their idle deadline (the time of their last
+        request plus the device's MAX_IDLE_TIME). Sessions already scheduled
+        are not added again; their deadline is recalculated when due.
+
+        Args:
+          session: A session.Session object.
+        """
+        if id(session) in self._idle_scheduled:
+            return
+        deadline = session.idle_deadline
+        if deadline is None:
+            return
+        self._idle_scheduled.add(id(session))
+        heapq.heappush(self._idle_deadlines,
+                       (deadline, self._idle_sequence.next(), session))
+
     def _session_idle_check(self):
-        """Checks the idle timeouts for all sessions."""
-        start = time.time()
-        for session in self.sessions.values():
-            if session is None:
-                continue
-            elif not session.idle or not session.connected:
+        """Disconnects sessions which have passed their idle deadline."""
+        start = now = time.time()
+        due = []
+        while self._idle_deadlines and self._idle_deadlines[0][0] <= now:
+            _, _, session = heapq.heappop(self._idle_deadlines)
+            self._idle_scheduled.discard(id(session))
+            due.append(session)
+        for session in due:
+            if not session.connected:
                 continue
-            elif (time.time() > (session.time_last_request or 0) +
-                  session.device.MAX_IDLE_TIME):
+            elif session.busy:
+                # Check again after the request completes.
+                self.schedule_idle_check(session)
+            elif session.idle_deadline > now:
+                # The session was used since it was scheduled.
+                self.schedule_idle_check(session)
+            else:
                 logging.debug('Session disconnect (idle for %d sec): %s',
                               session.device.MAX_IDLE_TIME,
                               session.device.name)
@@ -109,6 +317,59 @@ class Controller(object):
         eventlet.spawn_after(
             wait_time, self._session_idle_check)
 
+    def cache_stats(self):
+        """Returns statistics for the agent's caches.
+
+        Returns:
+          A dict with the 'sessions' cache statistics and the per-device
+          source 'device_matches' cache statistics (see lru.LruDict.stats),
+          the number of coalesced 'in_flight' requests executing and of
+          requests 'coalesced' with them, and the 'results' cache
+          statistics if results are cached (see
+          result_cache.ResultCache.stats).
+        """
+        result = {'sessions': self.sessions.stats(),
+                  'device_matches': self.device_manager.cache_stats(),
+                  'in_flight': {'requests': len(self._in_flight),
+                                'coalesced': self._coalesced}}
+        if self.result_cache is not None:
+            result['results'] = self.result_cache.stats()
+        return result
+
+    def connect_stats(self):
+        """Returns the connection limiter statistics.
+
+        Returns:
+          A dict; see connect_limiter.ConnectLimiter.stats.
+        """
+        return self.connect_limiter.stats()
+
+    def circuit_stats(self):
+        """Returns the circuit breaker state of devices failing to connect.
+
+        Returns:
+          A dict; see circuit_breaker.CircuitBreaker.stats.
+        """
+        return self.circuit_breaker.stats()
+
+    def session_stats(self):
+        """Returns the state and request queue statistics of each session.
+
+        Returns:
+          A dict, keyed by device name, of lists of dicts (one per session
+          to the device) including the session key attributes and the
+          statistics from session.Session.stats().
+        """
+        result = {}
+        for key, sess in self.sessions.items():
+            if sess is None:
+                continue
+            stats = sess.stats()
+            stats.update(connect_method=key.connect_method, user=key.user,
+                         privilege_level=key.privilege_level)
+            result.setdefault(key.device_name, []).append(stats)
+        return result
+
     def load_credentials(self):
         """Loads the credentials store (login passwords/keys)."""
         self.credentials = None
@@ -126,6 +387,10 @@ class Controller(object):
     def create_session(self, key):
         """Creates a session.Session object for the session key.
 
+        Devices allowing more than one session (see the device's
+        MAX_SESSIONS or the session_pool_sizes option) are given a
+        session.SessionPool, instead.
+
         No exceptions are raised here (due to this being a callback
         executed by the LRU cache).
 
@@ -133,7 +398,7 @@ class Controller(object):
           key: A session.SessionKey object, the session key.
 
         Returns:
-          A session.Session object.
+          A session.Session or session.SessionPool object.
 
         Raises:
           NoSuchDeviceError: The device did not exist.
@@ -141,18 +406,89 @@ class Controller(object):
         device_info = self.device_manager.device_info(key.device_name)
 
         if device_info:
-            device = device_factory.new_device(
-                device_info.device_name, device_info.device_type,
-                addresses=device_info.addresses)
-            return session.Session(device=device)
+            device = self._new_device(device_info)
+            session_kwargs = dict(
+                request_callback=self.schedule_idle_check,
+                max_queue_length=self._session_max_queue_length,
+                max_wait_time=self._session_max_wait_time,
+                max_channels=self._session_channel_limits.get(
+                    device_info.device_name))
+            max_sessions = self._session_pool_sizes.get(
+                device_info.device_name, device.MAX_SESSIONS)
+            if max_sessions > 1:
+                return session.SessionPool(
+                    functools.partial(self._new_device, device_info),
+                    max_sessions, device=device, **session_kwargs)
+            else:
+                return session.Session(device=device, **session_kwargs)
         else:
             raise notch.agent.errors.NoSuchDeviceError('Unknown device %r'
                                                        % key.device_name)
 
+    def _new_device(self, device_info):
+        """Returns a new device.Device subclass instance for the device."""
+        device = device_factory.new_device(
+            device_info.device_name, device_info.device_type,
+            addresses=device_info.addresses)
+        device.connect_limiter = self.connect_limiter
+        device.circuit_breaker = self.circuit_breaker
+        return device
+
+    def _probe_device(self, device_name):
+        """Connects to then disconnects from a device with an open circuit.
+
+        Raises:
+          ConnectError: The device could not be connected to.
+          NoSuchDeviceError: The device did not exist.
+          NoMatchingCredentialError: No credential matched the device.
+        """
+        device_info = self.device_manager.device_info(device_name)
+        if not device_info:
+            raise notch.agent.errors.NoSuchDeviceError(
+                'Unknown device %r' % device_name)
+        if not self.credentials:
+            raise notch.agent.errors.NoMatchingCredentialError(
+                'No credentials for host %r' % device_name)
+        credential = self.credentials.get_credential(device_name)
+        device = self._new_device(device_info)
+        # The probe must not be refused by the open circuit.
+        device.circuit_breaker = None
+        device.connect(credential=credential,
+                       connect_method=credential.connect_method)
+        try:
+            device.disconnect()
+        except notch.agent.errors.Error, e:
+            logging.debug('Error disconnecting probe of %s: %s',
+                          device_name, e)
+
     def expire_session(self, unused_session_key, session_value):
-        """LRU cache expiry callback for the sessions cache."""
+        """LRU cache expiry callback for the sessions cache.
+
+        Raises:
+          lru.DontExpireError: The session is busy with a request.
+        """
+        if session_value.busy:
+            raise lru.DontExpireError
         session_value.disconnect()
 
+    def session_eviction_cost(self, unused_session_key, session_value):
+        """LRU cache eviction cost callback for the sessions cache.
+
+        The cost is the session's measured connection time amortised over
+        the time it has been idle, so long idle or cheaply reconnected
+        sessions are evicted before recently used expensive ones.
+
+        Returns:
+          A float, the cost of evicting the session. Busy sessions cannot
+          be evicted, and cost float('inf').
+        """
+        if session_value.busy:
+            return float('inf')
+        elif not session_value.connected:
+            return 0.0
+        return (session_value.connect_cost or 0.0) / max(
+            1.0, session_value.idle_time)
+
     def get_session(self, **kwargs):
         """Returns a session matching the keyword arguments.
 
@@ -190,12 +526,59 @@ class Controller(object):
         except KeyError:
             return None
 
+    def _session_for_request(self, kwargs):
+        """Returns the session for a request, with its credential set.
+
+        Raises:
+          NoSessionCreatedError: No session matched the request arguments.
+          NoSuchDeviceError: The request had no device_name argument.
+          NoMatchingCredentialError: No credential matched the device.
+        """
+        session = self.get_session(**kwargs)
+        if session is None:
+            raise notch.agent.errors.NoSessionCreatedError(
+                'No session available for request arguments %r' % kwargs)
+        if 'device_name' not in kwargs:
+                raise notch.agent.errors.NoSuchDeviceError(
+                    'No device_name argument in request')
+        # TODO(afort): What if there's no credentials.
+        if self.credentials and 'device_name' in kwargs:
+            session.credential = self.credentials.get_credential(
+                kwargs['device_name'])
+            return session
+        else:
+            raise notch.agent.errors.NoMatchingCredentialError(
+                'No credentials for host %r' % kwargs['device_name'])
+
+    def _result_cache_key(self, method, kwargs):
+        """Returns the result cache key for a request, or None."""
+        if self.result_cache is None or method != 'command':
+            return None
+        command = kwargs.get('command')
+        if not isinstance(command, basestring):
+            return None
+        return result_cache.CacheKey(
+            device_name=kwargs.get('device_name'), command=command,
+            mode=kwargs.get('mode'), encoding=kwargs.get('encoding'),
+            scope=(kwargs.get('connect_method'), kwargs.get('user'),
+                   kwargs.get('privilege_level')))
+
     def request(self, method, **kwargs):
         """Executes a Notch device API request.
 
+        Commands are answered from the result cache, if it holds a response
+        young enough. Requests which may change the device (see
+        result_cache.INVALIDATING_METHODS) discard its cached responses.
+
+        A request for one of COALESCED_METHODS with the same arguments as
+        one being executed waits for, and receives, that request's result
+        or exception, rather than executing again.
+
         Args:
           method: A string, the device API method name.
-          kwargs: A dict, the keyword arguments for the request.
+          kwargs: A dict, the keyword arguments for the request. The
+            optional 'max_age' argument (a float) is the oldest cached
+            response, in seconds, acceptable; 0 always runs the command.
 
         Returns:
           Either an errors.Error subclass instance (when the request ends
@@ -203,23 +586,34 @@ class Controller(object):
 
         Raises:
           notch.agent.errors.NoSuchDeviceError if there was no device supplied
+          notch.agent.errors.InvalidRequestError if max_age was invalid
         """
-        session = self.get_session(**kwargs)
-        if session is None:
-            raise notch.agent.errors.NoSessionCreatedError(
-                'No session available for request arguments %r' % kwargs)
-        if 'device_name' not in kwargs:
-                raise notch.agent.errors.NoSuchDeviceError(
-                    'No device_name argument in request')
+        max_age = kwargs.pop('max_age', None)
         try:
-            # TODO(afort): What if there's no credentials.
-            if self.credentials and 'device_name' in kwargs:
-                session.credential = self.credentials.get_credential(
-                    kwargs['device_name'])
-                return session.request(method, **kwargs)
-            else:
-                raise notch.agent.errors.NoMatchingCredentialError(
-                    'No credentials for host %r' % kwargs['device_name'])
+            if max_age is not None:
+                try:
+                    max_age = float(max_age)
+                except (TypeError, ValueError):
+                    raise notch.agent.errors.InvalidRequestError(
+                        'Invalid max_age %r' % max_age)
+            cache_key = self._result_cache_key(method, kwargs)
+            if cache_key is not None:
+                result = self.result_cache.get(cache_key, max_age)
+                if result is not None:
+                    return result
+                # A change to the device whilst the command runs makes
+                # the response stale.
+                generation = self.result_cache.generation(
+                    cache_key.device_name)
+            try:
+                result = self._request_once(method, kwargs)
+            finally:
+                if (self.result_cache is not None and
+                    method in result_cache.INVALIDATING_METHODS):
+                    self.result_cache.invalidate(kwargs.get('device_name'))
+            if cache_key is not None:
+                self.result_cache.put(cache_key, result, generation)
+            return result
         except notch.agent.errors.Error, e:
             raise
         except Exception, e:
@@ -228,3 +622,235 @@ class Controller(object):
             # give the developer something to go by.
             logging.error('%s: %s', str(e.__class__), str(e), exc_info=True)
             raise
+
+    def _coalescing_key(self, method, kwargs):
+        """Returns the key for coalescing the request, or None."""
+        if not self.coalesce_requests or method not in COALESCED_METHODS:
+            return None
+        key = (method, tuple(sorted(kwargs.iteritems())))
+        try:
+            hash(key)
+        except TypeError:
+            # An argument is a list or dict.
+            return None
+        return key
+
+    def _request_once(self, method, kwargs):
+        """Executes a request, coalescing it with an identical one."""
+        key = self._coalescing_key(method, kwargs)
+        if key is None:
+            return self._session_for_request(kwargs).request(method, **kwargs)
+        if key in self._in_flight:
+            pending = self._in_flight[key]
+            if pending is None:
+                pending = self._in_flight[key] = eventlet.event.Event()
+            self._coalesced += 1
+            return pending.wait()
+        # The event is only created once another request waits.
+        self._in_flight[key] = None
+        try:
+            session = self._session_for_request(kwargs)
+            result = session.request(method, **kwargs)
+        # Waiters must be released however the request ends, e.g., by an
+        # eventlet.Timeout.
+        except BaseException:
+            exc_info = sys.exc_info()
+            pending = self._in_flight.pop(key)
+            if pending is not None:
+                pending.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        pending = self._in_flight.pop(key)
+        if pending is not None:
+            pending.send(result)
+        return result
+
+    def request_batch(self, method, arguments, stop_on_error=True,
+                      max_wait_time=None, encoding=None, **kwargs):
+        """Executes a sequence of requests to one device, in order.
+
+        The device's session is acquired once for the whole sequence.
+
+        Args:
+          method: A string, the device API method name.
+          arguments: A list of dicts, the keyword arguments for each request.
+          stop_on_error: A boolean. If True, the requests following a failed
+            request are not executed.
+          max_wait_time: A float, the maximum seconds to wait for the session.
+          encoding: A string, the encoding of the responses (see
+            session.ENCODINGS).
+          kwargs: A dict, the session arguments (e.g., 'device_name').
+
+        Returns:
+          A list of dicts, one per executed request. See
+          session.Session.request_batch.
+        """
+        try:
+            session = self._session_for_request(kwargs)
+            return session.request_batch(method, arguments,
+                                         stop_on_error=stop_on_error,
+                                         max_wait_time=max_wait_time,
+                                         encoding=encoding)
+        except notch.agent.errors.Error, e:
+            raise
+        except Exception, e:
+            logging.error('%s: %s', str(e.__class__), str(e), exc_info=True)
+            raise
+
+    def request_iter(self, method, **kwargs):
+        """Executes a Notch device API request, streaming the response.
+
+        Args:
+          method: A string, the device API method name (see
+            session.Session.streamable_requests).
+          kwargs: A dict, the keyword arguments for the request.
+
+        Returns:
+          A session.ResponseStream, yielding the response in pieces. Callers
+          must exhaust or close it, to release the device's session.
+        """
+        # Streamed responses are not cached.
+        kwargs.pop('max_age', None)
+        try:
+            session = self._session_for_request(kwargs)
+            return session.request_iter(method, **kwargs)
+        except notch.agent.errors.Error, e:
+            raise
+        except Exception, e:
+            logging.error('%s: %s', str(e.__class__), str(e), exc_info=True)
+            raise
+
+    def request_matching(self, method, regexp=None, concurrency=None,
+                         dedupe=False, normalise_hostname=False, **kwargs):
+        """Executes a request on each device matching a regexp.
+
+        Requests to the devices run concurrently, at most concurrency at
+        once. All fan-out requests share the fanout_concurrency limit.
+
+        Args:
+          method: A string, the device API method name.
+          regexp: A string, the device name regular expression (see
+            device_manager.DeviceManager.devices_matching).
+          concurrency: An int, the maximum number of devices to request at
+            once, or None for the fanout_concurrency limit.
+          dedupe: A boolean. If True, responses are sent once each (see
+            _deduplicate).
+          normalise_hostname: A boolean. If True, deduplicated responses
+            differing only in the device's hostname are sent once.
+          kwargs: A dict, the keyword arguments for each request (without
+            'device_name').
+
+        Returns:
+          An iterator of dicts, one per device, in the order the devices
+          respond. Each has the 'device_name' key and either a 'result' key
+          (the response), or an 'error' key (the error name) and a
+          'message' key. Callers should exhaust or close it; closing it
+          stops further requests from starting.
+
+        Raises:
+          InvalidRequestError: The regexp was missing, or the concurrency
+            was invalid.
+        """
+        if not regexp:
+            raise notch.agent.errors.InvalidRequestError(
+                'regexp argument required')
+        try:
+            concurrency = int(concurrency or self.fanout_concurrency)
+        except (TypeError, ValueError):
+            raise notch.agent.errors.InvalidRequestError(
+                'Invalid concurrency %r' % concurrency)
+        concurrency = max(1, min(concurrency, self.fanout_concurrency))
+        kwargs.pop('device_name', None)
+        devices = sorted(self.device_manager.devices_matching(regexp))
+        results = self._request_each(method, devices, concurrency, kwargs)
+        if dedupe:
+            return _deduplicate(results, kwargs.get('encoding'),
+                                normalise_hostname)
+        return results
+
+    def _request_each(self, method, devices, concurrency, kwargs):
+        """Yields the result of a request to each device as it completes."""
+        results = eventlet.queue.Queue()
+        pool = eventlet.greenpool.GreenPool(concurrency)
+        stopped = []
+
+        def request(device_name):
+            self._fanout_slots.acquire()
+            try:
+                results.put(self._device_result(method, device_name, kwargs))
+            finally:
+                self._fanout_slots.release()
+
+        def spawn_requests():
+            for device_name in devices:
+                if stopped:
+                    break
+                # Waits while the pool is full.
+                pool.spawn_n(request, device_name)
+
+        eventlet.spawn_n(spawn_requests)
+        try:
+            for _ in devices:
+                yield results.get()
+        finally:
+            stopped.append(True)
+
+    def _device_result(self, method, device_name, kwargs):
+        """Returns a fan-out result dict for a request to one device."""
+        try:
+            return {'device_name': device_name,
+                    'result': self.request(method, device_name=device_name,
+                                           **kwargs)}
+        except notch.agent.errors.ApiError, e:
+            return {'device_name': device_name, 'error': e.name,
+                    'message': str(e)}
+        # One device's failure must not end the others'.
+        # pylint: disable-msg=W0703
+        except Exception, e:
+            return {'device_name': device_name,
+                    'error': e.__class__.__name__, 'message': str(e)}
+
+
+def _hostname_pattern(device_name):
+    """Returns a regexp matching the device name or its first label."""
+    names = [device_name]
+    if '.' in device_name:
+        names.append(device_name.split('.', 1)[0])
+    return re.compile(r'\b(?:%s)\b' % '|'.join(re.escape(n) for n in names),
+                      re.I)
+
+
+def _deduplicate(results, encoding, normalise_hostname=False):
+    """Yields fan-out results, sending each distinct response once.
+
+    Each result with a response gains a 'hash' key, the SHA-1 hex digest of
+    the (decoded) response. Only the first result with each hash keeps its
+    'result'; clients use the hash to find it for the others. Error
+    results are passed on unchanged.
+
+    Args:
+      results: An iterator of fan-out results (see
+        Controller.request_matching).
+      encoding: A string, the encoding of the responses (see
+        session.ENCODINGS).
+      normalise_hostname: A boolean. If True, the device's name (and its
+        first label) are removed from the response before hashing, so
+        responses differing only in the hostname share a hash. The response
+        sent is that of the first device.
+    """
+    seen = set()
+    try:
+        for result in results:
+            if 'result' in result:
+                response = session.decode(result['result'], encoding)
+                if normalise_hostname:
+                    response = _hostname_pattern(
+                        result['device_name']).sub('', response)
+                digest = hashlib.sha1(response).hexdigest()
+                result['hash'] = digest
+                if digest in seen:
+                    del result['result']
+                else:
+                    seen.add(digest)
+            yield result
+    finally:
+        results.close()
@@ -285,6 +285,15 @@ class DeviceManager(object):
             if result is not None:
                 return result
 
+    def cache_stats(self):
+        """Returns the match cache statistics for each provider.
+
+        Returns:
+          A dict, keyed by device source name, of lru.LruDict.stats() dicts.
+        """
+        return dict((source, provider._match_cache.stats())
+                    for (_, source), provider in self.providers.iteritems())
+
     def devices_matching(self, regexp):
         """Returns a set of device names matching the regexp.
 
@@ -22,3 +22,6 @@ import dev_paramiko
 class FspDevice(dev_paramiko.ParamikoDevice):
     """An Adva FSP device model."""
 
+    # Each request uses its own SSH2 channel on the session's transport.
+    MAX_CHANNELS = 2
+
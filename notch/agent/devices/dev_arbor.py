@@ -51,7 +51,8 @@ class ArborDevice(device.Device):
                  connect_method=None, credential=None):
         port = port or self._port
         self._transport = trans_paramiko_expect.ParamikoExpectTransport(
-            timeouts=self.timeouts, address=str(address), port=port)       
+            timeouts=self.timeouts, address=str(address), port=port,
+            anchor_prompt=self.ANCHOR_PROMPT)
         self._transport.connect(credential)
         self._get_prompt(password=credential.password)
         if credential.auto_enable:
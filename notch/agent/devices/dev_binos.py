@@ -42,3 +42,16 @@ class BinosDevice(dev_ios.IosDevice):
                 exc = notch.agent.errors.CommandError(str(e))
                 exc.retry = True
                 raise exc
+
+    def _command_iter(self, command, mode=None):
+        # mode argument is as yet unused. Quieten pylint.
+        _ = mode
+        try:
+            for data in self._transport.command_iter(command, self._prompt,
+                                                     expect_trailer='\n',
+                                                     expect_command=False):
+                yield data
+        except (OSError, EOFError, pexpect.EOF, pexpect.TIMEOUT), e:
+            exc = notch.agent.errors.CommandError(str(e))
+            exc.retry = True
+            raise exc
@@ -56,11 +56,13 @@ class FtosDevice(dev_ios.IosDevice):
         if connect_method == 'sshv1' or connect_method is None:
             self._transport = trans_ssh.SshDeviceTransport(
                 timeouts=self.timeouts, port=port, address=str(address),
-                command_trailer='\r\n')
+                command_trailer='\r\n',
+                anchor_prompt=self.ANCHOR_PROMPT)
         elif connect_method == 'telnet':
             self._transport = trans_telnet.TelnetDeviceTransport(
                 timeouts=self.timeouts, port=port, address=str(address),
-                command_trailer='\r\n')
+                command_trailer='\r\n',
+                anchor_prompt=self.ANCHOR_PROMPT)
         else:
             raise ValueError('Unsupported connect_method: %r' %
                              connect_method)
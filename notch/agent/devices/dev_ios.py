@@ -72,10 +72,12 @@ class IosDevice(device.Device):
         connect_method = connect_method or self.connect_method
         if connect_method == 'sshv2' or connect_method is None:
             self._transport = trans_paramiko_expect.ParamikoExpectTransport(
-                timeouts=self.timeouts, port=port, address=str(address))
+                timeouts=self.timeouts, port=port, address=str(address),
+                anchor_prompt=self.ANCHOR_PROMPT)
         elif connect_method == 'telnet':
             self._transport = trans_telnet.TelnetDeviceTransport(
-                timeouts=self.timeouts, port=port, address=str(address))
+                timeouts=self.timeouts, port=port, address=str(address),
+                anchor_prompt=self.ANCHOR_PROMPT)
         else:
             raise ValueError('Unsupported connect_method: %r' %
                              connect_method)
@@ -161,9 +163,12 @@ class IosDevice(device.Device):
                     'Did not find login prompt %r.'
                     ' Instead, got %r' % (self.LOGIN_PROMPT,
                                           self._transport.before))
-            elif i == 1 or i == 2:
+            elif i == 1:
                 raise notch.agent.errors.ConnectError(
                     'Device says: %r' % self._transport.match)
+            elif i == 2:
+                raise notch.agent.errors.SessionLimitError(
+                    'Device says: %r' % self._transport.match)
             else:
                 self._transport.write(username + '\n')
                 i = self._transport.expect(
@@ -210,3 +215,40 @@ class IosDevice(device.Device):
                 exc = notch.agent.errors.CommandError(str(e))
                 exc.retry = True
                 raise exc
+
+    def _command_iter(self, command, mode=None):
+        # mode argument is as yet unused. Quieten pylint.
+        _ = mode
+        try:
+            for data in self._transport.command_iter(command, self._prompt):
+                yield data
+        except (OSError, EOFError, pexpect.EOF), e:
+            exc = notch.agent.errors.CommandError(str(e))
+            exc.retry = True
+            raise exc
+
+    def _commands(self, commands, mode=None):
+        # mode argument is as yet unused. Quieten pylint.
+        _ = mode
+        try:
+            return self._transport.commands(commands, self._prompt)
+        except (OSError, EOFError, pexpect.EOF), e:
+            exc = notch.agent.errors.CommandError(str(e))
+            exc.retry = True
+            raise exc
+
+
+class CiscoIosDevice(IosDevice):
+    """Cisco Systems IOS device model.
+
+    Settings only known to suit cisco devices are made here, rather than
+    inherited by every IOS style device model.
+    """
+
+    # IOS devices usually have five vtys; leave some for humans.
+    MAX_SESSIONS = 2
+
+    # IOS buffers commands typed ahead of its prompt.
+    PIPELINE_COMMANDS = True
+    # IOS prompts follow a line ending.
+    ANCHOR_PROMPT = True
@@ -22,3 +22,6 @@ import dev_paramiko
 
 class JunosDevice(dev_paramiko.ParamikoDevice):
     """Juniper Networks JunOS device model."""
+
+    # Each request uses its own SSH2 channel on the session's transport.
+    MAX_CHANNELS = 4
@@ -47,6 +47,9 @@ class BayDevice(dev_ios.IosDevice):
     PAGER = re.compile(r'(\-{4}.*More.*\-{4}|\-\-More\-\-)')
     POST_PAGER = re.compile(r'(\x08\x08 )*')
 
+    # Bay switches support few concurrent CLI sessions; use only one.
+    MAX_SESSIONS = 1
+
     def __init__(self, name=None, addresses=None):
         super(BayDevice, self).__init__(name=name, addresses=addresses)
 
@@ -82,6 +85,20 @@ class BayDevice(dev_ios.IosDevice):
                 exc.retry = True
                 raise exc
 
+    def _command_iter(self, command, mode=None):
+        # mode argument is as yet unused. Quieten pylint.
+        _ = mode
+        try:
+            for data in self._transport.command_iter(command, self._prompt,
+                                                     expect_trailer='\r',
+                                                     pager=self.PAGER,
+                                                     strip_chars=['\b ','\b']):
+                yield data
+        except (OSError, EOFError, pexpect.EOF, pexpect.TIMEOUT), e:
+            exc = notch.agent.errors.CommandError(str(e))
+            exc.retry = True
+            raise exc
+
     def _disable_pager(self):
         logging.debug('Disabling pager on %r', self.name)
         self._command('terminal length 0')
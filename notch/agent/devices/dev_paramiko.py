@@ -21,6 +21,8 @@ import os
 import socket
 import tempfile
 
+import eventlet.semaphore
+from eventlet.green import select
 import paramiko
 
 import notch.agent.errors
@@ -29,8 +31,16 @@ import device
 import scp
 
 
+# Bytes read from a command's output (or a downloaded file) at once.
+READ_SIZE = 32768
+
+
 class ParamikoDevice(device.Device):
-    """Generic paramiko SSHv2 device model."""
+    """Generic paramiko SSHv2 device model.
+
+    Each request opens its own channel on the SSH2 transport, so concurrent
+    requests (up to MAX_CHANNELS) may share one connection.
+    """
 
     DEFAULT_CONNECT_METHOD = 'sshv2'
     DEFAULT_PORT = 22
@@ -40,19 +50,17 @@ class ParamikoDevice(device.Device):
         self.connect_methods = ('sshv2', )
         self._ssh_client = None
         self._port = None
+        # Serialises reconnection by concurrent requests.
+        self._transport_lock = eventlet.semaphore.Semaphore()
 
     def _reconnect(self):
-        self._connect(address=self.__address,
-                      port=self.__port,
-                      connect_method=self.__connect_method,
-                      credential=self._current_credential)
+        # Reconnect as connect() does, subject to the connection limiter
+        # and circuit breaker.
+        self.connect(credential=self._current_credential,
+                     connect_method=self._connect_method)
 
     def _connect(self, address=None, port=None,
                  connect_method=None, credential=None):
-        self.__address = address
-        self.__port = port
-        self.__connect_method = connect_method
-        self.__credential = credential
         # Just ignore the connect method, we only support sshv2.
         _ = connect_method
 
@@ -84,14 +92,15 @@ class ParamikoDevice(device.Device):
         self._ssh_client = None
 
     def __check_transport(self):
-        transport = self._ssh_client.get_transport()
-        if transport is None:
-            self._reconnect()
-            transport = self._ssh_client.get_transport()
-        elif transport is not None and not transport.is_active():
-            self._reconnect()
+        self._transport_lock.acquire()
+        try:
             transport = self._ssh_client.get_transport()
-        return transport
+            if transport is None or not transport.is_active():
+                self._reconnect()
+                transport = self._ssh_client.get_transport()
+            return transport
+        finally:
+            self._transport_lock.release()
 
     def _exec_command(self, command, bufsize=-1, combine_stderr=False,
                       timeout=None):
@@ -108,6 +117,9 @@ class ParamikoDevice(device.Device):
         return stdin, stdout, stderr
 
     def _command(self, command, mode=None):
+        return ''.join(self._command_iter(command, mode=mode))
+
+    def _command_iter(self, command, mode=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
@@ -121,11 +133,37 @@ class ParamikoDevice(device.Device):
         else:
             stdin.close()
         try:
-            return ''.join(stdout.readlines())
+            while True:
+                data = self._recv(stdout.channel)
+                if not data:
+                    break
+                yield data
         finally:
             stdout.close()
             stderr.close()
 
+    def _recv(self, channel):
+        """Receives the next piece of a channel's output.
+
+        paramiko's reads wait on a (stdlib) threading.Condition, which would
+        block every greenthread. Instead, wait on the channel's file
+        descriptor, readable once data or EOF arrives, then receive.
+
+        Args:
+          channel: A paramiko.Channel.
+
+        Returns:
+          A string, the data received; empty at the end of the output.
+
+        Raises:
+          socket.timeout: No data arrived within the channel's timeout.
+        """
+        readable, _, _ = select.select([channel], [], [],
+                                       channel.gettimeout())
+        if not readable:
+            raise socket.timeout('Timed out waiting for command output')
+        return channel.recv(READ_SIZE)
+
     def download_file(self, source, destination, mode=None, overwrite=False):
         if not overwrite:
             if not os.path.exists(destination):
@@ -149,7 +187,17 @@ class ParamikoDevice(device.Device):
             raise notch.agent.errors.DownloadError(str(e))
 
     def get_config(self, source, mode=None):
+        return ''.join(self.get_config_iter(source, mode=mode))
+
+    def get_config_iter(self, source, mode=None):
         tf = tempfile.NamedTemporaryFile()
-        self.download_file(source, tf.name, mode=mode)
-        tf.seek(0)
-        return tf.read()
+        try:
+            self.download_file(source, tf.name, mode=mode)
+            tf.seek(0)
+            while True:
+                data = tf.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            tf.close()
@@ -62,7 +62,8 @@ class TimosDevice(device.Device):
                  connect_method=None, credential=None):
         port = port or self._port
         self._transport = trans_paramiko_expect.ParamikoExpectTransport(
-            timeouts=self.timeouts, address=str(address), port=port)       
+            timeouts=self.timeouts, address=str(address), port=port,
+            anchor_prompt=self.ANCHOR_PROMPT)
         self._transport.connect(credential)
         self._get_prompt(password=credential.password)
         self._disable_pager()
@@ -138,4 +139,17 @@ class TimosDevice(device.Device):
                 raise exc
             else:
                 pass
+
+    def _command_iter(self, command, mode=None):
+        # mode argument is as yet unused. Quieten pylint.
+        _ = mode
+        try:
+            for data in self._transport.command_iter(
+                command, self._prompt, expect_command=False,
+                command_trailer='\r', expect_trailer='[^\r]*\r\n'):
+                yield data
+        except (OSError, EOFError, pexpect.EOF), e:
+            exc = notch.agent.errors.CommandError(str(e))
+            exc.retry = True
+            raise exc
         
@@ -44,13 +44,42 @@ class Device(object):
         connection methods.
       name: A string, the device (host) name.
       vendor: A string, the device type name (e.g., 'juniper', 'cisco').
+      connect_limiter: A connect_limiter.ConnectLimiter, limiting connection
+        attempts, or None (the default) for no limit.
+      circuit_breaker: A circuit_breaker.CircuitBreaker, failing connection
+        attempts to the device while it is unreachable, or None.
     """
     # In concrete classes, set this to the vendor OS identifier.
     vendor = None
 
+    # Set on instances by the controller, to limit connection attempts.
+    connect_limiter = None
+    circuit_breaker = None
+
     # Default connect method for this device, e.g., 'sshv2' or 'telnet'
     DEFAULT_CONNECT_METHOD = None
 
+    # The maximum number of concurrent sessions (connections) the agent
+    # opens to the device. Keep this below the device's vty/session limit.
+    MAX_SESSIONS = 1
+
+    # The maximum number of requests executed at once on one session.
+    # Devices multiplexing requests over one connection (e.g., as SSH2
+    # channels) may raise this; requests are otherwise executed serially.
+    MAX_CHANNELS = 1
+
+    # True if several commands may be written to the device at once (i.e.,
+    # the device buffers input typed ahead of its prompt), so that command
+    # sequences are pipelined. Only set it for devices known to do so; a
+    # device dropping type-ahead loses or mixes up command responses.
+    PIPELINE_COMMANDS = False
+
+    # True if the CLI prompt always starts a line, so that the transport
+    # need not look for it elsewhere (e.g., within command output). Only
+    # set it for devices known never to draw the prompt after other text
+    # (e.g., escape sequences) on its line; such a prompt is never found.
+    ANCHOR_PROMPT = False
+
     # Timeout values used by session to determine liveness/etc.
     # Override as required in concrete device classes.
     MAX_IDLE_TIME = 900.0
@@ -129,39 +158,56 @@ class Device(object):
         if self._connect_method is None:
             self._connect_method = self.DEFAULT_CONNECT_METHOD
         self._current_credential = credential
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check(self.name)
 
         logging.debug('CONNECT %s %s', self.name, self._connect_method)
         # Try all of the available addresses.
         last_exc = None
         success = False
-        for address in self.addresses:
+        for i, address in enumerate(self.addresses):
+            # Waiting for the limiter is not part of the connect timeout.
+            # A connection is charged once to the device's rate limit,
+            # however many addresses it tries.
+            if self.connect_limiter is not None:
+                self.connect_limiter.acquire(self.name, address,
+                                             charge=(i == 0))
             try:
-                self._connect(address=address, credential=credential,
-                              connect_method=self._connect_method)
-                success = True
-                logging.debug('CONNECT_OK %s %s @ %s',
-                              self.name, self._connect_method, address)
-                break
-            except (EOFError, pexpect.EOF, pexpect.TIMEOUT, OSError), e:
-                success = False
-                # Don't retry certain errors: futility is not a strategy.
-                last_exc = notch.agent.errors.ConnectError(str(e))
-                if hasattr(e, 'errno') and e.errno not in self.DONT_RETRY_ERRNO:
-                    last_exc.retry = True
-                elif isinstance(e, pexpect.EOF):
-                    last_exc.retry = True
-                logging.error('CONNECT_FAIL %s %s @ %s: [%s] %s',
-                              self.name, self._connect_method, address,
-                              e.__class__.__name__, str(e))
-            except notch.agent.errors.ConnectError, e:
-                success = False
-                last_exc = e
-                logging.error('CONNECT_FAIL %s %s @ %s: [%s] %s',
-                              self.name, self._connect_method, address,
-                              e.__class__.__name__, str(e))
+                try:
+                    self._connect(address=address, credential=credential,
+                                  connect_method=self._connect_method)
+                    success = True
+                    logging.debug('CONNECT_OK %s %s @ %s',
+                                  self.name, self._connect_method, address)
+                    break
+                except (EOFError, pexpect.EOF, pexpect.TIMEOUT, OSError), e:
+                    success = False
+                    # Don't retry certain errors: futility is not a strategy.
+                    last_exc = notch.agent.errors.ConnectError(str(e))
+                    if (hasattr(e, 'errno') and
+                        e.errno not in self.DONT_RETRY_ERRNO):
+                        last_exc.retry = True
+                    elif isinstance(e, pexpect.EOF):
+                        last_exc.retry = True
+                    logging.error('CONNECT_FAIL %s %s @ %s: [%s] %s',
+                                  self.name, self._connect_method, address,
+                                  e.__class__.__name__, str(e))
+                except notch.agent.errors.ConnectError, e:
+                    success = False
+                    last_exc = e
+                    logging.error('CONNECT_FAIL %s %s @ %s: [%s] %s',
+                                  self.name, self._connect_method, address,
+                                  e.__class__.__name__, str(e))
+            finally:
+                if self.connect_limiter is not None:
+                    self.connect_limiter.release(address)
         if success:
             self._connected = True
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.success(self.name)
         elif last_exc is not None:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.failure(self.name, last_exc)
             raise last_exc
 
     def _connect(self, address=None, port=None,
@@ -187,10 +233,53 @@ class Device(object):
         """Executes a command on the device."""
         return self._command(command, mode=mode)
 
+    def _command_iter(self, command, mode=None):
+        """Implements the execution of a command, yielding its output.
+
+        Devices able to read the output in pieces override this; by
+        default the whole output is yielded at once.
+        """
+        yield self._command(command, mode=mode)
+
+    def command_iter(self, command, mode=None):
+        """Executes a command on the device, yielding its output in pieces."""
+        return self._command_iter(command, mode=mode)
+
+    def _commands(self, commands, mode=None):
+        """Implements pipelined execution of commands on the device."""
+        raise NotImplementedError
+
+    def commands(self, commands, mode=None):
+        """Executes a list of commands on the device, in order.
+
+        Commands are pipelined if the device allows it (PIPELINE_COMMANDS).
+
+        Returns:
+          A list of strings, the response to each command.
+
+        Raises:
+          notch.agent.errors.ApiError: A command failed. Its 'responses'
+            attribute holds the list of responses to the preceding commands.
+        """
+        if self.PIPELINE_COMMANDS and len(commands) > 1:
+            return self._commands(commands, mode=mode)
+        responses = []
+        for command in commands:
+            try:
+                responses.append(self.command(command, mode=mode))
+            except notch.agent.errors.ApiError, e:
+                e.responses = responses
+                raise
+        return responses
+
     def get_config(self, source, mode=None):
         """Gets the configuration of the source in the desired mode."""
         raise NotImplementedError
 
+    def get_config_iter(self, source, mode=None):
+        """Gets the configuration of the source, yielding it in pieces."""
+        yield self.get_config(source, mode=mode)
+
     def set_config(self, destination, config_data, mode=None):
         """Sets the destination configuration with supplied data."""
         _ = destination, config_data, mode
@@ -18,23 +18,239 @@
 
 import os
 import re
+import time
 
 import pexpect
 
 import notch.agent.errors
 
 
-STRIP_ANSI = [
-    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
-    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
-    re.compile(r'[\x03|\x1a]'),
-    ]
+# ANSI escape sequences.
+STRIP_ANSI = re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]')
+# Terminal control characters, stripped with ANSI escape sequences.
+STRIP_CONTROL_CHARS = '\x03\x1a'
+
+
+# Bytes of already searched data searched again with newly received data,
+# so that matches split across reads are found. Must exceed the longest
+# expected match (e.g., the CLI prompt).
+SEARCH_WINDOW = 512
+
+# Bytes requested from the device per read.
+READ_SIZE = 32768
+
+# Compiled patterns, by pattern string (and anchoring).
+_COMPILED = {}
+_COMPILED_MAX = 256
+
+
+def compile_pattern(pattern, anchor=False):
+    """Returns a compiled regular expression, compiled only once.
+
+    Args:
+      pattern: A string or compiled regular expression.
+      anchor: A boolean. If True, the pattern only matches at the start of
+        the data or of a line (after a carriage return or newline).
+    """
+    key = (pattern, anchor)
+    try:
+        return _COMPILED[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable (or foreign) pattern; leave it to the re module.
+        return re.compile(pattern)
+    if isinstance(pattern, basestring):
+        source = pattern
+    else:
+        source = pattern.pattern
+    if anchor:
+        compiled = re.compile(r'(?:^|(?<=[\r\n]))(?:%s)' % source,
+                              getattr(pattern, 'flags', 0))
+    elif isinstance(pattern, basestring):
+        compiled = re.compile(pattern)
+    else:
+        compiled = pattern
+    if len(_COMPILED) >= _COMPILED_MAX:
+        _COMPILED.clear()
+    _COMPILED[key] = compiled
+    return compiled
 
 
 class Error(Exception):
     pass
 
 
+class OutputNormaliser(object):
+    """Removes unwanted data from command output.
+
+    The removals for a transport configuration are composed once, in order:
+    characters in strip_chars, then DOS line endings, then ANSI escape
+    sequences. Each is a C-level pass (str.replace, str.translate or one
+    precompiled regular expression) and is skipped, without copying the
+    data, when the data has nothing for it to remove.
+    """
+
+    def __init__(self, strip_ansi=False, dos2unix=False, strip_chars=None):
+        """Initializer.
+
+        Args:
+          strip_ansi: A boolean, if True, strip ANSI escape sequences.
+          dos2unix: A boolean, if True, convert DOS line endings to UNIX.
+          strip_chars: A sequence of strings to strip.
+        """
+        self._steps = []
+        for strip_char in strip_chars or ():
+            if strip_char:
+                self._steps.append(
+                    lambda data, c=strip_char: data.replace(c, ''))
+        if dos2unix:
+            self._steps.append(self._dos2unix)
+        if strip_ansi:
+            self._steps.append(self._strip_ansi)
+
+    @staticmethod
+    def _dos2unix(data):
+        if '\r' not in data:
+            return data
+        # Some platforms send CR CR LF, so we need to do this twice.
+        data = data.replace('\r\n', '\n')
+        return data.replace('\r\n', '\n')
+
+    @staticmethod
+    def _strip_ansi(data):
+        if '\x1b' in data:
+            data = STRIP_ANSI.sub('', data)
+        for c in STRIP_CONTROL_CHARS:
+            if c in data:
+                return data.translate(None, STRIP_CONTROL_CHARS)
+        return data
+
+    def __call__(self, data):
+        """Returns the normalised data."""
+        if data:
+            for step in self._steps:
+                data = step(data)
+        return data
+
+
+_NORMALISERS = {}
+
+
+def get_normaliser(strip_ansi=False, dos2unix=False, strip_chars=None):
+    """Returns the OutputNormaliser for a configuration, built only once."""
+    key = (bool(strip_ansi), bool(dos2unix), tuple(strip_chars or ()))
+    try:
+        return _NORMALISERS[key]
+    except KeyError:
+        normaliser = OutputNormaliser(*key)
+        if len(_NORMALISERS) >= _COMPILED_MAX:
+            _NORMALISERS.clear()
+        _NORMALISERS[key] = normaliser
+        return normaliser
+
+
+class StreamSearcher(object):
+    """Finds the earliest match of any of a list of patterns in a stream.
+
+    Each call to feed() searches only the new data and the last
+    SEARCH_WINDOW bytes of data already searched, so the total cost of
+    searching is linear in the length of the stream (rather than searching
+    the whole stream again after each read, as pexpect does). Data which
+    no later match can include may be taken from the searcher with
+    release(), so that the data held stays small however long the stream.
+
+    Attributes:
+      eof_index: An int, the index of pexpect.EOF in the list, or -1.
+      timeout_index: An int, the index of pexpect.TIMEOUT in the list, or -1.
+    """
+
+    def __init__(self, patterns, window=SEARCH_WINDOW):
+        """Initializer.
+
+        Args:
+          patterns: A list of strings or compiled regular expressions, and
+            optionally pexpect.EOF and pexpect.TIMEOUT.
+          window: An int, the bytes of searched data to search again.
+        """
+        if not isinstance(patterns, (list, tuple)):
+            patterns = [patterns]
+        self.eof_index = -1
+        self.timeout_index = -1
+        self._patterns = []
+        for i, pattern in enumerate(patterns):
+            if pattern is pexpect.EOF:
+                self.eof_index = i
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = i
+            else:
+                self._patterns.append((i, compile_pattern(pattern)))
+        self._window = window
+        self._chunks = []
+        self._length = 0
+        # Bytes of the stream already returned by release().
+        self._released = 0
+        # The end of the searched data; window bytes plus one preceding
+        # byte, so that anchored patterns see what precedes the window.
+        self._tail = ''
+
+    @property
+    def data(self):
+        """Returns all data fed (and not released) so far."""
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks and self._chunks[0] or ''
+
+    def feed(self, data):
+        """Adds data and searches for a match.
+
+        Returns:
+          None if there was no match, else a tuple (index, match, before,
+          after, remainder); the index of the matching pattern, its re match
+          object, the data before and of the match, and the data after it.
+        """
+        searched = self._tail + data
+        offset = self._length - len(self._tail)
+        # Don't search from the byte before the window (if any).
+        position = min(1, offset)
+        self._chunks.append(data)
+        self._length += len(data)
+        best = None
+        for i, pattern in self._patterns:
+            m = pattern.search(searched, position)
+            if m is not None and (best is None or m.start() < best[1].start()):
+                best = (i, m)
+        if best is None:
+            self._tail = searched[-(self._window + 1):]
+            return None
+        i, m = best
+        buf = self.data
+        start = offset + m.start() - self._released
+        end = offset + m.end() - self._released
+        return i, m, buf[:start], buf[start:end], buf[end:]
+
+    def release(self):
+        """Returns and forgets data which no later match can include.
+
+        Data is released up to the end of a line, so that line endings and
+        escape sequences are never split between released pieces.
+
+        Returns:
+          A string, possibly empty.
+        """
+        # Matches may start in the window, and look behind its first byte.
+        limit = self._length - self._released - self._window - 1
+        if limit <= 0:
+            return ''
+        buf = self.data
+        end = buf.rfind('\n', 0, limit) + 1
+        if not end:
+            return ''
+        self._chunks = [buf[end:]]
+        self._released += end
+        return buf[:end]
+
+
 class DeviceTransport(object):
     """Abstract device transport.
 
@@ -43,13 +259,14 @@ class DeviceTransport(object):
       port: An int, the TCP port to connect to. None uses the default port.
       timeouts: A device.Timeouts namedtuple, timeout values to use.
       strip_ansi: A boolean, if True, strip ANSI escape sequences.
+      anchor_prompt: A boolean, if True, the CLI prompt must start a line.
     """
 
     DEFAULT_PORT = None
 
     def __init__(self, address=None, port=None, timeouts=None, strip_ansi=None,
                  dos2unix=False, command_trailer=None, expect_trailer=None,
-                 pager_response=None, **kwargs):
+                 pager_response=None, anchor_prompt=False, **kwargs):
         """Initializer.
 
         Args:
@@ -61,6 +278,9 @@ class DeviceTransport(object):
           expect_trailer: A string or regular expression, what to expect after
             the command returns.
           pager_response: A string, what to send back to the pager.
+          anchor_prompt: A boolean, if True, the CLI prompt must start a line
+            (see compile_pattern). Anchored prompts are not found within
+            command output.
         """
         _ = kwargs
         self.address = address
@@ -72,11 +292,12 @@ class DeviceTransport(object):
         self.command_trailer = command_trailer or '\n'
         self.expect_trailer = expect_trailer or '\r\n'
         self.pager_response = pager_response or ' '
+        self.anchor_prompt = anchor_prompt
 
-    def _strip_ansi(self, data):
-        for reg in STRIP_ANSI:
-            data = reg.sub('', data)
-        return data
+    def normaliser(self, strip_chars=None):
+        """Returns the OutputNormaliser for this transport's settings."""
+        return get_normaliser(strip_ansi=self.strip_ansi,
+                              dos2unix=self.dos2unix, strip_chars=strip_chars)
         
     @property
     def match(self):
@@ -113,28 +334,99 @@ class DeviceTransport(object):
         """Expects one of a list of regular expressions from the device."""
         raise NotImplementedError
 
-    def command(self, command, prompt, timeout=None, expect_trailer=None,
-                command_trailer=None, expect_command=True,
-                pager=None, pager_response=None, strip_chars=None):
-        """Executes a command.
+    def _escape_prompt(self, prompt):
+        if isinstance(prompt, str):
+            return compile_pattern(re.escape(prompt),
+                                   anchor=self.anchor_prompt)
+        else:
+            return prompt
 
-        This returns any data after the CLI command sent, prior to the
-        CLI prompt after the output ceases.
+    def expect_iter(self, re_list, timeout=None):
+        """Expects one of a list of regular expressions, yielding the data.
+
+        This behaves as expect(), but data received before the match may be
+        yielded (as (None, data) tuples) as it arrives. The last tuple
+        yielded is (index, before); the index of the pattern seen and the
+        data before it not already yielded. This implementation yields
+        nothing before the match; transports which can stream override it.
         """
-        expect_trailer = expect_trailer or self.expect_trailer
-        command_trailer = command_trailer or self.command_trailer
-        timeout_long = timeout or self.timeouts.resp_long
-        timeout_short = timeout or self.timeouts.resp_short
-        pager_response = pager_response or self.pager_response
+        i = self.expect(re_list, timeout)
+        yield i, self.before
+
+    def _expect_spawn(self, spawn, re_list, timeout=None):
+        """Expects one of a list of regular expressions from a pexpect spawn.
+
+        This behaves as spawn.expect(), but searches the received data
+        incrementally (see StreamSearcher).
 
-        # Find the prompt and flush the expect buffer.
+        Args:
+          spawn: A pexpect.spawn (or fdpexpect.fdspawn) object.
+          re_list: A list of strings or regular expressions, and optionally
+            pexpect.EOF and pexpect.TIMEOUT.
+          timeout: A float, the maximum seconds to wait, or None to wait
+            indefinitely.
+
+        Returns:
+          An int, the index of the pattern in re_list which was seen first.
+
+        Raises:
+          pexpect.EOF: EOF was seen, but was not in re_list.
+          pexpect.TIMEOUT: The timeout expired, but was not in re_list.
+        """
+        for index, _ in self._expect_spawn_iter(spawn, re_list, timeout,
+                                                release=False):
+            pass
+        return index
+
+    def _expect_spawn_iter(self, spawn, re_list, timeout=None, release=True):
+        """Expects one of a list of regular expressions from a pexpect spawn.
+
+        As _expect_spawn(), but as a generator (see expect_iter()). If
+        release is True, data which cannot be part of the match is yielded
+        as it is received, and is not kept in spawn.before.
+        """
+        searcher = StreamSearcher(re_list)
+        if timeout is not None:
+            end_time = time.time() + timeout
+        try:
+            found = searcher.feed(spawn.buffer)
+            while found is None:
+                if timeout is not None:
+                    timeout = end_time - time.time()
+                    if timeout < 0:
+                        raise pexpect.TIMEOUT('Timeout exceeded in expect.')
+                found = searcher.feed(spawn.read_nonblocking(READ_SIZE,
+                                                             timeout))
+                if release and found is None:
+                    data = searcher.release()
+                    if data:
+                        yield None, data
+        except (pexpect.EOF, pexpect.TIMEOUT), e:
+            if isinstance(e, pexpect.EOF):
+                spawn.buffer = ''
+                spawn.after = pexpect.EOF
+                index = searcher.eof_index
+            else:
+                spawn.buffer = searcher.data
+                spawn.after = pexpect.TIMEOUT
+                index = searcher.timeout_index
+            spawn.before = searcher.data
+            if index < 0:
+                spawn.match = None
+                spawn.match_index = None
+                raise
+            spawn.match = spawn.after
+            spawn.match_index = index
+            yield index, spawn.before
+            return
+        index, spawn.match, spawn.before, spawn.after, spawn.buffer = found
+        spawn.match_index = index
+        yield index, spawn.before
+
+    def _find_prompt(self, command, esc_prompt, command_trailer, timeout):
+        """Finds the prompt, flushing the expect buffer."""
         self.write(command_trailer)
-        if isinstance(prompt, str):
-            esc_prompt = re.escape(prompt)
-        else:
-            esc_prompt = prompt
-        i = self.expect([esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                        timeout_short)
+        i = self.expect([esc_prompt, pexpect.EOF, pexpect.TIMEOUT], timeout)
         if i == 1:
             exc = notch.agent.errors.CommandError(
                 'EOF received during command %r' % command)
@@ -144,70 +436,63 @@ class DeviceTransport(object):
             raise notch.agent.errors.CommandError('CLI prompt not found prior '
                                                   'to sending command.')
 
-        # Send the command.
-        self.write(command + command_trailer)
-
-        # Expect the command to be echoed back first, perhaps. If the
-        # device echoes back the 'full' command for an abbreviated
+    def _expect_echo(self, command, expect_command, expect_trailer, timeout):
+        """Expects the command (or just a trailer) to be echoed back."""
+        # If the device echoes back the 'full' command for an abbreviated
         # command input (um, thanks), allow for that, also.
         if expect_command:
             i = self.expect(
                 [re.escape(command) + expect_trailer, pexpect.EOF,
-                 pexpect.TIMEOUT], timeout_short)
+                 pexpect.TIMEOUT], timeout)
         else:
             trailer = expect_trailer or os.linesep
             i = self.expect([trailer, pexpect.EOF, pexpect.TIMEOUT],
-                            timeout_short)
+                            timeout)
         if i > 0:
             exc = notch.agent.errors.CommandError(
                 'Device did not start response within short response timeout.')
             exc.retry = True
             raise exc
 
-        # Wait for the remaining data, possibly handling pager responses
+    def _read_response(self, command, prompt, esc_prompt, timeout, pager,
+                       pager_response, strip_chars):
+        """Returns the command response, up to the next prompt."""
+        return ''.join(self._iter_response(command, prompt, esc_prompt,
+                                           timeout, pager, pager_response,
+                                           strip_chars))
 
-        response_buf = []
+    def _iter_response(self, command, prompt, esc_prompt, timeout, pager,
+                       pager_response, strip_chars):
+        """Yields the command response in pieces, up to the next prompt."""
+        # Wait for the remaining data, possibly handling pager responses
+        normalise = self.normaliser(strip_chars)
+        if pager:
+            re_list = [pager, esc_prompt, pexpect.EOF, pexpect.TIMEOUT]
+        else:
+            re_list = [esc_prompt, pexpect.EOF, pexpect.TIMEOUT]
         while True:
-            if pager:
-                i = self.expect([pager,
-                                 esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                                timeout_long)
-            else:
-                i = self.expect([esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                                timeout_long)
+            for i, data in self.expect_iter(re_list, timeout):
+                if i is None:
+                    yield normalise(data)
+            if not pager:
                 i += 1
 
-            data = self.before
-            # Strip characters
-            if strip_chars and data is not None:
-                for strip_char in strip_chars:
-                    data = data.replace(strip_char, '')
-            if self.dos2unix:
-                # Some platforms are retarded, and thus we need to do
-                # this twice (which is safe, if slow).
-                if data is not None:
-                    data = data.replace('\r\n', '\n')
-                    data = data.replace('\r\n', '\n')
             if not i:
                 # Saw the pager prompt.
-                if data is not None:
-                    if self.strip_ansi:
-                        response_buf.append(self._strip_ansi(data))
-                    else:
-                        response_buf.append(data)
+                if data:
+                    yield normalise(data)
                 self.write(pager_response)
             elif i == 1:
                 # Saw the command prompt, indicating we're done.
                 # Clean up the output to include only the part between the first
                 # character after the newline after the command requested until
                 # the last character prior to the next CLI prompt.
-                if data is not None:
+                if data:
                     prompt_index = data.rfind(prompt)
-                    if prompt_index == -1:
-                        response_buf.append(data)
-                    else:
-                        response_buf.append(data[:prompt_index])
-                return ''.join(response_buf)
+                    if prompt_index != -1:
+                        data = data[:prompt_index]
+                    yield normalise(data)
+                return
             elif i == 2:
                 exc = notch.agent.errors.CommandError(
                     'EOF received during command %r' % command)
@@ -218,4 +503,93 @@ class DeviceTransport(object):
                 # indicate overloaded devices.
                 raise notch.agent.errors.CommandError(
                     'Command executed, CLI prompt not seen after %.1f sec' %
-                    timeout_long)
+                    timeout)
+
+    def command(self, command, prompt, timeout=None, expect_trailer=None,
+                command_trailer=None, expect_command=True,
+                pager=None, pager_response=None, strip_chars=None):
+        """Executes a command.
+
+        This returns any data after the CLI command sent, prior to the
+        CLI prompt after the output ceases.
+        """
+        return ''.join(self.command_iter(
+            command, prompt, timeout=timeout, expect_trailer=expect_trailer,
+            command_trailer=command_trailer, expect_command=expect_command,
+            pager=pager, pager_response=pager_response,
+            strip_chars=strip_chars))
+
+    def command_iter(self, command, prompt, timeout=None, expect_trailer=None,
+                     command_trailer=None, expect_command=True,
+                     pager=None, pager_response=None, strip_chars=None):
+        """Executes a command, yielding the response in pieces.
+
+        As command(), but the (normalised) response is yielded as it is
+        received, so that it is never held whole. Pieces end at line
+        endings, except at a pager prompt and the end of the response.
+        """
+        expect_trailer = expect_trailer or self.expect_trailer
+        command_trailer = command_trailer or self.command_trailer
+        timeout_long = timeout or self.timeouts.resp_long
+        timeout_short = timeout or self.timeouts.resp_short
+        pager_response = pager_response or self.pager_response
+
+        esc_prompt = self._escape_prompt(prompt)
+        self._find_prompt(command, esc_prompt, command_trailer, timeout_short)
+        # Send the command.
+        self.write(command + command_trailer)
+        # Expect the command to be echoed back first, perhaps.
+        self._expect_echo(command, expect_command, expect_trailer,
+                          timeout_short)
+        for data in self._iter_response(command, prompt, esc_prompt,
+                                        timeout_long, pager, pager_response,
+                                        strip_chars):
+            if data:
+                yield data
+
+    def commands(self, commands, prompt, timeout=None, expect_trailer=None,
+                 command_trailer=None, expect_command=True, strip_chars=None):
+        """Executes several commands, pipelined.
+
+        All commands are written to the device at once (after the prompt is
+        first found), then the returned stream is split on successive
+        prompts. This saves all but one round trip per command, but is only
+        safe for devices which buffer input typed ahead of their prompt and
+        which have their pager disabled.
+
+        Args:
+          commands: A list of strings, the commands to execute in order.
+          prompt: A string or regular expression, the CLI prompt.
+          Other arguments are as for command().
+
+        Returns:
+          A list of strings, the response to each command.
+
+        Raises:
+          notch.agent.errors.CommandError: A command failed. Its 'responses'
+            attribute holds the list of responses to the preceding commands.
+        """
+        expect_trailer = expect_trailer or self.expect_trailer
+        command_trailer = command_trailer or self.command_trailer
+        timeout_long = timeout or self.timeouts.resp_long
+        timeout_short = timeout or self.timeouts.resp_short
+
+        responses = []
+        if not commands:
+            return responses
+        esc_prompt = self._escape_prompt(prompt)
+        self._find_prompt(commands[0], esc_prompt, command_trailer,
+                          timeout_short)
+        self.write(''.join(c + command_trailer for c in commands))
+        for command in commands:
+            try:
+                self._expect_echo(command, expect_command, expect_trailer,
+                                  timeout_short)
+                responses.append(
+                    self._read_response(command, prompt, esc_prompt,
+                                        timeout_long, None, None,
+                                        strip_chars))
+            except notch.agent.errors.CommandError, e:
+                e.responses = responses
+                raise
+        return responses
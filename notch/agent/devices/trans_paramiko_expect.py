@@ -153,7 +153,12 @@ class ParamikoExpectTransport(trans.DeviceTransport):
     def expect(self, re_list, timeout=None):
         if timeout is None and self.timeouts:
             timeout = self.timeouts.resp_long
-        return self._c.expect(re_list, timeout=timeout)
+        return self._expect_spawn(self._c, re_list, timeout=timeout)
+
+    def expect_iter(self, re_list, timeout=None):
+        if timeout is None and self.timeouts:
+            timeout = self.timeouts.resp_long
+        return self._expect_spawn_iter(self._c, re_list, timeout=timeout)
 
     def download_and_return_file(self, source):
         try:
@@ -105,4 +105,8 @@ class TelnetDeviceTransport(trans.DeviceTransport):
 
     def expect(self, re_list, timeout=None):
         timeout = timeout or self.timeouts.resp_long
-        return self._expect.expect(re_list, timeout=timeout)
+        return self._expect_spawn(self._expect, re_list, timeout=timeout)
+
+    def expect_iter(self, re_list, timeout=None):
+        timeout = timeout or self.timeouts.resp_long
+        return self._expect_spawn_iter(self._expect, re_list, timeout=timeout)
@@ -70,6 +70,10 @@ class ConnectError(ApiError):
     dampen_reconnect = True
 
 
+class SessionLimitError(ConnectError):
+    """The device refused the connection as its session limit was reached."""
+
+
 class CommandError(ApiError):
     """There was an error whilst executing a command on a device."""
     disconnect_on_error = True
@@ -87,6 +91,10 @@ class DisconnectError(ApiError):
     """There was an error disconnecting from a device."""
 
 
+class EncodingError(ApiError):
+    """The response could not be returned in the requested encoding."""
+
+
 class EnableError(ApiError):
     """There was an error attempting to receive enable authorization."""
 
@@ -132,6 +140,18 @@ class UploadError(ApiError):
     """There was an error whilst uploading a file from the device."""
 
 
+class SessionQueueFullError(ApiError):
+    """Too many requests are already waiting for the device session."""
+
+
+class SessionQueueTimeoutError(ApiError):
+    """The request timed out waiting for the device session."""
+
+
+class OverloadedError(ApiError):
+    """The agent is overloaded; retry the request later or elsewhere."""
+
+
 def rpc_error_handler(exc, rpc):
     """Handles an RPC error.
 
@@ -140,7 +160,11 @@ def rpc_error_handler(exc, rpc):
       rpc: A tornadorpc RPCParser instance (JSONRPCParser or XMLRPCParser).
     """
     if hasattr(rpc, 'faults'):
-        err = getattr(rpc.faults, exc.__class__.__name__, None)
+        try:
+            err = getattr(rpc.faults, exc.__class__.__name__, None)
+        except KeyError:
+            # Not one of our errors (see error_dictionary).
+            err = None
         if err is not None:
             return err(str(exc))
         else:
@@ -170,6 +194,11 @@ error_dictionary = {
     'UploadError': 14,
     'NoSuchDeviceError': 15,
     'EnableError': 16,
+    'SessionQueueFullError': 17,
+    'SessionQueueTimeoutError': 18,
+    'SessionLimitError': 19,
+    'EncodingError': 20,
+    'OverloadedError': 21,
 }
 
 reverse_error_dictionary = dict((v, k) for (k, v) in error_dictionary.items())
@@ -20,9 +20,14 @@ These handlers implement the server-side API using session and device
 objects, using the Tornado request handler framework.
 """
 
+import collections
+import functools
+import json
 import logging
 import traceback
 
+import eventlet.event
+
 import jsonrpclib
 # Disable automatic class translation.
 jsonrpclib.config.use_jsonclass = False
@@ -33,6 +38,7 @@ import tornado.web
 import tornadorpc.json
 import tornadorpc.base
 
+import notch.agent.admission
 import notch.agent.errors
 
 
@@ -44,14 +50,341 @@ class HomeHandler(BaseHandler):
     """Handles the root page."""
 
 
+class StreamHandler(BaseHandler):
+    """Streams the response to a command or get_config request.
+
+    The method is named in the URL, and its arguments are given as query
+    arguments (e.g., /stream/command?device_name=rtr1&command=show+version).
+    The response body is the unencoded response, sent (with chunked transfer
+    encoding) as it is read from the device. A piece is written to the client
+    only once the previous piece has been sent, so the agent holds at most
+    two pieces of the response at a time however large it is.
+
+    Fan-out methods (e.g., /stream/command_matching?regexp=^br.*&command=...
+    &concurrency=20) run the request on each device matching the regexp
+    (see controller.Controller.request_matching). Their response is
+    newline-delimited JSON, one object per device, sent as each device
+    completes. With dedupe=true, each distinct response is sent once.
+
+    Errors before the response begins are returned with an HTTP error status
+    and a body of the error name and message. Later errors close the
+    connection without ending the response, so that clients see it as
+    incomplete.
+
+    Requires the Tornado HTTP server (WSGI servers cannot stream).
+    """
+
+    # HTTP status codes for errors before the response begins. Other API
+    # errors (from the device) are 502, and unexpected errors are 500.
+    ERROR_STATUS = (
+        (notch.agent.errors.InvalidRequestError, 400),
+        (notch.agent.errors.NoSuchDeviceError, 404),
+        (notch.agent.errors.SessionQueueFullError, 503),
+        (notch.agent.errors.SessionQueueTimeoutError, 503),
+        (notch.agent.errors.OverloadedError, 503),
+        (notch.agent.errors.ApiError, 502),
+        )
+    # Fan-out methods, and the device API method each requests.
+    MATCHING_METHODS = {'command_matching': 'command'}
+    # Query arguments taken as booleans ('1', 'true' or 'yes' are true).
+    BOOLEAN_ARGUMENTS = ('dedupe', 'normalise_hostname')
+
+    @tornado.web.asynchronous
+    def get(self, method):
+        self.controller = self.settings['controller']
+        self._io_loop = tornado.ioloop.IOLoop.instance()
+        self._client_closed = False
+        # Whether the last piece is still being sent, and the call to make
+        # once it has been.
+        self._flushing = False
+        self._after_flush = None
+        kwargs = dict((str(name), values[-1]) for name, values
+                      in self.request.arguments.iteritems())
+        for name in self.BOOLEAN_ARGUMENTS:
+            if name in kwargs:
+                kwargs[name] = kwargs[name].lower() in ('1', 'true', 'yes')
+        try:
+            ticket = self.controller.admission.admit(kwargs.get('device_name'))
+        except notch.agent.errors.ApiError, e:
+            self._send_error(eventlet.event.Event(), e)
+            return
+        if method in self.MATCHING_METHODS:
+            self.set_header('Content-Type', 'application/x-ndjson')
+        else:
+            self.set_header('Content-Type', 'application/octet-stream')
+        self.settings['workers'].submit(self._stream, method, kwargs, ticket)
+
+    def on_connection_close(self):
+        self._client_closed = True
+        # The last piece will never be sent; release the worker waiting.
+        self._on_flush()
+
+    def _stream(self, method, kwargs, ticket):
+        """Streams the response (in a worker thread)."""
+        try:
+            self._stream_response(method, kwargs, ticket)
+        finally:
+            ticket.done()
+
+    def _stream_response(self, method, kwargs, ticket):
+        try:
+            if method in self.MATCHING_METHODS:
+                ticket.start()
+                pieces = _json_lines(self.controller.request_matching(
+                    self.MATCHING_METHODS[method], **kwargs))
+            else:
+                notch.agent.admission.bind(ticket)
+                try:
+                    pieces = self.controller.request_iter(method, **kwargs)
+                finally:
+                    notch.agent.admission.bind(None)
+        except Exception, e:
+            self._on_loop(self._send_error, e)
+            return
+        sent = False
+        try:
+            try:
+                for piece in pieces:
+                    if not self._on_loop(self._send_piece, piece):
+                        logging.debug('Client closed %s stream.', method)
+                        return
+                    sent = True
+            except Exception, e:
+                if sent:
+                    logging.error('%s stream failed. %s: %s', method,
+                                  e.__class__.__name__, str(e))
+                    self._on_loop(self._abort)
+                else:
+                    self._on_loop(self._send_error, e)
+            else:
+                self._on_loop(self._finish)
+        finally:
+            pieces.close()
+
+    def _on_loop(self, method, *args):
+        """Calls method(done, *args) in the IOLoop, returning its result.
+
+        The method sends its result to the event done. Exceptions it raises
+        are logged, and the result is then False.
+        """
+        done = eventlet.event.Event()
+
+        def callback():
+            try:
+                method(done, *args)
+            except Exception, e:
+                logging.error('%s: %s', e.__class__.__name__, str(e),
+                              exc_info=True)
+                if not done.ready():
+                    done.send(False)
+
+        self._io_loop.add_callback(callback)
+        return done.wait()
+
+    def _send_error(self, done, exc):
+        for error, status in self.ERROR_STATUS:
+            if isinstance(exc, error):
+                break
+        else:
+            logging.error('%s: %s', str(exc.__class__), str(exc))
+            status = 500
+        self.set_status(status)
+        self.set_header('Content-Type', 'text/plain')
+        self.finish('%s: %s\n' % (getattr(exc, 'name',
+                                          exc.__class__.__name__), exc))
+        done.send(True)
+
+    def _send_piece(self, done, piece):
+        stream = self.request.connection.stream
+        if self._client_closed or stream.closed():
+            done.send(False)
+        elif self._flushing:
+            # Wait for the previous piece to be sent.
+            self._after_flush = functools.partial(self._send_piece, done,
+                                                  piece)
+        else:
+            self.write(piece)
+            self._flushing = True
+            self.flush(callback=self._on_flush)
+            done.send(True)
+
+    def _on_flush(self):
+        """Makes the call waiting for the last piece to be sent, if any."""
+        self._flushing = False
+        after_flush, self._after_flush = self._after_flush, None
+        if after_flush is not None:
+            after_flush()
+
+    def _finish(self, done):
+        if not self._client_closed:
+            self.finish()
+        done.send(True)
+
+    def _abort(self, done):
+        stream = self.request.connection.stream
+        if self._flushing and not stream.closed():
+            # Send what was read before the error, first.
+            self._after_flush = functools.partial(self._abort, done)
+            return
+        stream.close()
+        done.send(True)
+
+
+def _json_lines(results):
+    """Yields each result as a line of JSON, closing results when done."""
+    try:
+        for result in results:
+            yield json.dumps(result) + '\n'
+    finally:
+        results.close()
+
+
+class BatchQueue(object):
+    """Runs the device requests of one JSON-RPC request in a worker pool.
+
+    Requests to one device run one at a time, in the order submitted, so
+    that a batch may rely on their ordering (e.g., set_config followed by
+    get_config). Requests to different devices run concurrently, at most
+    max_concurrency at once. The remainder wait here rather than in the
+    worker pool, so that one large batch cannot occupy every worker.
+
+    Not thread-safe; used only from the IOLoop.
+
+    Attributes:
+      max_concurrency: An int, the maximum number of requests running.
+    """
+
+    def __init__(self, workers, max_concurrency, io_loop=None):
+        """Initializer.
+
+        Args:
+          workers: A tp.ThreadPool, executing the requests.
+          max_concurrency: An int, the maximum number of requests running.
+          io_loop: A tornado.ioloop.IOLoop, in which results are delivered.
+            Defaults to the IOLoop instance.
+        """
+        self._workers = workers
+        self.max_concurrency = max(1, max_concurrency)
+        self._io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        # Deques of (task, callback, dispatched) tuples, keyed by device
+        # name. The first tuple of a lane may be running.
+        self._lanes = {}
+        # Lanes with requests waiting and none running, in arrival order.
+        self._ready = collections.deque()
+        self._running = 0
+
+    def submit(self, lane, task, callback, dispatched=None):
+        """Queues a request.
+
+        Args:
+          lane: A hashable, the request's device name. Requests with the
+            same lane run in order.
+          task: A callable, executed in a worker thread.
+          callback: A callable, called in the IOLoop with task's result.
+          dispatched: An optional callable, called when the task leaves its
+            lane for the worker pool.
+        """
+        if lane in self._lanes:
+            self._lanes[lane].append((task, callback, dispatched))
+        else:
+            self._lanes[lane] = collections.deque(
+                [(task, callback, dispatched)])
+            self._ready.append(lane)
+        self._start()
+
+    @property
+    def running(self):
+        """The number of requests now running."""
+        return self._running
+
+    def _start(self):
+        while self._ready and self._running < self.max_concurrency:
+            lane = self._ready.popleft()
+            task, _, dispatched = self._lanes[lane][0]
+            if dispatched is not None:
+                dispatched()
+            self._running += 1
+            future = self._workers.submit(task)
+            future.add_done_callback(functools.partial(self._on_done, lane))
+
+    def _on_done(self, lane, future):
+        """Hands a finished request back to the IOLoop (in a worker)."""
+        self._io_loop.add_callback(functools.partial(self._done, lane, future))
+
+    def _done(self, lane, future):
+        _, callback, _ = self._lanes[lane].popleft()
+        self._running -= 1
+        if self._lanes[lane]:
+            self._ready.append(lane)
+        else:
+            del self._lanes[lane]
+        self._start()
+        callback(future.result())
+
+
+class JSONRPCParser(tornadorpc.json.JSONRPCParser):
+    """A JSON-RPC parser returning batch responses in request order.
+
+    tornadorpc returns results in the order they complete. This parser
+    records the position of the call being dispatched, and handlers store
+    each result at the position of its call.
+
+    Attributes:
+      position: An int, the index of the call last dispatched (in the batch,
+        or zero for a single call).
+    """
+    position = -1
+
+    def parse_request(self, request_body):
+        requests = super(JSONRPCParser, self).parse_request(request_body)
+        if isinstance(requests, tuple):
+            self.handler._results = [None] * len(requests)
+        return requests
+
+    def dispatch(self, method_name, params):
+        self.position += 1
+        return super(JSONRPCParser, self).dispatch(method_name, params)
+
+
 class SynchronousJSONRPCHandler(tornadorpc.json.JSONRPCHandler):
+    """A JSON-RPC handler, accepting JSON-RPC 2.0 batch requests.
+
+    The calls of a batch are dispatched together. Device requests among
+    them run concurrently in the application's worker pool (see
+    BatchQueue), and the responses are returned as one array, in the
+    order of the calls.
+    """
     _RPC = tornadorpc.json.JSONRPCParser(jsonrpclib)
 
     def post(self):
         self._RPC.faults.codes.update(notch.agent.errors.error_dictionary)
         self.controller = self.settings['controller']
+        # The parser holds the request being handled, and requests may now
+        # be handled concurrently, so each needs its own.
+        self._RPC_ = JSONRPCParser(tornadorpc.json.JSONRPCLibraryWrapper)
+        workers = self.settings.get('workers')
+        if workers is None:
+            self._batch_queue = None
+        else:
+            self._batch_queue = BatchQueue(
+                workers, self.controller.rpc_batch_concurrency)
         super(SynchronousJSONRPCHandler, self).post()
 
+    def result(self, result, *results):
+        """Returns the result of the call being dispatched."""
+        self._result_at(self._RPC_.position, result, *results)
+
+    def _result_at(self, position, result, *results):
+        """Returns the result of the call at position in the request."""
+        if results:
+            result = [result] + list(results)
+        if 0 <= position < len(self._results):
+            self._results[position] = result
+        else:
+            # A fault for the whole request (e.g., a parse error).
+            self._results.append(result)
+        self._RPC_.response(self)
+
 
 #pylint: disable-msg=E1101
 class NotchAPI(object):
@@ -64,6 +397,56 @@ class NotchAPI(object):
             logging.debug(traceback.format_exc())
         return notch.agent.errors.rpc_error_handler(exc, self._RPC)
 
+    def _call_controller(self, method, *args, **kwargs):
+        """Executes a controller method, returning its result to the client.
+
+        The method runs in the application's worker pool (the 'workers'
+        setting) if it has one, so that the IOLoop carries on serving other
+        requests meanwhile; its result is then returned from the IOLoop.
+        Methods for one device run in the order called (see BatchQueue).
+        Without a worker pool (e.g., under WSGI), it runs here.
+
+        The request is refused at once, or shed when it leaves the queue, if
+        the agent is overloaded (see admission.AdmissionControl). Its
+        queueing delay excludes any wait behind earlier calls to its device
+        in the batch, and ends when it acquires the device's session (or,
+        for requests without a device, when a worker takes it).
+
+        Args:
+          method: A callable, the controller method.
+          args: Non-keyword arguments for the method.
+          kwargs: Keyword arguments for the method.
+        """
+        position = self._RPC_.position
+        device_name = kwargs.get('device_name')
+        try:
+            ticket = self.controller.admission.admit(device_name)
+        except notch.agent.errors.ApiError, e:
+            self._result_at(position, self.handle_exception(e))
+            return
+
+        def work():
+            try:
+                try:
+                    if device_name is None:
+                        ticket.start()
+                    else:
+                        notch.agent.admission.bind(ticket)
+                    return method(*args, **kwargs)
+                except Exception, e:
+                    return self.handle_exception(e)
+            finally:
+                notch.agent.admission.bind(None)
+                ticket.done()
+
+        if self._batch_queue is None:
+            self._result_at(position, work())
+        else:
+            self._batch_queue.submit(
+                device_name, work,
+                functools.partial(self._result_at, position),
+                dispatched=ticket.restart)
+
     def devices_matching(self, **kwargs):
         try:
             if not kwargs:
@@ -97,64 +480,130 @@ class NotchAPI(object):
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
-    def command(self, **kwargs):
+    def cache_stats(self, **kwargs):
         try:
-            return self.controller.request('command', **kwargs)
+            return self.controller.cache_stats()
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
-    def get_config(self, **kwargs):
+    def circuit_stats(self, **kwargs):
         try:
-            return self.controller.request('get_config', **kwargs)
+            return self.controller.circuit_stats()
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
-    def set_config(self, **kwargs):
+    def connect_stats(self, **kwargs):
         try:
-            return self.controller.request('set_config', **kwargs)
+            return self.controller.connect_stats()
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
-    def copy_file(self, **kwargs):
+    def session_stats(self, **kwargs):
         try:
-            return self.controller.request('copy_file', **kwargs)
+            return self.controller.session_stats()
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
-    def upload_file(self, **kwargs):
+    def admission_stats(self, **kwargs):
+        return self.controller.admission.stats()
+
+    def worker_stats(self, **kwargs):
+        workers = self.settings.get('workers')
+        if workers is None:
+            return {}
+        return workers.stats()
+
+    @tornadorpc.base.async
+    def command(self, **kwargs):
+        self._call_controller(self.controller.request, 'command', **kwargs)
+
+    @tornadorpc.base.async
+    def commands(self, **kwargs):
+        """Executes a list of commands on one device, in order.
+
+        Takes the 'command' method's arguments, but with 'commands' (a list
+        of strings) in place of 'command'. The optional 'stop_on_error'
+        argument (default: True) stops execution after a failed command.
+        """
         try:
-            return self.controller.request('upload_file', **kwargs)
+            commands = kwargs.pop('commands', None)
+            if not isinstance(commands, (list, tuple)):
+                raise notch.agent.errors.InvalidRequestError(
+                    'commands argument must be a list, not %r' % commands)
+            mode = kwargs.pop('mode', None)
+            arguments = []
+            for command in commands:
+                if mode is None:
+                    arguments.append({'command': command})
+                else:
+                    arguments.append({'command': command, 'mode': mode})
         except notch.agent.errors.ApiError, e:
-            return self.handle_exception(e)
+            self.result(self.handle_exception(e))
+            return
+        self._call_controller(self.controller.request_batch, 'command',
+                              arguments, **kwargs)
+
+    @tornadorpc.base.async
+    def command_matching(self, **kwargs):
+        """Executes a command on each device matching a regexp.
+
+        Takes the 'command' method's arguments, but with 'regexp' in place
+        of 'device_name', and the optional 'concurrency' (the maximum number
+        of devices to request at once). The optional 'dedupe' and
+        'normalise_hostname' arguments send each distinct response once.
+        Returns a list of per-device results; see
+        controller.Controller.request_matching. The standalone
+        server also streams the results as each device completes (see
+        StreamHandler).
+        """
+        self._call_controller(self._request_matching, 'command', **kwargs)
+
+    def _request_matching(self, method, **kwargs):
+        return list(self.controller.request_matching(method, **kwargs))
+
+    @tornadorpc.base.async
+    def get_config(self, **kwargs):
+        self._call_controller(self.controller.request, 'get_config', **kwargs)
 
+    @tornadorpc.base.async
+    def set_config(self, **kwargs):
+        self._call_controller(self.controller.request, 'set_config', **kwargs)
+
+    @tornadorpc.base.async
+    def copy_file(self, **kwargs):
+        self._call_controller(self.controller.request, 'copy_file', **kwargs)
+
+    @tornadorpc.base.async
+    def upload_file(self, **kwargs):
+        self._call_controller(self.controller.request, 'upload_file', **kwargs)
+
+    @tornadorpc.base.async
     def download_file(self, **kwargs):
-        try:
-            return self.controller.request('download_file', **kwargs)
-        except notch.agent.errors.ApiError, e:
-            return self.handle_exception(e)
+        self._call_controller(self.controller.request, 'download_file',
+                              **kwargs)
 
+    @tornadorpc.base.async
     def delete_file(self, **kwargs):
-        try:
-            return self.controller.request('delete_file', **kwargs)
-        except notch.agent.errors.ApiError, e:
-            return self.handle_exception(e)
+        self._call_controller(self.controller.request, 'delete_file', **kwargs)
 
+    @tornadorpc.base.async
     def lock(self, **kwargs):
-        try:
-            return self.controller.request('lock', **kwargs)
-        except notch.agent.errors.ApiError, e:
-            return self.handle_exception(e)
+        self._call_controller(self.controller.request, 'lock', **kwargs)
 
+    @tornadorpc.base.async
     def unlock(self, **kwargs):
-        try:
-            return self.controller.request('unlock', **kwargs)
-        except notch.agent.errors.ApiError, e:
-            return self.handle_exception(e)
+        self._call_controller(self.controller.request, 'unlock', **kwargs)
 #pylint: enable-msg=E1101
 
 
 class NotchSyncJsonRpcHandler(NotchAPI, SynchronousJSONRPCHandler):
-    """The Notch API as presented to JSON-RPC asynchronously, for WSGI."""
+    """The Notch API as presented to JSON-RPC.
+
+    Inventory and statistics queries are answered at once. Device requests
+    run in the application's worker pool, if it has one (see
+    NotchAPI._call_controller). Batch requests are accepted (see
+    SynchronousJSONRPCHandler).
+    """
 
 
 class StopHandler(tornado.web.RequestHandler):
@@ -18,12 +18,23 @@
 
 import copy
 import heapq
+import sys
 import time
 import UserDict
 
 import eventlet
 
 
+# Number of least-recently used items considered for eviction when the
+# cache has an eviction cost callback.
+DEFAULT_EVICTION_SAMPLE_SIZE = 8
+
+# Causes of item expiry, as counted in LruDict.stats().
+EXPIRED_SIZE = 'size'
+EXPIRED_AGE = 'age'
+EXPIRED_EXPLICIT = 'explicit'
+
+
 class Error(Exception):
     pass
 
@@ -37,53 +48,221 @@ class DontExpireError(Error):
 
 
 # pylint:disable-msg=R0903
-class HeapItem(object):
-    """A cached key kept on the heap queue from the data dictionary."""
-    def __init__(self, key):
-        self.time = time.time()
-        self.key = key
+class Node(object):
+    """A cached key's entry in the recency-ordered doubly-linked list.
 
-    def __lt__(self, other):
-        if self.time < other.time:
-            return True
-        else:
-            return False
+    Attributes:
+      key: The cache key.
+      deadline: A float, the time after which the entry has aged out, or
+        None if the entry does not age.
+      weight: A number, the entry's weight (see LruDict.weight_callback).
+    """
+    __slots__ = ('prev', 'next', 'key', 'deadline', 'weight')
+
+    def __init__(self, key=None):
+        self.prev = self.next = self
+        self.key = key
+        self.deadline = None
+        self.weight = 0
 
 
 class LruDict(UserDict.IterableUserDict):
     """A least-recently used cache style dictionary.
 
-    This dictionary is not thread-safe, though it should not explode.
-    Particularly, boundaries (such as maximum_size) may not be respected.
+    Keys are kept on a circular doubly-linked list in recency order, so
+    cache hits, insertions and expiry are all O(1). The least-recently
+    used key is expired first when the cache is full.
+
+    Entries older than maximum_age are expired by a single reaper
+    greenthread per cache, which sleeps until the earliest deadline, and
+    are also expired upon access should the reaper not yet have run.
+
+    Concurrent misses for the same key from multiple greenthreads are
+    populated once: the first greenthread calls populate_callback whilst
+    the others wait for, and receive, the same value or exception. This
+    dictionary is safe for use by greenthreads, but not by OS threads.
+
+    Hit, miss, population and expiry counters are kept for each cache, see
+    the stats() method.
+
+    If an eviction_cost_callback is given, the cache evicts the cheapest
+    of the eviction_sample_size least-recently used items when full,
+    rather than always evicting the least-recently used item.
+
+    If a weight_callback and maximum_weight are given, the cache is also
+    full when the total weight of its items would exceed maximum_weight
+    (e.g., to bound the bytes held, rather than the number of items).
 
     Attributes:
       populate_callback: A callable, the method to call (with the item key)
         to populate the dictionary value for that key.
       expire_callback: Optional callable, the method to call (with key
         and value arguments) when
-      maximum_size: An int, the maximum cache size. Not reliable in a multi-
-        threaded environment (the respected maximum size may be up to
-        num_threads higher).
+      maximum_size: An int, the maximum cache size. This is only exceeded
+        when expire_callback refuses to expire items (see DontExpireError).
       maximum_age: A float, the cache entry lifetime. Setting this to 0 or None
         disables automatic aging for all new items entering the cache.
+      eviction_cost_callback: Optional callable, the method to call (with
+        key and value arguments) returning a float, the cost of evicting
+        the item. Items costing float('inf') are not evicted.
+      eviction_sample_size: An int, the number of least-recently used
+        items compared when an eviction_cost_callback is set.
+      weight_callback: Optional callable, the method to call (with key and
+        value arguments) returning the weight of the item.
+      maximum_weight: A number, the maximum total weight of the items, or
+        None for no limit. An item heavier than this is still cached, once
+        all others are expired.
+      weight: A number, the total weight of the items. Read-only.
     """
 
     def __init__(self, populate_callback=None, expire_callback=None,
-                 maximum_size=1024, maximum_age=None, dict=None):
+                 maximum_size=1024, maximum_age=None, dict=None,
+                 eviction_cost_callback=None,
+                 eviction_sample_size=DEFAULT_EVICTION_SAMPLE_SIZE,
+                 weight_callback=None, maximum_weight=None):
+        # The list sentinel; root.next is the LRU, root.prev the MRU key.
+        self._root = Node()
+        self._nodes = {}
+        self.data = {}
         UserDict.IterableUserDict.__init__(self, dict=dict)
         self._expire_callback = expire_callback
         self.maximum_size = maximum_size
         self.maximum_age = maximum_age
         self._populate_callback = populate_callback
-        self._heap = []
-        self.data = {}
-        self._cleanup_gts = set()
+        self._eviction_cost_callback = eviction_cost_callback
+        self.eviction_sample_size = eviction_sample_size
+        self._weight_callback = weight_callback
+        self.maximum_weight = maximum_weight
+        self.weight = 0
+        # A heap of (deadline, key) tuples. Entries whose deadline no longer
+        # matches their node's are stale and are discarded by the reaper.
+        self._deadlines = []
+        self._reaper = None
+        self._reaper_deadline = None
+        # eventlet.event.Event objects (or None, with no waiters) for keys
+        # being populated, the keys whose expire_callback is running and an
+        # event sent when one of those callbacks ends.
+        self._populating = {}
+        self._expiring = set()
+        self._expired = eventlet.event.Event()
+        self.reset_stats()
         self._initialise()
 
     def _initialise(self):
-        self._heap[:] = []
+        self._root.prev = self._root.next = self._root
+        self._nodes.clear()
         self.data.clear()
-            
+        self.weight = 0
+        self._deadlines[:] = []
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    def _link_mru(self, node):
+        """Links a node in at the most-recently used end of the list."""
+        root = self._root
+        last = root.prev
+        node.prev = last
+        node.next = root
+        last.next = root.prev = node
+
+    def _unlink(self, node):
+        """Unlinks a node from the list."""
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = node.next = node
+
+    def _touch(self, key):
+        """Moves the key to the most-recently used end of the list."""
+        node = self._nodes.get(key)
+        if (node is not None and node is not self._root.prev and
+            key not in self._expiring):
+            self._unlink(node)
+            self._link_mru(node)
+
+    def _set_deadline(self, node):
+        """Starts a new lifetime for the node, if items age in this cache."""
+        if not self.maximum_age:
+            node.deadline = None
+            return
+        node.deadline = time.time() + self.maximum_age
+        heapq.heappush(self._deadlines, (node.deadline, node.key))
+        self._schedule_reaper(node.deadline)
+
+    def _schedule_reaper(self, deadline):
+        """Ensures the reaper will run no later than the deadline."""
+        if self._reaper is not None:
+            if self._reaper_deadline <= deadline:
+                return
+            self._reaper.cancel()
+        self._reaper_deadline = deadline
+        self._reaper = eventlet.spawn_after(max(0, deadline - time.time()),
+                                            self._reap)
+
+    def _reap(self):
+        """Expires all items past their deadline; executed by the reaper."""
+        self._reaper = None
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self._deadlines)
+            node = self._nodes.get(key)
+            if node is not None and node.deadline == deadline:
+                self._expire_aged(key)
+        if self._deadlines:
+            self._schedule_reaper(self._deadlines[0][0])
+
+    def _expire_aged(self, key):
+        """Expires an aged item, or starts a new lifetime if it stays."""
+        self._expire_item(key, EXPIRED_AGE)
+        node = self._nodes.get(key)
+        if node is not None:
+            self._set_deadline(node)
+
+    def _check_age(self, key):
+        """Expires the key now if it is past its deadline."""
+        node = self._nodes.get(key)
+        if (node is not None and node.deadline is not None and
+            node.deadline <= time.time()):
+            self._expire_aged(key)
+
+    def reset_stats(self):
+        """Resets the cache statistics counters."""
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'get_misses': 0,
+                       'populations': 0,
+                       'population_errors': 0,
+                       'population_time': 0.0,
+                       'population_time_max': 0.0,
+                       'expiry_refused': 0,
+                       'expired': {EXPIRED_SIZE: 0,
+                                   EXPIRED_AGE: 0,
+                                   EXPIRED_EXPLICIT: 0}}
+
+    def stats(self):
+        """Returns the cache statistics.
+
+        Returns:
+          A dict of counters; 'hits', 'misses', 'get_misses' (calls to get
+          for keys not cached, which do not populate them), 'populations'
+          (calls to the populate callback), 'population_errors',
+          'population_time' (the
+          total, in seconds), 'population_time_max', 'expiry_refused'
+          (DontExpireError raised by the expire callback) and 'expired' (a
+          dict of items expired, keyed by cause: EXPIRED_SIZE, EXPIRED_AGE
+          or EXPIRED_EXPLICIT). Also includes the current 'size' and
+          'weight' along with the 'maximum_size', 'maximum_weight' and
+          'maximum_age' settings.
+        """
+        result = dict(self._stats)
+        result['expired'] = dict(self._stats['expired'])
+        result['size'] = len(self.data)
+        result['weight'] = self.weight
+        result['maximum_size'] = self.maximum_size
+        result['maximum_weight'] = self.maximum_weight
+        result['maximum_age'] = self.maximum_age
+        return result
+
     def expire_item(self, return_copy=True):
         """Expires an item and optionally returns a shallow copy of it.
 
@@ -93,20 +272,26 @@ class LruDict(UserDict.IterableUserDict):
         Raises:
           IndexError: if the LRU is empty.
         """
-        item = heapq.heappop(self._heap)
-        value = self.data.get(item.key)
+        node = self._root.next
+        if node is self._root:
+            raise IndexError('expire_item(): LRU is empty')
+        value = self.data.get(node.key)
         if return_copy:
             result = copy.copy(value)
         else:
             result = None
-        self._expire_item(item.key)
+        self._expire_item(node.key, EXPIRED_EXPLICIT)
         return result
 
     def get(self, key, default=None):
         """Returns the named key's value from the cache."""
+        self._check_age(key)
         if key in self.data:
+            self._stats['hits'] += 1
+            self._touch(key)
             return self.data[key]
         else:
+            self._stats['get_misses'] += 1
             return default
 
     def set_populate_callback(self, callback):
@@ -118,47 +303,214 @@ class LruDict(UserDict.IterableUserDict):
         """Sets the expiry callback for the expire_callback attribute."""
         self._expire_callback = callback
 
+    def set_eviction_cost_callback(self, callback):
+        """Sets the eviction cost callback."""
+        self._eviction_cost_callback = callback
+
+    def _remove_node(self, key):
+        """Unlinks and forgets the key's node, if it has one."""
+        node = self._nodes.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self.weight -= node.weight
+
+    def clear(self):
+        """Removes all items from the cache without expiring them."""
+        self._initialise()
+
+    def pop(self, key, *args):
+        """Removes the key from the cache without expiring it."""
+        self._remove_node(key)
+        return self.data.pop(key, *args)
+
     def __getitem__(self, key):
         """Gets the value for key from the cache, maybe populating it first."""
-        if key not in self.data:
+        self._check_age(key)
+        if key in self.data:
+            self._stats['hits'] += 1
+            self._touch(key)
+            return self.data[key]
+        self._stats['misses'] += 1
+        if key in self._populating:
+            # Another greenthread is populating this key; share its result.
+            pending = self._populating[key]
+            if pending is None:
+                pending = self._populating[key] = eventlet.event.Event()
+            return pending.wait()
+
+        # The event is only created once another greenthread waits.
+        self._populating[key] = None
+        self._stats['populations'] += 1
+        start = time.time()
+        try:
             try:
                 value = self._populate_callback(key)
             except DontPopulateItemError:
-                return None
-            except Exception, e:
-                raise e
-            self._push_and_set(key, value)
-        return self.data[key]
+                value = None
+            else:
+                self._record_population_time(start)
+                self._push_and_set(key, value)
+        # Waiters must be released however the population ends, e.g., by
+        # an eventlet.Timeout.
+        except BaseException:
+            exc_info = sys.exc_info()
+            self._stats['population_errors'] += 1
+            pending = self._populating.pop(key)
+            if pending is not None:
+                pending.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        pending = self._populating.pop(key)
+        if pending is not None:
+            pending.send(value)
+        return value
+
+    def _record_population_time(self, start):
+        elapsed = max(0.0, time.time() - start)
+        self._stats['population_time'] += elapsed
+        if elapsed > self._stats['population_time_max']:
+            self._stats['population_time_max'] = elapsed
+
+    def __contains__(self, key):
+        self._check_age(key)
+        return key in self.data
 
     def __setitem__(self, key, value):
         """Sets the value for key to the cache."""
         self._push_and_set(key, value)
 
+    def __delitem__(self, key):
+        """Removes the key from the cache without expiring it."""
+        del self.data[key]
+        self._remove_node(key)
+
     def _push_and_set(self, key, value):
-        """Pushes an item onto the heap and sets it in the cache."""
-        item = HeapItem(key)
-        if len(self._heap) < self.maximum_size:
-            heapq.heappush(self._heap, item)
+        """Sets the key in the cache as the most-recently used item.
+
+        If the cache is full, the least-recently used items are expired first.
+        """
+        if self._weight_callback is None:
+            weight = 0
+        else:
+            weight = self._weight_callback(key, value)
+        node = self._nodes.get(key)
+        if node is not None and key in self._expiring:
+            # The old value's expire callback is running. Replace its
+            # (unlinked) node, so that the expiry leaves the new value.
+            del self._nodes[key]
+            self.weight -= node.weight
+            node = None
+        if node is None:
+            self._make_room(weight)
+        else:
+            self._make_room(weight - node.weight, replacing=True)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = Node(key)
+            self._link_mru(node)
         else:
-            old_item = heapq.heapreplace(self._heap, item)
-            self._expire_item(old_item.key)
+            self._touch(key)
+            self.weight -= node.weight
+        node.weight = weight
+        self.weight += weight
         self.data[key] = value
-        if self.maximum_age:
-            self._cleanup_gts.add(
-                eventlet.spawn_after(self.maximum_age, self._expire_item, key))
+        self._set_deadline(node)
 
-    def _expire_item(self, key):
-        """Expires an item from the cache."""
+    def _full(self, weight, replacing=False):
+        """Returns True if an item of weight does not fit in the cache."""
+        if not replacing and len(self._nodes) >= self.maximum_size:
+            return True
+        return (self.maximum_weight is not None and weight > 0 and
+                self.weight + weight > self.maximum_weight)
+
+    def _make_room(self, weight=0, replacing=False):
+        """Expires least-recently used items until there is room for one more.
+
+        Expire callbacks may yield to other greenthreads, so the size is
+        checked again after each expiry. Each item is tried at most once,
+        in case the expire callback refuses to expire them.
+
+        Args:
+          weight: A number, the weight to make room for.
+          replacing: A boolean, True if the item replaces one cached.
+        """
+        attempts = len(self._nodes)
+        while self._full(weight, replacing) and attempts > 0:
+            node = self._root.next
+            if node is self._root:
+                if not self._expiring:
+                    break
+                # All items are being expired by other greenthreads; wait
+                # for one of them to finish.
+                self._expired.wait()
+                continue
+            if self._eviction_cost_callback is not None:
+                node = self._cheapest_victim()
+            attempts -= 1
+            self._expire_item(node.key, EXPIRED_SIZE)
+
+    def _cheapest_victim(self):
+        """Returns the cheapest to evict of the least-recently used nodes.
+
+        If no sampled node may be evicted, the least-recently used node is
+        returned, so that the expire callback can decide.
+        """
+        victim = self._root.next
+        victim_cost = float('inf')
+        node = self._root.next
+        for _ in xrange(max(1, self.eviction_sample_size)):
+            if node is self._root:
+                break
+            cost = self._eviction_cost_callback(node.key, self.data[node.key])
+            if cost < victim_cost:
+                victim, victim_cost = node, cost
+            node = node.next
+        return victim
+
+    def _expire_item(self, key, cause=EXPIRED_EXPLICIT):
+        """Expires an item from the cache.
+
+        Args:
+          key: The key of the item to expire.
+          cause: A string, the reason for expiry (one of the EXPIRED_*
+            constants), recorded in the cache statistics.
+        """
+        if key in self._expiring:
+            # Another greenthread is already expiring this item.
+            return
+        node = self._nodes.get(key)
         if self._expire_callback and key in self.data:
+            # Unlink the item whilst the callback runs, so that evictions
+            # by other greenthreads choose a different item.
+            if node is not None:
+                self._unlink(node)
+            self._expiring.add(key)
             try:
                 self._expire_callback(key, self.data[key])
             except DontExpireError:
-                # If this exception is raised, we won't expire the item.
+                # If this exception is raised, we won't expire the item,
+                # though it is made most-recently used so we try others.
+                self._stats['expiry_refused'] += 1
+                if node is not None and self._nodes.get(key) is node:
+                    self._link_mru(node)
+                return
+            except Exception:
+                if node is not None and self._nodes.get(key) is node:
+                    self._link_mru(node)
+                raise
+            finally:
+                self._expiring.discard(key)
+                expired, self._expired = self._expired, eventlet.event.Event()
+                expired.send()
+            new_node = self._nodes.get(key)
+            if new_node is not None and new_node is not node:
+                # The key was set again whilst the callback ran.
+                self._stats['expired'][cause] += 1
                 return
-            except Exception, e:
-                raise e
+        self._remove_node(key)
         try:
             del self.data[key]
         except KeyError:
             # Indicates a race condition, multi-threaded use.
             pass
+        else:
+            self._stats['expired'][cause] += 1
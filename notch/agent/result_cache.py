@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A cache of read-only command responses.
+
+Responses to commands matching a configured pattern are kept for that
+pattern's time-to-live, so that clients polling the same devices are
+answered without running the command again. Requests which may change a
+device (see INVALIDATING_METHODS) discard its cached responses, and those
+still being read from it (see ResultCache.generation).
+"""
+
+import collections
+import logging
+import re
+import time
+
+import lru
+
+
+# Default maximum total bytes of cached responses.
+DEFAULT_MAXIMUM_BYTES = 64 * 1024 * 1024
+# Default maximum number of cached responses.
+DEFAULT_MAXIMUM_SIZE = 65536
+
+# Device API methods which discard the device's cached responses.
+INVALIDATING_METHODS = frozenset(['set_config', 'copy_file', 'upload_file'])
+
+
+# The cache key. scope is a tuple of the session arguments determining the
+# credential and privileges used (connect_method, user, privilege_level).
+CacheKey = collections.namedtuple(
+    'CacheKey', 'device_name command mode encoding scope')
+
+
+class ResultCache(object):
+    """A byte-weighted LRU cache of command responses.
+
+    Attributes:
+      rules: A list of (compiled regexp, float) tuples; commands matching
+        the regexp are cached for that many seconds. The first match wins.
+      maximum_bytes: An int, the maximum total length of cached responses.
+    """
+
+    def __init__(self, rules, maximum_bytes=DEFAULT_MAXIMUM_BYTES,
+                 maximum_size=DEFAULT_MAXIMUM_SIZE):
+        """Initializer.
+
+        Args:
+          rules: A list of (pattern string, ttl) pairs or dicts with
+            'pattern' and 'ttl' keys. Commands matching no pattern are not
+            cached.
+          maximum_bytes: An int, the maximum total length of responses.
+          maximum_size: An int, the maximum number of responses.
+
+        Raises:
+          ValueError: A rule was invalid.
+        """
+        self.rules = []
+        for rule in rules:
+            if isinstance(rule, dict):
+                pattern, ttl = rule.get('pattern'), rule.get('ttl')
+            else:
+                pattern, ttl = rule
+            try:
+                self.rules.append((re.compile(pattern), float(ttl)))
+            except (re.error, TypeError, ValueError), e:
+                raise ValueError('Invalid result cache rule %r: %s'
+                                 % (rule, e))
+        self.maximum_bytes = maximum_bytes
+        # Entries older than the longest time-to-live are reaped.
+        max_ttl = max([ttl for _, ttl in self.rules] or [0])
+        self._cache = lru.LruDict(
+            expire_callback=self._forget, maximum_size=maximum_size,
+            maximum_age=max_ttl or None, maximum_weight=maximum_bytes,
+            weight_callback=lambda unused_key, entry: len(entry[0]))
+        # The cached keys of each device, keyed by device name.
+        self._device_keys = {}
+        # The number of times each device was invalidated, by device name.
+        self._generations = {}
+        self._invalidations = 0
+
+    def ttl(self, command):
+        """Returns the time-to-live for the command, or None if uncached."""
+        for regexp, ttl in self.rules:
+            if regexp.search(command):
+                return ttl
+
+    def get(self, key, max_age=None):
+        """Returns the cached response for key, or None.
+
+        Args:
+          key: A CacheKey.
+          max_age: A float, the maximum age in seconds of the response
+            acceptable to the client, or None for the rule's time-to-live.
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        response, stored, ttl = entry
+        age = time.time() - stored
+        if age > ttl:
+            self._discard(key)
+            return None
+        elif max_age is not None and age > max_age:
+            return None
+        return response
+
+    def generation(self, device_name):
+        """Returns the device's generation, bumped by each invalidation.
+
+        Record it before executing a command and pass it to put(); the
+        response is then not cached if the device was changed meanwhile.
+        """
+        return self._generations.get(device_name, 0)
+
+    def put(self, key, response, generation=None):
+        """Caches the response, if its command is cacheable.
+
+        Args:
+          key: A CacheKey.
+          response: A string, the command's response.
+          generation: An int, the device's generation() when the command
+            started, or None to cache the response regardless.
+        """
+        ttl = self.ttl(key.command)
+        if not ttl or not isinstance(response, basestring):
+            return
+        elif (generation is not None and
+              generation != self.generation(key.device_name)):
+            logging.debug('Not caching response to %r on %s; the device '
+                          'changed whilst it was read.', key.command,
+                          key.device_name)
+            return
+        elif len(response) > self.maximum_bytes:
+            logging.debug('Not caching %d byte response to %r on %s.',
+                          len(response), key.command, key.device_name)
+            return
+        self._cache[key] = (response, time.time(), ttl)
+        self._device_keys.setdefault(key.device_name, set()).add(key)
+
+    def invalidate(self, device_name):
+        """Discards the device's cached responses.
+
+        Responses still being read from the device are not cached either,
+        as the change may have happened whilst they were read.
+        """
+        self._generations[device_name] = self.generation(device_name) + 1
+        keys = self._device_keys.pop(device_name, ())
+        if keys:
+            self._invalidations += 1
+        for key in keys:
+            self._cache.pop(key, None)
+
+    def stats(self):
+        """Returns the cache statistics.
+
+        Returns:
+          A dict, the lru.LruDict statistics (where 'weight' is the bytes
+          cached and 'get_misses' counts lookups not cached) with the
+          number of 'invalidations' and of cached 'devices'.
+        """
+        result = self._cache.stats()
+        result['invalidations'] = self._invalidations
+        result['devices'] = len(self._device_keys)
+        return result
+
+    def _discard(self, key):
+        self._cache.pop(key, None)
+        self._forget(key, None)
+
+    def _forget(self, key, unused_entry):
+        """Removes an expired key from its device's keys."""
+        keys = self._device_keys.get(key.device_name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._device_keys[key.device_name]
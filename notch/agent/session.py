@@ -26,10 +26,17 @@ keeping devices connected until idle timers expire.
 
 import base64
 import collections
+import cStringIO
+import gzip
 import logging
-import threading
 import time
+import zlib
 
+import eventlet
+import eventlet.event
+import eventlet.timeout
+
+import admission
 import errors
 
 
@@ -37,30 +44,273 @@ import errors
 SessionKey = collections.namedtuple(
     'SessionKey', 'device_name connect_method user privilege_level')
 
+# Response encodings a request may ask for (see Session.request).
+ENCODINGS = ('base64', 'raw', 'zlib+base64', 'gzip')
+DEFAULT_ENCODING = 'base64'
+# zlib compression level for the compressed encodings.
+COMPRESS_LEVEL = 6
+
+
+def decode(response, encoding=None):
+    """Returns the original response, given it in an encoding.
+
+    Args:
+      response: A string, the response as encoded by Session.request.
+      encoding: A string, one of ENCODINGS (default: DEFAULT_ENCODING).
+
+    Returns:
+      A string, the response. 'raw' responses are UTF-8 encoded.
+    """
+    encoding = encoding or DEFAULT_ENCODING
+    if encoding == 'raw':
+        if isinstance(response, unicode):
+            return response.encode('utf-8')
+        return response
+    response = base64.b64decode(response)
+    if encoding == 'zlib+base64':
+        return zlib.decompress(response)
+    elif encoding == 'gzip':
+        return gzip.GzipFile(fileobj=cStringIO.StringIO(response)).read()
+    return response
+
+
+class RequestLock(object):
+    """A cooperative lock that is granted to waiting greenthreads in order.
+
+    Waiting greenthreads yield to the eventlet hub rather than blocking it.
+    Up to capacity greenthreads may hold the lock at once.
+
+    Attributes:
+      max_waiters: An int, the maximum number of waiting greenthreads, or
+        None for no limit.
+      capacity: An int, the maximum number of concurrent holders.
+    """
+
+    def __init__(self, max_waiters=None, capacity=1):
+        self.max_waiters = max_waiters
+        self.capacity = max(1, capacity)
+        self._holders = 0
+        # eventlet.event.Event objects, one per waiting greenthread.
+        self._waiters = collections.deque()
+        self._stats = {'acquisitions': 0,
+                       'waits': 0,
+                       'wait_time': 0.0,
+                       'wait_time_max': 0.0,
+                       'waiting_max': 0,
+                       'timeouts': 0,
+                       'rejections': 0}
+
+    def locked(self):
+        """Returns True if the lock cannot be acquired without waiting."""
+        return self._holders >= self.capacity
+
+    @property
+    def holders(self):
+        """The number of greenthreads holding the lock."""
+        return self._holders
+
+    @property
+    def waiting(self):
+        """The number of greenthreads waiting for the lock."""
+        return len(self._waiters)
+
+    def stats(self):
+        """Returns the lock statistics.
+
+        Returns:
+          A dict of counters; 'acquisitions', 'waits' (acquisitions which
+          had to wait), 'wait_time' (the total, in seconds), 'wait_time_max',
+          'waiting_max' (the longest queue seen), 'timeouts' and
+          'rejections' (due to max_waiters). Also includes whether the lock
+          is 'locked', its 'capacity', the number of 'holders' and the
+          number of greenthreads now 'waiting'.
+        """
+        result = dict(self._stats)
+        result['locked'] = self.locked()
+        result['capacity'] = self.capacity
+        result['holders'] = self._holders
+        result['waiting'] = len(self._waiters)
+        return result
+
+    def acquire(self, timeout=None):
+        """Acquires the lock, waiting behind any earlier waiters.
+
+        Args:
+          timeout: A float, the maximum seconds to wait, or None to wait
+            until the lock is acquired.
+
+        Raises:
+          errors.SessionQueueFullError: max_waiters greenthreads are waiting.
+          errors.SessionQueueTimeoutError: The timeout expired first.
+        """
+        if self._holders < self.capacity and not self._waiters:
+            self._holders += 1
+            self._stats['acquisitions'] += 1
+            return
+        if (self.max_waiters is not None and
+            len(self._waiters) >= self.max_waiters):
+            self._stats['rejections'] += 1
+            raise errors.SessionQueueFullError(
+                '%d requests already waiting' % len(self._waiters))
+
+        waiter = eventlet.event.Event()
+        self._waiters.append(waiter)
+        self._stats['waiting_max'] = max(self._stats['waiting_max'],
+                                         len(self._waiters))
+        start = time.time()
+        timer = None
+        if timeout is not None:
+            timer = eventlet.timeout.Timeout(timeout)
+        try:
+            try:
+                waiter.wait()
+            except eventlet.timeout.Timeout, e:
+                if e is not timer:
+                    self._abandon(waiter)
+                    raise
+                # The lock may have been handed over as the timer fired.
+                if not waiter.ready():
+                    self._abandon(waiter)
+                    self._stats['timeouts'] += 1
+                    raise errors.SessionQueueTimeoutError(
+                        'Waited %.1f sec' % timeout)
+            except:
+                # e.g., the greenthread was killed whilst waiting.
+                self._abandon(waiter)
+                raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            elapsed = max(0.0, time.time() - start)
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += elapsed
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'],
+                                               elapsed)
+        self._stats['acquisitions'] += 1
+
+    def _abandon(self, waiter):
+        """Gives up waiting, passing the lock on if it was handed over."""
+        if waiter.ready():
+            self.release()
+        else:
+            self._waiters.remove(waiter)
+
+    def release(self):
+        """Releases the lock, handing it to the longest waiter (if any)."""
+        if self._waiters:
+            self._waiters.popleft().send()
+        else:
+            self._holders -= 1
+
+
+class ResponseStream(object):
+    """An iterator over the pieces of a response streamed from a session.
+
+    The session is held until the stream is exhausted, fails or is closed.
+    Consumers which stop reading early must call close().
+    """
+
+    def __init__(self, pieces, release):
+        """Initializer.
+
+        Args:
+          pieces: A generator, yielding the response in pieces.
+          release: A callable, called once when the stream ends.
+        """
+        self._pieces = pieces
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._pieces is None:
+            raise StopIteration
+        try:
+            return self._pieces.next()
+        except:
+            # Includes StopIteration, at the end of the response.
+            self.close()
+            raise
+
+    def close(self):
+        """Abandons the rest of the response and releases the session."""
+        if self._pieces is None:
+            return
+        pieces, self._pieces = self._pieces, None
+        try:
+            pieces.close()
+        finally:
+            self._release()
+
 
 class Session(object):
-    """A session manages a connections and requests to a device."""
+    """A session manages a connections and requests to a device.
+
+    Requests are executed one at a time, unless the device multiplexes
+    requests over its connection (device.MAX_CHANNELS > 1), in which case up
+    to max_channels requests execute at once. Requests waiting for the
+    session queue in order, up to max_queue_length at once, waiting for at
+    most max_wait_time seconds (or the request's own max_wait_time argument).
+    """
 
     # Methods supported by the Device API that may be requested.
     valid_requests = ('command', 'get_config', 'set_config',
                       'copy_file', 'upload_file', 'download_file',
                       'delete_file', 'lock', 'unlock')
 
-    def __init__(self, device=None):
+    # Methods whose response may be streamed (see request_iter).
+    streamable_requests = ('command', 'get_config')
+
+    # Default limits on requests waiting for the session.
+    MAX_QUEUE_LENGTH = 64
+    MAX_WAIT_TIME = 300.0
+
+    def __init__(self, device=None, request_callback=None,
+                 max_queue_length=None, max_wait_time=None,
+                 max_channels=None):
+        """Initializer.
+
+        Args:
+          device: A device.Device subclass instance, the session's device.
+          request_callback: Optional callable, called with this session
+            after each request completes (successfully or not).
+          max_queue_length: An int, the maximum number of requests waiting
+            for the session (default: MAX_QUEUE_LENGTH).
+          max_wait_time: A float, the default maximum seconds a request
+            waits for the session (default: MAX_WAIT_TIME).
+          max_channels: An int, the maximum number of concurrent requests
+            (default: the device's MAX_CHANNELS).
+        """
         # TODO(afort): Allow devices to have multiple authentication
         # credentials available (e.g., during password changes).
-        self._exclusive = threading.Lock()
+        if max_queue_length is None:
+            max_queue_length = self.MAX_QUEUE_LENGTH
+        if max_channels is None:
+            max_channels = getattr(device, 'MAX_CHANNELS', 1)
+        self._exclusive = RequestLock(max_waiters=max_queue_length,
+                                      capacity=max_channels)
+        # Serialises connection by concurrent requests.
+        self._connecting = RequestLock()
+        # The number of requests executing on the device.
+        self._active = 0
+        if max_wait_time is None:
+            max_wait_time = self.MAX_WAIT_TIME
+        self.max_wait_time = max_wait_time
 
         self.device = device
+        self.request_callback = request_callback
         self._credential = None
 
         self._connected = False
-        self.idle = True
+        self.idle = not self._active
 
         self.time_last_connect = None
         self.time_last_disconnect = None
         self.time_last_response = None
         self.time_last_request = None
+        # Seconds taken by the last successful connection (and login).
+        self.connect_cost = None
 
         self._bytes_sent = 0
         self._bytes_recv = 0
@@ -89,6 +339,36 @@ class Session(object):
     def connected(self):
         return self._connected
 
+    @property
+    def busy(self):
+        """True if a request is executing (or waiting) on this session."""
+        return not self.idle or self._exclusive.holders > 0
+
+    def stats(self):
+        """Returns the session's state and request queue statistics."""
+        return {'connected': self._connected,
+                'idle': self.idle,
+                'time_last_request': self.time_last_request,
+                'time_last_connect': self.time_last_connect,
+                'connect_cost': self.connect_cost,
+                'queue': self._exclusive.stats()}
+
+    @property
+    def idle_deadline(self):
+        """Returns the time the session becomes idle, or None if unknown."""
+        last_used = self.time_last_request or self.time_last_connect
+        if last_used is None or self.device is None:
+            return None
+        return last_used + self.device.MAX_IDLE_TIME
+
+    @property
+    def idle_time(self):
+        """Returns the seconds since the last request (or connection)."""
+        last_used = self.time_last_request or self.time_last_connect
+        if last_used is None:
+            return 0.0
+        return max(0.0, time.time() - last_used)
+
     def _credential(self):
         return self._credential
 
@@ -121,11 +401,23 @@ class Session(object):
         if self._credential is None:
             raise errors.NoMatchingCredentialError()
 
+        start = time.time()
         self.device.connect(credential=self._credential,
                             connect_method=self._credential.connect_method)
         self.time_last_connect = time.time()
+        self.connect_cost = max(0.0, self.time_last_connect - start)
         self._connected = True
-        self.idle = True
+        self.idle = not self._active
+
+    def _ensure_connected(self):
+        """Connects the session, unless a concurrent request already has."""
+        if self._connected:
+            return
+        self._connecting.acquire()
+        try:
+            self.connect()
+        finally:
+            self._connecting.release()
 
     def disconnect(self):
         """Disconnects the session."""
@@ -136,61 +428,149 @@ class Session(object):
         self.device.disconnect()
         self.time_last_disconnect = time.time()
         self._connected = False
-        self.idle = True
+        self.idle = not self._active
 
-    def request(self, method, *args, **kwargs):
-        """Executes a request on this session."""
-        result = None
+    def _acquire(self, max_wait_time=None):
+        """Waits for the session.
+
+        Args:
+          max_wait_time: The maximum seconds to wait (default:
+            self.max_wait_time).
+
+        Raises:
+          errors.InvalidRequestError: max_wait_time was not a number.
+          errors.SessionQueueFullError: Too many requests are waiting.
+          errors.SessionQueueTimeoutError: The wait for the session timed out.
+          errors.OverloadedError: The request was shed (see admission).
+        """
+        try:
+            if max_wait_time is None:
+                max_wait_time = self.max_wait_time
+            max_wait_time = float(max_wait_time)
+        except (TypeError, ValueError):
+            raise errors.InvalidRequestError(
+                'Invalid max_wait_time %r' % max_wait_time)
         logging.debug('Acquiring lock for %s', self)
-        self._exclusive.acquire()
+        self._exclusive.acquire(timeout=max_wait_time)
+        logging.debug('Acquired lock for %s', self)
         try:
-            logging.debug('Acquired lock for %s', self)
-            # Check the method name is valid.
-            if not method in self.valid_requests:
-                raise errors.InvalidRequestError(
-                    'Method %r not part of the device API.' % method)
-            if self.device is None:
-                raise errors.InvalidDeviceError('Device not yet initialised.')
-            if not self._connected:
-                self.connect()
-            # Execute the method.
-            self.time_last_request = time.time()
-            device_method = getattr(self.device, method)
-
-            self.idle = False
+            admission.start_bound()
+        except errors.OverloadedError:
+            self._release()
+            raise
+
+    def _release(self):
+        logging.debug('Releasing lock for %s', self)
+        self._exclusive.release()
+        if self.request_callback is not None:
+            self.request_callback(self)
+
+    def _check_request(self, method):
+        # Check the method name is valid.
+        if not method in self.valid_requests:
+            raise errors.InvalidRequestError(
+                'Method %r not part of the device API.' % method)
+        if self.device is None:
+            raise errors.InvalidDeviceError('Device not yet initialised.')
+
+    def _disconnect_unshared(self, reason):
+        """Disconnects, unless other requests share the connection.
+
+        Devices with MAX_CHANNELS above one run concurrent requests on
+        separate channels of one connection; closing it would fail the
+        requests on the other channels, too.
+
+        Args:
+          reason: A string, the reason to log for disconnecting.
+        """
+        if self._active > 1:
+            logging.debug('Not disconnecting session %s (%s); %d other '
+                          'requests are active.', self, reason,
+                          self._active - 1)
+            return
+        logging.debug('Disconnecting session %s (%s).', self, reason)
+        self.disconnect()
+
+    def _execute(self, method, args, kwargs):
+        """Executes a request whilst holding the session lock.
+
+        Returns:
+          The device method's (unencoded) result.
+        """
+        self._ensure_connected()
+        # Execute the method.
+        self.time_last_request = time.time()
+        device_method = getattr(self.device, method)
+
+        self._active += 1
+        self.idle = False
+        try:
+            # Remove the device_name argument not used in device.py.
+            # TODO(afort): device.py/subclasses to take **kwargs instead?
+            if 'device_name' in kwargs:
+                del kwargs['device_name']
             try:
-                # Remove the device_name argument not used in device.py.
-                # TODO(afort): device.py/subclasses to take **kwargs instead?
-                if 'device_name' in kwargs:
-                    del kwargs['device_name']
-                try:
-                    # May raise any exception, we'll trigger a retry
-                    # upon API errors with the retry attribute set.
+                # May raise any exception, we'll trigger a retry
+                # upon API errors with the retry attribute set.
+                result = device_method(*args, **kwargs)
+            except errors.ApiError, e:
+                # Normally, we'll disconnect upon error just incase.
+                if e.disconnect_on_error:
+                    self._disconnect_unshared('error occured')
+                # Single optional retry.
+                if e.retry:
+                    logging.debug('Retrying request on session %s.', self)
+                    self._ensure_connected()
                     result = device_method(*args, **kwargs)
-                    # We must now base64 encode the string result,
-                    # incase it contains binary data.
-
-                except errors.ApiError, e:
-                    # Normally, we'll disconnect upon error just incase.
-                    if e.disconnect_on_error:
-                        logging.debug(
-                            'Disconnecting session %s (error occured).', self)
-                        self.disconnect()
-                    # Single optional retry.
-                    if e.retry:
-                        logging.debug('Retrying request on session %s.', self)
-                        self.connect()
-                        result = device_method(*args, **kwargs)
-                    else:
-                        raise e
-                self.time_last_response = time.time()
-            finally:
-                self.idle = True
-
+                else:
+                    raise e
+            self.time_last_response = time.time()
+            return result
         finally:
-            logging.debug('Releasing lock for %s', self)
-            self._exclusive.release()
-
+            self._active -= 1
+            self.idle = not self._active
+
+    def _check_encoding(self, encoding):
+        if encoding is not None and encoding not in ENCODINGS:
+            raise errors.InvalidRequestError(
+                'Invalid encoding %r (must be one of %s)' %
+                (encoding, ', '.join(ENCODINGS)))
+
+    def _encode(self, result, encoding=None):
+        """Returns the result in the requested encoding.
+
+        Args:
+          result: The device method's result.
+          encoding: A string, one of ENCODINGS (default: DEFAULT_ENCODING).
+            'raw' returns the result as is, 'zlib+base64' returns it zlib
+            compressed then base64 encoded and 'gzip' returns it in the gzip
+            file format, base64 encoded.
+
+        Raises:
+          errors.EncodingError: A 'raw' result was not valid UTF-8.
+        """
+        encoding = encoding or DEFAULT_ENCODING
+        if encoding == 'raw':
+            if isinstance(result, str):
+                try:
+                    return result.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise errors.EncodingError(
+                        'Response is not valid UTF-8 text; use the base64 '
+                        'encoding.')
+            return result
+        elif encoding != DEFAULT_ENCODING and isinstance(result, str):
+            if encoding == 'zlib+base64':
+                result = zlib.compress(result, COMPRESS_LEVEL)
+            else:
+                buf = cStringIO.StringIO()
+                gzip_file = gzip.GzipFile(mode='wb', fileobj=buf,
+                                          compresslevel=COMPRESS_LEVEL)
+                gzip_file.write(result)
+                gzip_file.close()
+                result = buf.getvalue()
+        # We must base64 encode the string result, incase it contains
+        # binary data.
         try:
             return base64.b64encode(result)
         except Exception, e:
@@ -199,4 +579,375 @@ class Session(object):
                           e.__class__.__name__, str(e), result)
             return result
 
+    def request(self, method, *args, **kwargs):
+        """Executes a request on this session.
+
+        Args:
+          method: A string, the device API method name.
+          args: Non-keyword arguments for the device method.
+          kwargs: Keyword arguments for the device method. The optional
+            'max_wait_time' argument (a float) overrides the maximum seconds
+            to wait for the session, and the optional 'encoding' argument
+            (one of ENCODINGS; default: DEFAULT_ENCODING) sets the encoding
+            of the response.
+
+        Raises:
+          errors.InvalidRequestError: The encoding was invalid.
+          errors.EncodingError: The response could not be encoded.
+          errors.SessionQueueFullError: Too many requests are waiting.
+          errors.SessionQueueTimeoutError: The wait for the session timed out.
+        """
+        encoding = kwargs.pop('encoding', None)
+        self._check_encoding(encoding)
+        self._acquire(kwargs.pop('max_wait_time', None))
+        try:
+            self._check_request(method)
+            result = self._execute(method, args, kwargs)
+        finally:
+            self._release()
+        return self._encode(result, encoding)
+
+    def request_iter(self, method, *args, **kwargs):
+        """Executes a request on this session, streaming the response.
+
+        The session is acquired and connected before this returns, so
+        errors doing so are raised here. Errors executing the request are
+        raised by the returned stream; the request is retried (as by
+        request()) only if no part of the response has been yielded.
+
+        Args:
+          method: A string, the device API method name; one of
+            streamable_requests.
+          args: Non-keyword arguments for the device method.
+          kwargs: Keyword arguments for the device method, and the optional
+            'max_wait_time' argument (see request()).
+
+        Returns:
+          A ResponseStream, yielding the (unencoded) response in pieces.
+
+        Raises:
+          errors.InvalidRequestError: The method cannot be streamed.
+          errors.SessionQueueFullError: Too many requests are waiting.
+          errors.SessionQueueTimeoutError: The wait for the session timed out.
+        """
+        self._acquire(kwargs.pop('max_wait_time', None))
+        try:
+            self._check_request(method)
+            if method not in self.streamable_requests:
+                raise errors.InvalidRequestError(
+                    'Method %r cannot be streamed.' % method)
+            self._ensure_connected()
+        except:
+            self._release()
+            raise
+        return ResponseStream(self._stream(method, args, kwargs),
+                              self._release)
+
+    def _stream(self, method, args, kwargs):
+        """Yields a response in pieces whilst holding the session lock."""
+        self.time_last_request = time.time()
+        device_method = getattr(self.device, method + '_iter')
+        if 'device_name' in kwargs:
+            del kwargs['device_name']
+
+        self._active += 1
+        self.idle = False
+        streaming = False
+        try:
+            try:
+                try:
+                    for piece in device_method(*args, **kwargs):
+                        streaming = True
+                        yield piece
+                except errors.ApiError, e:
+                    if e.disconnect_on_error:
+                        self._disconnect_unshared('error occured')
+                    # Part of the response is gone; it cannot be retried.
+                    if not e.retry or streaming:
+                        raise
+                    logging.debug('Retrying request on session %s.', self)
+                    self._ensure_connected()
+                    for piece in device_method(*args, **kwargs):
+                        yield piece
+            except GeneratorExit:
+                # The rest of the response is still to come from the
+                # device, so the connection is no longer in step.
+                try:
+                    self._disconnect_unshared('response abandoned')
+                except errors.Error, e:
+                    logging.error(str(e))
+                raise
+            self.time_last_response = time.time()
+        finally:
+            self._active -= 1
+            self.idle = not self._active
+
+    def _pipelined_commands(self, method, arguments):
+        """Returns a (commands, mode) tuple if the batch can be pipelined.
+
+        Command batches are pipelined if the device allows it and all
+        commands use the same mode. Otherwise, returns None.
+        """
+        if (method != 'command' or len(arguments) < 2 or
+            not getattr(self.device, 'PIPELINE_COMMANDS', False)):
+            return None
+        allowed = set(['command', 'mode'])
+        modes = set()
+        for kwargs in arguments:
+            if 'command' not in kwargs or not allowed.issuperset(kwargs):
+                return None
+            modes.add(kwargs.get('mode'))
+        if len(modes) != 1:
+            return None
+        return [kwargs['command'] for kwargs in arguments], modes.pop()
+
+    def _batch_result(self, response, encoding):
+        try:
+            return {'result': self._encode(response, encoding)}
+        except errors.EncodingError, e:
+            return {'error': e.name, 'message': str(e)}
+
+    def request_batch(self, method, arguments, stop_on_error=True,
+                      max_wait_time=None, encoding=None):
+        """Executes a sequence of requests, waiting for the session once.
+
+        Command sequences are pipelined on devices which allow it (see
+        device.Device.PIPELINE_COMMANDS).
+
+        Args:
+          method: A string, the device API method name.
+          arguments: A list of dicts, the keyword arguments for each request.
+          stop_on_error: A boolean. If True, the requests following a failed
+            request are not executed.
+          max_wait_time: A float, the maximum seconds to wait for the session.
+          encoding: A string, the encoding of the responses (see request()).
+
+        Returns:
+          A list of dicts, one per executed request, in order. Each has either
+          a 'result' key (the encoded response), or an 'error' key
+          (the errors.ApiError name) and a 'message' key.
+
+        Raises:
+          errors.InvalidRequestError: The method name was invalid.
+          errors.SessionQueueFullError: Too many requests are waiting.
+          errors.SessionQueueTimeoutError: The wait for the session timed out.
+        """
+        self._check_encoding(encoding)
+        results = []
+        self._acquire(max_wait_time)
+        try:
+            self._check_request(method)
+            # Connection errors fail the whole batch, as for one request.
+            self._ensure_connected()
+            pipelined = self._pipelined_commands(method, arguments)
+            if pipelined is not None:
+                try:
+                    responses = self._execute('commands', pipelined[:1],
+                                              {'mode': pipelined[1]})
+                except errors.ApiError, e:
+                    for response in getattr(e, 'responses', []):
+                        results.append(self._batch_result(response, encoding))
+                    results.append({'error': e.name, 'message': str(e)})
+                    if stop_on_error:
+                        return results
+                    # Run the remaining commands one at a time.
+                    arguments = arguments[len(results):]
+                else:
+                    return [self._batch_result(r, encoding)
+                            for r in responses]
+            for kwargs in arguments:
+                try:
+                    result = self._execute(method, (), dict(kwargs))
+                except errors.ApiError, e:
+                    results.append({'error': e.name, 'message': str(e)})
+                    if stop_on_error:
+                        break
+                else:
+                    results.append(self._batch_result(result, encoding))
+        finally:
+            self._release()
+        return results
+
+
+class SessionPool(object):
+    """A pool of sessions to one device, for concurrent requests.
+
+    The pool offers the same interface as a Session. Requests are dispatched
+    to an idle member session. When all members are busy, the pool grows
+    (up to max_sessions) by connecting a new session to the device. Should
+    the device refuse further sessions (errors.SessionLimitError), the pool
+    stops growing at its current size for limit_backoff seconds. Otherwise,
+    requests wait on the member with the fewest waiting requests.
+    Disconnected members (e.g., when idle) are removed from the pool, down
+    to min_sessions members.
+
+    Attributes:
+      members: A list of Session objects, the pool members.
+      max_sessions: An int, the maximum number of members.
+      min_sessions: An int, the minimum number of members.
+      limit_backoff: A float, the seconds before a pool limited by the
+        device tries to grow beyond that limit again.
+    """
+
+    # Seconds before growing beyond the device's session limit again.
+    LIMIT_BACKOFF = 300.0
+
+    def __init__(self, device_factory, max_sessions, min_sessions=1,
+                 device=None, **kwargs):
+        """Initializer.
+
+        Args:
+          device_factory: A callable returning a new device.Device subclass
+            instance for each new member session.
+          max_sessions: An int, the maximum number of members.
+          min_sessions: An int, the minimum number of members.
+          device: Optional device.Device subclass instance to use for the
+            first member (otherwise, one is made by device_factory).
+          kwargs: Keyword arguments for each member Session.
+        """
+        self._device_factory = device_factory
+        self.max_sessions = max(1, max_sessions)
+        self.min_sessions = max(1, min(min_sessions, self.max_sessions))
+        self.limit_backoff = self.LIMIT_BACKOFF
+        # The pool size the device last limited us to, and when the limit
+        # expires.
+        self._device_limit = None
+        self._device_limit_expiry = None
+        self._session_kwargs = kwargs
+        self._credential = None
+        self.members = []
+        self._add_member(device=device)
+
+    def __str__(self):
+        return '<%s of %d on %s>' % (self.__class__.__name__,
+                                     len(self.members), self.device.name)
+
+    def _add_member(self, device=None):
+        member = Session(device=device or self._device_factory(),
+                         **self._session_kwargs)
+        if self._credential is not None:
+            member.credential = self._credential
+        self.members.append(member)
+        return member
+
+    @property
+    def device(self):
+        return self.members[0].device
+
+    @property
+    def connected(self):
+        return any(m.connected for m in self.members)
+
+    @property
+    def busy(self):
+        return any(m.busy for m in self.members)
+
+    @property
+    def idle(self):
+        return all(m.idle for m in self.members)
+
+    @property
+    def idle_time(self):
+        """Returns the seconds since any connected member was last used."""
+        times = [m.idle_time for m in self.members if m.connected]
+        return min(times or [0.0])
+
+    @property
+    def connect_cost(self):
+        costs = [m.connect_cost for m in self.members
+                 if m.connect_cost is not None]
+        return max(costs or [None])
+
+    def _set_credential(self, c):
+        self._credential = c
+        for member in self.members:
+            member.credential = c
+
+    credential = property(lambda self: self._credential, _set_credential)
+
+    def stats(self):
+        """Returns the pool's state and the statistics of each member.
+
+        'device_limit' is the pool size the device has limited the pool to,
+        or None.
+        """
+        self._size_limit()
+        return {'connected': self.connected,
+                'idle': self.idle,
+                'min_sessions': self.min_sessions,
+                'max_sessions': self.max_sessions,
+                'device_limit': self._device_limit,
+                'members': [m.stats() for m in self.members]}
+
+    def connect(self):
+        """Connects the first member session."""
+        self.members[0].connect()
+
+    def disconnect(self):
+        """Disconnects all member sessions."""
+        for member in list(self.members):
+            member.disconnect()
+
+    def _remove_member(self, member):
+        # Members compare equal (they share a device), so compare identity.
+        self.members = [m for m in self.members if m is not member]
+
+    def _shrink(self):
+        """Removes disconnected, idle members, down to min_sessions."""
+        for member in list(self.members):
+            if len(self.members) <= self.min_sessions:
+                break
+            if not member.connected and not member.busy:
+                self._remove_member(member)
+
+    def _size_limit(self):
+        """Returns the maximum number of members, allowing for the device."""
+        if self._device_limit is not None:
+            if time.time() < self._device_limit_expiry:
+                return self._device_limit
+            logging.info('%s: pool may grow to %d sessions again', self,
+                         self.max_sessions)
+            self._device_limit = None
+        return self.max_sessions
+
+    def _choose_member(self):
+        """Returns a (member, is_new_member) tuple to dispatch a request to."""
+        idle = [m for m in self.members if not m.busy]
+        if idle:
+            connected = [m for m in idle if m.connected]
+            return (connected or idle)[0], False
+        elif len(self.members) < self._size_limit():
+            return self._add_member(), True
+        else:
+            return min(self.members, key=lambda m: m._exclusive.waiting), False
+
+    def _dispatch(self, request, *args, **kwargs):
+        """Calls the named request method of a member session."""
+        self._shrink()
+        member, is_new_member = self._choose_member()
+        try:
+            return getattr(member, request)(*args, **dict(kwargs))
+        except errors.SessionLimitError:
+            if not is_new_member or len(self.members) == 1:
+                raise
+            # The device has no more room for us; stop growing for a while.
+            self._remove_member(member)
+            self._device_limit = len(self.members)
+            self._device_limit_expiry = time.time() + self.limit_backoff
+            logging.warn('%s: device session limit reached, pool size is '
+                         '%d for %.0f sec', self, self._device_limit,
+                         self.limit_backoff)
+            member, _ = self._choose_member()
+            return getattr(member, request)(*args, **dict(kwargs))
+
+    def request(self, method, *args, **kwargs):
+        """Executes a request on a member session. See Session.request."""
+        return self._dispatch('request', method, *args, **kwargs)
+
+    def request_batch(self, method, arguments, **kwargs):
+        """Executes requests on a member session. See Session.request_batch."""
+        return self._dispatch('request_batch', method, arguments, **kwargs)
 
+    def request_iter(self, method, *args, **kwargs):
+        """Streams a request on a member session. See Session.request_iter."""
+        return self._dispatch('request_iter', method, *args, **kwargs)
@@ -13,106 +13,420 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-
 """An executor thread-pool.
 
-A very simple execute only thread pool for background execution of
-Notch RPC handlers in the Tornado webserver.
+Executes Notch RPC handlers in the background in the Tornado webserver.
+Work items return futures, through which their results (or exceptions)
+are delivered. Worker threads (greenthreads, as threading is green) wait
+on condition variables; none poll or sleep.
 """
 
+import collections
 import logging
-import Queue
-from eventlet.green import threading
+import sys
 import time
 import traceback
 
-# Default number of threads to have in the pool. Thread count, and
+import eventlet
+import eventlet.event
+import eventlet.timeout
+from eventlet.green import Queue
+from eventlet.green import threading
+
+# Default maximum number of threads in the pool. Thread count, and
 # specifically contention, is the major factor in jitter due to
 # queueing artifacts. More threads are necessary when an agent must
 # talk to many devices simultaneously, to allow for the combined
 # effects of network latency. Sharding work amongst multiple agents
 # using a reverse proxy load-balancer is a useful scaling strategy.
-DEFAULT_NUM_THREADS = 8
+DEFAULT_MAX_THREADS = 8
+
+# Seconds a thread beyond min_threads may be idle before it exits.
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+
+# Raised by submit_nowait() when the queue is full.
+Full = Queue.Full
+
+
+class Error(Exception):
+    pass
+
+
+class TimeoutError(Error):
+    """A future's result was not ready in time."""
+
+
+class StoppedError(Error):
+    """Work was submitted to a stopped ThreadPool."""
+
+
+class Future(object):
+    """The eventual result of a work item.
+
+    Greenthreads waiting for the result yield to the eventlet hub.
+    """
+
+    def __init__(self):
+        self._done = eventlet.event.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Returns True if the work item has finished."""
+        return self._done.ready()
+
+    def result(self, timeout=None):
+        """Returns the work item's result, waiting for it if necessary.
+
+        Args:
+          timeout: A float, the seconds to wait, or None to wait forever.
+
+        Returns:
+          The work item's return value.
+
+        Raises:
+          TimeoutError: The work item did not finish in time.
+          The exception raised by the work item, with its traceback.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the work item, or None.
+
+        Args:
+          timeout: A float, the seconds to wait, or None to wait forever.
+
+        Raises:
+          TimeoutError: The work item did not finish in time.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) when the work item finishes.
+
+        The callback is called at once if the work item has finished,
+        otherwise it is called in the worker thread. Exceptions it raises
+        are logged.
+        """
+        if self.done():
+            self._call(callback)
+        else:
+            self._callbacks.append(callback)
 
-# Time to sleep when the queue is full on put() and block=True.
-DEFAULT_QUEUE_FULL_SLEEP_TIME = 1.0
+    def _wait(self, timeout):
+        if self.done():
+            return
+        timer = eventlet.timeout.Timeout(
+            timeout, TimeoutError('Result not ready after %s seconds.'
+                                  % timeout))
+        try:
+            self._done.wait()
+        finally:
+            timer.cancel()
+
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._done.send()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        # Log but don't raise exceptions. pylint: disable-msg=W0703
+        except Exception, e:
+            logging.error('Unhandled exception in %s callback. %s: %s\n%s',
+                          self.__class__.__name__, e.__class__.__name__,
+                          str(e), traceback.format_exc())
 
 
 class ThreadPool(object):
-    """A simple thread pool of executor threads.
+    """A pool of executor threads.
 
-    Threads execute work items from a queue (a callable, args and kwargs).
-    Work items are executed, their results are ignored.  Exceptions details
-    are logged, but otherwise ignored.
+    Threads execute work items (a callable, args and kwargs) from a queue,
+    in the order submitted. The pool starts min_threads threads, and starts
+    more, up to max_threads, when work items are queued and no thread is
+    idle. Threads beyond min_threads exit after idle_timeout seconds idle.
 
     Attributes:
-      num_threads: An integer, the number of threads to use in the pool.
-      daemon_threads: A bool, iff True, threads are daemonised.
-      max_q_in_depth: An integer, the maximum queue depth.
-      full_sleep_time: A float, the thead sleep timer when the queue is full.
+      min_threads: An int, the number of threads kept when idle.
+      max_threads: An int, the maximum number of threads.
+      max_queue_depth: An int, the maximum number of queued work items, or
+        None for no limit.
+      idle_timeout: A float, the seconds a thread beyond min_threads may
+        be idle before it exits.
     """
 
-    def __init__(self, num_threads=DEFAULT_NUM_THREADS, daemon_threads=True,
-                 max_q_in_depth=None, full_sleep_time=None):
-        self.num_threads = num_threads
-        self.max_q_in_depth = max_q_in_depth
-        self.full_sleep_time = full_sleep_time or DEFAULT_QUEUE_FULL_SLEEP_TIME
-        if self.max_q_in_depth:
-            self._q_in = Queue.Queue(self.max_q_in_depth)
-        else:
-            self._q_in = Queue.Queue()
-        self._stopped = False
+    def __init__(self, max_threads=DEFAULT_MAX_THREADS, min_threads=0,
+                 max_queue_depth=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.min_threads = 0
+        self.max_threads = 1
+        self.max_queue_depth = max_queue_depth
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # Signalled when a work item is queued, or threads should exit.
+        self._work_ready = threading.Condition(self._lock)
+        # Signalled when a work item leaves a full queue.
+        self._not_full = threading.Condition(self._lock)
+        # (future, task, args, kwargs, submit time) tuples.
+        self._queue = collections.deque()
+        # Worker threads, keyed by name.
         self._threads = {}
-        for i in xrange(self.num_threads):
-            name = 'thread-%d' % i
-            self._threads[name] = threading.Thread(target=self._process_q,
-                                                   name=name)
-            self._threads[name].start()
+        self._idle = 0
+        self._running = 0
+        self._thread_count = 0
+        self._stopped = False
+        self._stats = {'submitted': 0,
+                       'completed': 0,
+                       'failed': 0,
+                       'rejected': 0,
+                       'queue_depth_max': 0,
+                       'threads_max': 0,
+                       'wait_time': 0.0,
+                       'wait_time_max': 0.0,
+                       'run_time': 0.0,
+                       'run_time_max': 0.0}
+        self.resize(min_threads, max_threads)
+
+    def resize(self, min_threads=None, max_threads=None):
+        """Changes the number of threads in the pool.
+
+        Threads beyond a reduced max_threads exit once their work item (if
+        any) is done.
 
-    def put(self, task, *args, **kwargs):
-        """Places a work item on the queue.
+        Args:
+          min_threads: An int, the new min_threads, or None to keep it.
+          max_threads: An int, the new max_threads, or None to keep it.
+
+        Raises:
+          ValueError: max_threads is less than 1 or min_threads.
+        """
+        self._lock.acquire()
+        try:
+            if min_threads is None:
+                min_threads = self.min_threads
+            if max_threads is None:
+                max_threads = self.max_threads
+            if max_threads < 1 or min_threads > max_threads:
+                raise ValueError('Invalid thread limits: min %r, max %r.'
+                                 % (min_threads, max_threads))
+            self.min_threads = max(0, min_threads)
+            self.max_threads = max_threads
+            while (not self._stopped and
+                   len(self._threads) < self.min_threads):
+                self._start_thread()
+            while (self._queue and self._idle < len(self._queue) and
+                   len(self._threads) < self.max_threads):
+                self._start_thread()
+            # Surplus idle threads notice and exit.
+            self._work_ready.notify_all()
+        finally:
+            self._lock.release()
+
+    def submit(self, task, *args, **kwargs):
+        """Queues a work item, waiting while the queue is full.
 
         Args:
           task: A callable to execute.
-          args: Non-keyword arguments.
-          kwargs: Keyword arguments, including 'block' (bool). If block is
-            True, block until the item is queued.  If False, exceptions raised.
+          args: Non-keyword arguments for the callable.
+          kwargs: Keyword arguments for the callable.
+
+        Returns:
+          A Future, for the work item's result.
 
         Raises:
-          Queue.Full: If the ThreadPool has a max_q_in_depth, this may occur
-          when not running in blocking mode.
+          StoppedError: The pool is stopped.
         """
-        while True:
-            try:
-                return self._q_in.put_nowait((task, args, kwargs))
-            except Queue.Full:
-                if 'block' in kwargs and kwargs['block']:
-                    time.sleep(self.full_sleep_time)
-                else:
-                    raise
+        return self._submit(task, args, kwargs, True)
+
+    def submit_nowait(self, task, *args, **kwargs):
+        """Queues a work item, like submit().
+
+        Raises:
+          Full: The queue is full.
+          StoppedError: The pool is stopped.
+        """
+        return self._submit(task, args, kwargs, False)
 
     def stop(self):
-        """Stops the ThreadPool."""
-        self._stopped = True
-        for thread in self._threads.itervalues():
+        """Stops the ThreadPool once queued work items are done."""
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._work_ready.notify_all()
+            self._not_full.notify_all()
+            threads = self._threads.values()
+        finally:
+            self._lock.release()
+        for thread in threads:
             thread.join()
 
-    def _process_q(self):
-        """Processes queue items; executed by worker threads."""
-        while not self._stopped:
-            try:
-                task, a, kwa = self._q_in.get(True, self.full_sleep_time)
-            except Queue.Empty:
-                continue
-            # During thread shutdown, Queue may == Null.
-            except AttributeError:
-                return
+    @property
+    def queue_depth(self):
+        """The number of work items waiting for a thread."""
+        return len(self._queue)
+
+    def stats(self):
+        """Returns the pool statistics.
+
+        Returns:
+          A dict of counters; work items 'submitted', 'completed' and
+          'failed' (completed by raising an exception), submissions
+          'rejected' (queue full), 'queue_depth_max' (the longest queue
+          seen), 'threads_max' (the most threads seen), the time work
+          items spent queued ('wait_time', the total, in seconds, and
+          'wait_time_max') and running ('run_time', 'run_time_max').
+          Also includes the 'queue_depth' and the number of 'threads',
+          'threads_idle' and 'threads_running' now, and the thread limits.
+        """
+        result = dict(self._stats)
+        result['queue_depth'] = len(self._queue)
+        result['threads'] = len(self._threads)
+        result['threads_idle'] = self._idle
+        result['threads_running'] = self._running
+        result['min_threads'] = self.min_threads
+        result['max_threads'] = self.max_threads
+        return result
+
+    def _submit(self, task, args, kwargs, block):
+        future = Future()
+        self._lock.acquire()
+        try:
+            while (not self._stopped and self.max_queue_depth and
+                   len(self._queue) >= self.max_queue_depth):
+                if not block:
+                    self._stats['rejected'] += 1
+                    raise Full
+                self._not_full.wait()
+            if self._stopped:
+                raise StoppedError('%s is stopped.' % self.__class__.__name__)
+            self._queue.append((future, task, args, kwargs, time.time()))
+            self._stats['submitted'] += 1
+            if len(self._queue) > self._stats['queue_depth_max']:
+                self._stats['queue_depth_max'] = len(self._queue)
+            if (self._idle < len(self._queue) and
+                len(self._threads) < self.max_threads):
+                self._start_thread()
+            self._work_ready.notify()
+        finally:
+            self._lock.release()
+        return future
+
+    def _start_thread(self):
+        """Starts a worker thread; called with the lock held."""
+        name = 'thread-%d' % self._thread_count
+        self._thread_count += 1
+        thread = threading.Thread(target=self._process_q, name=name,
+                                  args=(name,))
+        thread.setDaemon(True)
+        self._threads[name] = thread
+        if len(self._threads) > self._stats['threads_max']:
+            self._stats['threads_max'] = len(self._threads)
+        thread.start()
+
+    def _wake_idle(self):
+        """Wakes idle threads, so that those idle too long exit."""
+        self._lock.acquire()
+        try:
+            self._work_ready.notify_all()
+        finally:
+            self._lock.release()
+
+    def _next_item(self):
+        """Returns the next work item, or None if this thread should exit.
+
+        Called with the lock held.
+        """
+        idle_since = time.time()
+        while True:
+            surplus = len(self._threads) > self.max_threads
+            if self._queue and not surplus:
+                item = self._queue.popleft()
+                self._not_full.notify()
+                return item
+            if self._stopped or surplus:
+                return None
+            if len(self._threads) > self.min_threads:
+                remaining = idle_since + self.idle_timeout - time.time()
+                if remaining <= 0:
+                    return None
+                timer = eventlet.spawn_after(remaining, self._wake_idle)
+            else:
+                timer = None
+            self._idle += 1
             try:
-                # Execute the work item. pylint: disable-msg=W0142
-                task(*a, **kwa)
-            # Log but don't raise exceptions. pylint: disable-msg=W0703
-            except Exception, e:
-                logging.error('Unhandled exception occured in %s. %s: %s\n%s',
-                              self.__class__.__name__,
-                              str(e.__class__), str(e),
-                              traceback.format_exc())
+                self._work_ready.wait()
+            finally:
+                self._idle -= 1
+                if timer is not None:
+                    timer.cancel()
+
+    def _process_q(self, name):
+        """Processes queue items; executed by worker threads."""
+        self._lock.acquire()
+        try:
+            while True:
+                item = self._next_item()
+                if item is None:
+                    return
+                future, task, args, kwargs, submitted = item
+                self._running += 1
+                self._lock.release()
+                start = time.time()
+                exc_info = None
+                try:
+                    try:
+                        # Execute the work item. pylint: disable-msg=W0142
+                        future._set_result(task(*args, **kwargs))
+                        failed = False
+                    # Deliver exceptions to the future. pylint: disable-msg=W0703
+                    except Exception:
+                        future._set_exc_info(sys.exc_info())
+                        failed = True
+                    # Others (e.g., greenlet.GreenletExit) end the thread,
+                    # once waiters have been released.
+                    except BaseException:
+                        exc_info = sys.exc_info()
+                        future._set_exc_info(exc_info)
+                        failed = True
+                finally:
+                    end = time.time()
+                    self._lock.acquire()
+                    self._running -= 1
+                self._record(start - submitted, end - start, failed)
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            del self._threads[name]
+            # Replace a thread ended by an exception, if work remains.
+            if (not self._stopped and self._idle < len(self._queue) and
+                len(self._threads) < self.max_threads):
+                self._start_thread()
+            self._lock.release()
+
+    def _record(self, wait_time, run_time, failed):
+        """Records a work item's statistics; called with the lock held."""
+        self._stats['completed'] += 1
+        if failed:
+            self._stats['failed'] += 1
+        self._stats['wait_time'] += wait_time
+        if wait_time > self._stats['wait_time_max']:
+            self._stats['wait_time_max'] = wait_time
+        self._stats['run_time'] += run_time
+        if run_time > self._stats['run_time_max']:
+            self._stats['run_time_max'] = run_time
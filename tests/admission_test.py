@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the admission module."""
+
+
+import mox
+import time
+import unittest
+
+from notch.agent import admission
+from notch.agent import errors
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = mox.stubout.StubOutForTesting()
+        self.clock = FakeClock()
+        self.stubs.Set(time, 'time', self.clock.time)
+        self.control = admission.AdmissionControl(
+            max_pending=4, max_device_pending=2, target_delay=1.0,
+            interval=10.0)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def testPendingLimits(self):
+        first = self.control.admit('rtr1')
+        self.control.admit('rtr1')
+        self.assertRaises(errors.OverloadedError, self.control.admit, 'rtr1')
+        self.control.admit('rtr2')
+        self.control.admit(None)
+        self.assertRaises(errors.OverloadedError, self.control.admit, 'rtr3')
+        first.start()
+        first.done()
+        first.done()
+        self.control.admit('rtr1')
+        stats = self.control.stats()
+        self.assertEqual(stats['pending'], 4)
+        self.assertEqual(stats['waiting'], 4)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['rejected_device'], 1)
+
+    def testNoSheddingBelowTarget(self):
+        for _ in range(3):
+            ticket = self.control.admit()
+            self.clock.now += 0.5
+            ticket.start()
+            ticket.done()
+        self.assertEqual(self.control.stats()['shed'], 0)
+
+    def testShedsAfterIntervalAboveTarget(self):
+        tickets = [self.control.admit() for _ in range(4)]
+        self.clock.now += 5.0
+        # Above target, but not yet for an interval.
+        tickets[0].start()
+        self.clock.now += 11.0
+        self.assertRaises(errors.OverloadedError, tickets[1].start)
+        self.assert_(self.control.stats()['shedding'])
+        # The next shedding is an interval later.
+        tickets[2].start()
+        self.control.admit()
+        self.clock.now += 10.0
+        self.assertRaises(errors.OverloadedError, tickets[3].start)
+        stats = self.control.stats()
+        self.assertEqual(stats['shed'], 2)
+        # Shed requests are done; the others are still pending.
+        self.assertEqual(stats['pending'], 3)
+        self.assertEqual(stats['waiting'], 1)
+
+    def testSheddingStopsBelowTarget(self):
+        tickets = [self.control.admit() for _ in range(3)]
+        self.clock.now += 5.0
+        tickets[0].start()
+        self.clock.now += 11.0
+        self.assertRaises(errors.OverloadedError, tickets[1].start)
+        self.assert_(self.control.stats()['shedding'])
+        # A request which did not wait ends the shedding.
+        ticket = self.control.admit()
+        ticket.start()
+        self.failIf(self.control.stats()['shedding'])
+
+    def testRestart(self):
+        ticket = self.control.admit()
+        self.control.admit()
+        self.clock.now += 20.0
+        # The wait before the restart is not part of the delay.
+        ticket.restart()
+        ticket.start()
+        self.assertEqual(self.control.stats()['delay_max'], 0.0)
+
+    def testStartBound(self):
+        ticket = self.control.admit()
+        admission.start_bound()
+        self.assertEqual(self.control.stats()['waiting'], 1)
+        admission.bind(ticket)
+        try:
+            self.clock.now += 0.5
+            admission.start_bound()
+        finally:
+            admission.bind(None)
+        stats = self.control.stats()
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['delay_max'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the circuit_breaker module."""
+
+
+import eventlet
+import unittest
+
+from notch.agent import circuit_breaker
+from notch.agent import errors
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.probes = []
+        self.probe_errors = []
+        self.breaker = circuit_breaker.CircuitBreaker(
+            self.probe, failure_threshold=2, initial_backoff=0.01,
+            max_backoff=0.03)
+
+    def tearDown(self):
+        self.breaker.reset()
+
+    def probe(self, device_name):
+        self.probes.append(device_name)
+        if self.probe_errors:
+            raise self.probe_errors.pop(0)
+
+    def testOpensAfterThreshold(self):
+        self.breaker.check('rtr1')
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.check('rtr1')
+        self.breaker.failure('rtr1', errors.ConnectError('no route'))
+        self.assertRaises(errors.ConnectError, self.breaker.check, 'rtr1')
+        self.breaker.check('rtr2')
+        stats = self.breaker.stats()
+        self.assertEqual(stats['open'], 1)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['devices']['rtr1']['state'],
+                         circuit_breaker.OPEN)
+        self.assertEqual(stats['devices']['rtr1']['message'], 'no route')
+
+    def testSuccessResetsFailures(self):
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.success('rtr1')
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.check('rtr1')
+        # A device at its session limit is reachable.
+        self.breaker.failure('rtr1', errors.SessionLimitError('busy'))
+        self.assertEqual(self.breaker.stats()['devices'], {})
+
+    def testProbeCloses(self):
+        self.probe_errors = [errors.ConnectError('still down')]
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        eventlet.sleep(0.015)
+        # The first probe failed; the next waits twice as long.
+        self.assertEqual(self.probes, ['rtr1'])
+        self.assertRaises(errors.ConnectError, self.breaker.check, 'rtr1')
+        self.assertEqual(
+            self.breaker.stats()['devices']['rtr1']['message'], 'still down')
+        eventlet.sleep(0.03)
+        self.assertEqual(self.probes, ['rtr1', 'rtr1'])
+        self.breaker.check('rtr1')
+        stats = self.breaker.stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['closed'], 1)
+        self.assertEqual(stats['probes'], 2)
+        self.assertEqual(stats['open'], 0)
+
+    def testBackoffLimit(self):
+        self.probe_errors = [errors.ConnectError('down')] * 10
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        eventlet.sleep(0.1)
+        circuit = self.breaker._circuits['rtr1']
+        self.assertEqual(circuit.backoff, 0.03)
+
+    def testDisabled(self):
+        self.breaker.failure_threshold = 0
+        for _ in range(5):
+            self.breaker.failure('rtr1', errors.ConnectError('refused'))
+        self.breaker.check('rtr1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the connect_limiter module."""
+
+
+import eventlet
+import unittest
+
+from notch.agent import connect_limiter
+from notch.agent import errors
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def testTake(self):
+        bucket = connect_limiter.TokenBucket(rate=10.0, burst=2)
+        self.assertEqual(bucket.take(), 0.0)
+        self.assertEqual(bucket.take(), 0.0)
+        self.failIf(bucket.full)
+        delay = bucket.take()
+        self.assert_(0.05 < delay <= 0.1, delay)
+
+
+class ConnectLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = connect_limiter.ConnectLimiter(
+            max_connecting=3, max_prefix_connecting=2, device_rate=0,
+            max_wait=1.0)
+        self.order = []
+
+    def connect(self, device_name, address):
+        self.limiter.acquire(device_name, address)
+        self.order.append(device_name)
+
+    def testPrefix(self):
+        self.assertEqual(self.limiter.prefix('10.1.2.3'), '10.1.2.0')
+        self.assertEqual(self.limiter.prefix('2001:db8::1:1'), '2001:db8::')
+
+    def testLimits(self):
+        self.connect('a1', '10.0.0.1')
+        self.connect('a2', '10.0.0.2')
+        self.connect('b1', '10.0.1.1')
+        waiters = [eventlet.spawn(self.connect, name, address)
+                   for name, address in (('a3', '10.0.0.3'),
+                                         ('b2', '10.0.1.2'),
+                                         ('c1', '10.0.2.1'))]
+        eventlet.sleep(0)
+        self.assertEqual(self.limiter.stats()['waiting'], 3)
+        # a3's prefix is still full, so b2 is granted in its place.
+        self.limiter.release('10.0.1.1')
+        eventlet.sleep(0)
+        self.assertEqual(self.order[3:], ['b2'])
+        self.limiter.release('10.0.0.1')
+        self.limiter.release('10.0.1.2')
+        for waiter in waiters:
+            waiter.wait()
+        self.assertEqual(self.order[3:], ['b2', 'a3', 'c1'])
+        stats = self.limiter.stats()
+        self.assertEqual(stats['connecting'], 3)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['granted'], 6)
+        self.assertEqual(stats['waited'], 3)
+
+    def testTimeout(self):
+        self.limiter.max_wait = 0.01
+        self.connect('a1', '10.0.0.1')
+        self.connect('a2', '10.0.0.2')
+        self.assertRaises(errors.ConnectError,
+                          self.limiter.acquire, 'a3', '10.0.0.3')
+        stats = self.limiter.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['connecting'], 2)
+
+    def testDeviceRate(self):
+        self.limiter.device_rate = 20.0
+        self.limiter.device_burst = 1
+        self.connect('a1', '10.0.0.1')
+        self.limiter.release('10.0.0.1')
+        self.connect('a1', '10.0.0.1')
+        self.limiter.release('10.0.0.1')
+        self.connect('a2', '10.0.0.2')
+        stats = self.limiter.stats()
+        self.assertEqual(stats['rate_limited'], 1)
+        self.assert_(stats['wait_time_max'] >= 0.04, stats['wait_time_max'])
+
+
+if __name__ == '__main__':
+    unittest.main()
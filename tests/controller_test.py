@@ -16,14 +16,20 @@
 
 """Tests for the controller module."""
 
+import eventlet
+import eventlet.event
 import ipaddr
 import mox
+import time
 import unittest
 
 from notch.agent import device_manager
 from notch.agent import errors
 from notch.agent import controller
+from notch.agent import circuit_breaker
+from notch.agent import connect_limiter
 from notch.agent import credential
+from notch.agent import lru
 from notch.agent import session
 from notch.agent.devices import device
 
@@ -120,6 +126,28 @@ class TestController(unittest.TestCase):
         self.assertEqual(resp, '# show run output.')
         self.mock.VerifyAll()
 
+    def testRequestBatch(self):
+        sk = session.SessionKey(device_name='xr1.foo',
+                                connect_method='sshv2',
+                                user='anonymous',
+                                privilege_level='ro')
+        arguments = [{'command': 'show run'}, {'command': 'show ver'}]
+        sess = self.mock.CreateMock(session.Session)
+        sess.request_batch('command', arguments, stop_on_error=False,
+                           max_wait_time=None, encoding=None
+                           ).AndReturn([{'result': 'a'}, {'result': 'b'}])
+
+        self.mock.ReplayAll()
+        self.controller.sessions = {sk: sess}
+        resp = self.controller.request_batch('command', arguments,
+                                             stop_on_error=False,
+                                             device_name='xr1.foo',
+                                             connect_method='sshv2',
+                                             user='anonymous',
+                                             privilege_level='ro')
+        self.assertEqual(resp, [{'result': 'a'}, {'result': 'b'}])
+        self.mock.VerifyAll()
+
     def testRequestNoDeviceName(self):
         sk = session.SessionKey(device_name=None,
                                 connect_method=None,
@@ -146,6 +174,279 @@ class TestController(unittest.TestCase):
                           'command', command='show run', device_name='___')
         self.mock.VerifyAll()
 
+    def testCreateSessionPool(self):
+        sk = session.SessionKey(device_name='xr1.foo',
+                                connect_method='sshv2',
+                                user='anonymous',
+                                privilege_level='ro')
+        dev1 = device_manager.DeviceInfo(device_name='xr1.foo',
+                                         device_type='juniper',
+                                         addresses=('10.0.0.1', ))
+        self.controller = controller.Controller(
+            {'options': {'session_pool_sizes': {'xr1.foo': 3}}})
+        self.dm = self.mock.CreateMock(device_manager.DeviceManager)
+        self.controller.device_manager = self.dm
+        self.dm.device_info('xr1.foo').AndReturn(dev1)
+        self.mock.ReplayAll()
+        sess = self.controller.create_session(sk)
+        self.assert_(isinstance(sess, session.SessionPool))
+        self.assertEqual(sess.max_sessions, 3)
+        self.assertEqual(sess.device.name, 'xr1.foo')
+        self.assertEqual(sess.connected, False)
+        self.mock.VerifyAll()
+
+    def testCreateSessionPoolSizeByVendor(self):
+        for device_type, pool in (('cisco', True), ('nortel_esr', False)):
+            sk = session.SessionKey(device_name='rtr1.foo',
+                                    connect_method='sshv2',
+                                    user='anonymous',
+                                    privilege_level='ro')
+            dev1 = device_manager.DeviceInfo(device_name='rtr1.foo',
+                                             device_type=device_type,
+                                             addresses=('10.0.0.1', ))
+            self.controller = controller.Controller({})
+            self.dm = self.mock.CreateMock(device_manager.DeviceManager)
+            self.controller.device_manager = self.dm
+            self.dm.device_info('rtr1.foo').AndReturn(dev1)
+            self.mock.ReplayAll()
+            sess = self.controller.create_session(sk)
+            self.assertEqual(isinstance(sess, session.SessionPool), pool)
+            if pool:
+                self.assertEqual(sess.max_sessions, 2)
+            self.mock.VerifyAll()
+            self.mock.ResetAll()
+
+    def testCreateSessionChannelLimit(self):
+        sk = session.SessionKey(device_name='mx1.foo',
+                                connect_method='sshv2',
+                                user='anonymous',
+                                privilege_level='ro')
+        dev1 = device_manager.DeviceInfo(device_name='mx1.foo',
+                                         device_type='juniper',
+                                         addresses=('10.0.0.1', ))
+        self.controller = controller.Controller(
+            {'options': {'session_channel_limits': {'mx1.foo': 8}}})
+        self.dm = self.mock.CreateMock(device_manager.DeviceManager)
+        self.controller.device_manager = self.dm
+        self.dm.device_info('mx1.foo').AndReturn(dev1)
+        self.mock.ReplayAll()
+        sess = self.controller.create_session(sk)
+        self.assert_(isinstance(sess, session.Session))
+        self.assertEqual(sess.stats()['queue']['capacity'], 8)
+        self.mock.VerifyAll()
+
+    def testRequestMatching(self):
+        self.dm = self.mock.CreateMock(device_manager.DeviceManager)
+        self.controller.device_manager = self.dm
+        self.dm.devices_matching('^xr.*').AndReturn(
+            set(['xr1.foo', 'xr2.foo']))
+        self.mock.StubOutWithMock(self.controller, 'request')
+        self.controller.request('command', device_name='xr1.foo',
+                                command='show ver').AndReturn('ver1')
+        self.controller.request('command', device_name='xr2.foo',
+                                command='show ver').AndRaise(
+            errors.ConnectError('refused'))
+        self.mock.ReplayAll()
+        results = list(self.controller.request_matching(
+            'command', regexp='^xr.*', concurrency=1, command='show ver'))
+        self.assertEqual(results,
+                         [{'device_name': 'xr1.foo', 'result': 'ver1'},
+                          {'device_name': 'xr2.foo', 'error': 'ConnectError',
+                           'message': 'refused'}])
+        self.mock.VerifyAll()
+
+    def testRequestMatchingDedupe(self):
+        self.dm = self.mock.CreateMock(device_manager.DeviceManager)
+        self.controller.device_manager = self.dm
+        self.dm.devices_matching('^sw.*').AndReturn(
+            set(['sw1.foo', 'sw2.foo', 'sw3.foo']))
+        self.mock.StubOutWithMock(self.controller, 'request')
+        for name, output in (('sw1.foo', 'sw1 v1.0'), ('sw2.foo', 'sw2 v1.0'),
+                             ('sw3.foo', 'sw3 v2.0')):
+            self.controller.request('command', device_name=name,
+                                    command='show ver', encoding='raw'
+                                    ).AndReturn(output)
+        self.mock.ReplayAll()
+        results = list(self.controller.request_matching(
+            'command', regexp='^sw.*', concurrency=1, command='show ver',
+            encoding='raw', dedupe=True, normalise_hostname=True))
+        self.assertEqual([r['device_name'] for r in results],
+                         ['sw1.foo', 'sw2.foo', 'sw3.foo'])
+        self.assertEqual(results[0]['result'], 'sw1 v1.0')
+        self.assertEqual(results[1]['hash'], results[0]['hash'])
+        self.assert_('result' not in results[1])
+        self.assertEqual(results[2]['result'], 'sw3 v2.0')
+        self.assertNotEqual(results[2]['hash'], results[0]['hash'])
+        self.mock.VerifyAll()
+
+    def testRequestMatchingInvalidArguments(self):
+        self.assertRaises(errors.InvalidRequestError,
+                          self.controller.request_matching, 'command',
+                          command='show ver')
+        self.assertRaises(errors.InvalidRequestError,
+                          self.controller.request_matching, 'command',
+                          regexp='.*', concurrency='many')
+
+    def testRequestResultCache(self):
+        self.controller = controller.Controller(
+            {'options': {'result_cache': {'ttls': [['^show ver', 60]]}}})
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco',
+                                  password='router')]
+        sk = session.SessionKey(device_name='xr1.foo', connect_method=None,
+                                user=None, privilege_level=None)
+        sess = self.mock.CreateMock(session.Session)
+        sess.request('command', command='show ver',
+                     device_name='xr1.foo').AndReturn('ver1')
+        sess.request('set_config', destination='running-config',
+                     source='x', device_name='xr1.foo').AndReturn('')
+        sess.request('command', command='show ver',
+                     device_name='xr1.foo').AndReturn('ver2')
+        self.mock.ReplayAll()
+        self.controller.sessions = {sk: sess}
+        request = lambda: self.controller.request(
+            'command', command='show ver', device_name='xr1.foo')
+        self.assertEqual(request(), 'ver1')
+        self.assertEqual(request(), 'ver1')
+        self.controller.request('set_config', destination='running-config',
+                                source='x', device_name='xr1.foo')
+        self.assertEqual(request(), 'ver2')
+        self.assertEqual(self.controller.request(
+            'command', command='show ver', device_name='xr1.foo',
+            max_age=60), 'ver2')
+        self.assertRaises(errors.InvalidRequestError,
+                          self.controller.request, 'command',
+                          command='show ver', device_name='xr1.foo',
+                          max_age='old')
+        stats = self.controller.result_cache.stats()
+        self.assertEqual(stats['invalidations'], 1)
+        self.mock.VerifyAll()
+
+    def testRequestResultCacheChangedWhilstReading(self):
+        self.controller = controller.Controller(
+            {'options': {'result_cache': {'ttls': [['^show ver', 60]]}}})
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco',
+                                  password='router')]
+        sk = session.SessionKey(device_name='xr1.foo', connect_method=None,
+                                user=None, privilege_level=None)
+        sess = self.mock.CreateMock(session.Session)
+        release = eventlet.event.Event()
+        sess.request('command', command='show ver', device_name='xr1.foo'
+                     ).WithSideEffects(lambda *a, **k: release.wait()
+                                       ).AndReturn('ver1')
+        sess.request('set_config', destination='running-config',
+                     source='x', device_name='xr1.foo').AndReturn('')
+        sess.request('command', command='show ver',
+                     device_name='xr1.foo').AndReturn('ver2')
+        self.mock.ReplayAll()
+        self.controller.sessions = {sk: sess}
+        request = lambda: self.controller.request(
+            'command', command='show ver', device_name='xr1.foo')
+        reader = eventlet.spawn(request)
+        eventlet.sleep(0)
+        self.controller.request('set_config', destination='running-config',
+                                source='x', device_name='xr1.foo')
+        release.send()
+        # The slow read's response predates the change; it is not cached.
+        self.assertEqual(reader.wait(), 'ver1')
+        self.assertEqual(request(), 'ver2')
+        self.assertEqual(request(), 'ver2')
+        self.mock.VerifyAll()
+
+    def testRequestCoalescing(self):
+        sk = session.SessionKey(device_name='xr1.foo', connect_method=None,
+                                user=None, privilege_level=None)
+        sess = self.mock.CreateMock(session.Session)
+        release = eventlet.event.Event()
+        sess.request('command', command='show ver', device_name='xr1.foo'
+                     ).WithSideEffects(lambda *a, **k: release.wait()
+                                       ).AndReturn('ver1')
+        fail = eventlet.event.Event()
+        sess.request('command', command='show ver', device_name='xr1.foo'
+                     ).WithSideEffects(lambda *a, **k: fail.wait()
+                                       ).AndRaise(errors.CommandError('EOF'))
+        self.mock.ReplayAll()
+        self.controller.sessions = lru.LruDict()
+        self.controller.sessions[sk] = sess
+        request = lambda: self.controller.request(
+            'command', command='show ver', device_name='xr1.foo')
+        first = eventlet.spawn(request)
+        eventlet.sleep(0)
+        second = eventlet.spawn(request)
+        eventlet.sleep(0)
+        self.assertEqual(self.controller.cache_stats()['in_flight'],
+                         {'requests': 1, 'coalesced': 1})
+        release.send()
+        self.assertEqual(first.wait(), 'ver1')
+        self.assertEqual(second.wait(), 'ver1')
+        # Errors are delivered to every waiter.
+        first = eventlet.spawn(request)
+        eventlet.sleep(0)
+        second = eventlet.spawn(request)
+        eventlet.sleep(0)
+        fail.send()
+        self.assertRaises(errors.CommandError, first.wait)
+        self.assertRaises(errors.CommandError, second.wait)
+        self.assertEqual(self.controller.cache_stats()['in_flight'],
+                         {'requests': 0, 'coalesced': 2})
+        self.mock.VerifyAll()
+
+    def testRpcWorkers(self):
+        self.assertEqual(self.controller.rpc_workers, controller.RPC_WORKERS)
+        self.assertEqual(controller.Controller(
+            {'options': {'rpc_workers': '16'}}).rpc_workers, 16)
+        self.assertEqual(controller.Controller(
+            {'options': {'rpc_workers': 'lots'}}).rpc_workers,
+                         controller.RPC_WORKERS)
+
+    def testRpcBatchConcurrency(self):
+        self.assertEqual(self.controller.rpc_batch_concurrency,
+                         controller.RPC_BATCH_CONCURRENCY)
+        self.assertEqual(controller.Controller(
+            {'options': {'rpc_batch_concurrency': '4'}}
+            ).rpc_batch_concurrency, 4)
+        self.assertEqual(controller.Controller(
+            {'options': {'rpc_batch_concurrency': 0}}
+            ).rpc_batch_concurrency, 1)
+
+    def testConnectLimits(self):
+        c = controller.Controller(
+            {'options': {'connect_limits': {'max_connecting': '8',
+                                            'device_rate': 'fast'}}})
+        self.assertEqual(c.connect_limiter.max_connecting, 8)
+        self.assertEqual(c.connect_limiter.device_rate,
+                         connect_limiter.DEFAULT_DEVICE_RATE)
+        self.assertEqual(c.connect_stats()['max_connecting'], 8)
+
+    def testCircuitBreaker(self):
+        c = controller.Controller(
+            {'options': {'circuit_breaker': {'failure_threshold': '5',
+                                             'max_backoff': 'never'}}})
+        self.assertEqual(c.circuit_breaker.failure_threshold, 5)
+        self.assertEqual(c.circuit_breaker.max_backoff,
+                         circuit_breaker.DEFAULT_MAX_BACKOFF)
+        self.assertEqual(c.circuit_stats()['open'], 0)
+
+    def testCacheStats(self):
+        stats = self.controller.cache_stats()
+        self.assertEqual(stats['sessions']['size'], 0)
+        self.assertEqual(stats['sessions']['maximum_size'],
+                         controller.MAX_ACTIVE_SESSIONS)
+        self.assertEqual(stats['device_matches'], {})
+
+    def testSessionStats(self):
+        sk = self.testSessionKey()
+        self.controller.sessions = {sk: session.Session()}
+        stats = self.controller.session_stats()
+        self.assertEqual(stats.keys(), ['xr1.foo'])
+        self.assertEqual(len(stats['xr1.foo']), 1)
+        self.assertEqual(stats['xr1.foo'][0]['user'], 'anonymous')
+        self.assertEqual(stats['xr1.foo'][0]['connected'], False)
+        self.assertEqual(stats['xr1.foo'][0]['queue']['waiting'], 0)
+
     def testExpireSession(self):
         dev = self.mock.CreateMock(device.Device)
         dev.name = 'xr1.foo'
@@ -161,6 +462,45 @@ class TestController(unittest.TestCase):
         # No value assertions, just confirm all the device calls are made.
         self.mock.VerifyAll()
 
+    def testExpireBusySession(self):
+        dev = self.mock.CreateMock(device.Device)
+        self.mock.ReplayAll()
+        sess = session.Session(device=dev)
+        sess._connected = True
+        sess.idle = False
+        self.assertRaises(lru.DontExpireError,
+                          self.controller.expire_session, None, sess)
+        self.assertEqual(self.controller.session_eviction_cost(None, sess),
+                         float('inf'))
+        # No device calls (e.g., disconnect) are expected.
+        self.mock.VerifyAll()
+
+    def testSessionEvictionCost(self):
+        cheap = session.Session()
+        cheap._connected = True
+        cheap.connect_cost = 0.2
+        cheap.time_last_request = time.time() - 10.0
+        expensive = session.Session()
+        expensive._connected = True
+        expensive.connect_cost = 8.0
+        expensive.time_last_request = time.time() - 10.0
+        disconnected = session.Session()
+        self.assertEqual(
+            self.controller.session_eviction_cost(None, disconnected), 0.0)
+        self.assert_(self.controller.session_eviction_cost(None, cheap) <
+                     self.controller.session_eviction_cost(None, expensive))
+        # Idle sessions become cheaper to evict.
+        expensive.time_last_request = time.time() - 1000.0
+        self.assert_(self.controller.session_eviction_cost(None, expensive) <
+                     self.controller.session_eviction_cost(None, cheap))
+
+    def testMaxActiveSessionsFromConfig(self):
+        c = controller.Controller({'options': {'max_active_sessions': 3}})
+        self.assertEqual(c.sessions.maximum_size, 3)
+        c = controller.Controller({'options': {'max_active_sessions': 'x'}})
+        self.assertEqual(c.sessions.maximum_size,
+                         controller.MAX_ACTIVE_SESSIONS)
+
     def testRunMaintenanceWithDisconnectableSession(self):
         dev = self.mock.CreateMock(device.Device)
         dev.MAX_IDLE_TIME = 300.0
@@ -176,9 +516,34 @@ class TestController(unittest.TestCase):
         sess.time_last_request = 1.0
 
         self.controller.sessions = {self.testSessionKey(): sess}
+        self.controller.schedule_idle_check(sess)
         self.assertTrue(sess.connected)
         self.controller.run_maintenance()
         self.assertFalse(sess.connected)
+        self.assertEqual(self.controller._idle_deadlines, [])
+        self.mock.VerifyAll()
+
+    def testRunMaintenanceWithRecentlyUsedSession(self):
+        dev = self.mock.CreateMock(device.Device)
+        dev.MAX_IDLE_TIME = 300.0
+        dev.name = 'xr1.foo'
+        self.mock.ReplayAll()
+        self.controller._stopped.send()
+
+        sess = session.Session(device=dev)
+        sess._connected = True
+        sess.time_last_request = 1.0
+        self.controller.schedule_idle_check(sess)
+        # Scheduling again does not add another deadline.
+        self.controller.schedule_idle_check(sess)
+        self.assertEqual(len(self.controller._idle_deadlines), 1)
+        # A request since scheduling moves the deadline into the future.
+        sess.time_last_request = time.time()
+        self.controller.run_maintenance()
+        self.assertTrue(sess.connected)
+        self.assertEqual(len(self.controller._idle_deadlines), 1)
+        self.assertEqual(self.controller._idle_deadlines[0][0],
+                         sess.time_last_request + 300.0)
         self.mock.VerifyAll()
 
 
@@ -74,6 +74,20 @@ class DeviceManagerTest(unittest.TestCase):
         self.assertEqual(None, self.device_manager.provider(None))
         self.assertEqual(None, self.device_manager.provider(0))
 
+    def testCacheStats(self):
+        config = notch_config.get_config_from_file(
+            os.path.join(TESTDATA, 'notch_config.yaml'))
+        self.device_manager = device_manager.DeviceManager(config)
+        provider = self.device_manager.provider('old_rancid_configs')
+        provider.ready = True
+        self.device_manager.devices_matching('xr.*')
+        self.device_manager.devices_matching('xr.*')
+        stats = self.device_manager.cache_stats()
+        self.assertEqual(stats.keys(), ['old_rancid_configs'])
+        self.assertEqual(stats['old_rancid_configs']['hits'], 1)
+        self.assertEqual(stats['old_rancid_configs']['misses'], 1)
+        self.assertEqual(stats['old_rancid_configs']['size'], 1)
+
     def testAddProviders(self):
         self.device_manager = device_manager.DeviceManager({})
         self.device_manager.add_providers(None)
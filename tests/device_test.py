@@ -16,15 +16,53 @@
 
 """Tests for the device module."""
 
+import errno
 import ipaddr
+import os
+import socket
 
+import eventlet
 import mox
 import unittest
 
+from notch.agent import circuit_breaker
+from notch.agent import connect_limiter
+from notch.agent import device_factory
 from notch.agent import errors
+from notch.agent.devices import dev_paramiko
 from notch.agent.devices import device
 
 
+class FakeChannel(object):
+    """A paramiko channel whose output arrives over a pipe."""
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.read_fd, self.write_fd = os.pipe()
+        self.closed = False
+
+    def fileno(self):
+        return self.read_fd
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv(self, nbytes):
+        return os.read(self.read_fd, nbytes)
+
+    def makefile(self):
+        return FakeChannelFile(self)
+
+
+class FakeChannelFile(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def close(self):
+        self.channel.closed = True
+
+
 class TestDevice(unittest.TestCase):
     """Tests concrete methods in device.Device().
 
@@ -62,6 +100,21 @@ class TestDevice(unittest.TestCase):
         self.assertFalse(dev.connected)
         self.mock.VerifyAll()
 
+    def testDeviceCommandsSequential(self):
+        dev = device.Device(name='xr1', addresses='10.0.0.1')
+        self.mock.StubOutWithMock(dev, '_command')
+        dev._command('sh ver', mode=None).AndReturn('ver')
+        dev._command('bogus', mode=None).AndRaise(
+            errors.CommandError('Invalid input'))
+        self.mock.ReplayAll()
+        try:
+            dev.commands(['sh ver', 'bogus', 'sh clock'])
+        except errors.CommandError, e:
+            self.assertEqual(e.responses, ['ver'])
+        else:
+            self.fail('CommandError not raised')
+        self.mock.VerifyAll()
+
     def testDeviceAddressesProperty(self):
         dev = device.Device()
         self.assertEqual(dev.addresses, [])
@@ -108,6 +161,101 @@ class TestDevice(unittest.TestCase):
         self.assertEqual(fake_dev.addresses, [])
         self.assertRaises(errors.DeviceWithoutAddressError, fake_dev.connect)
 
+    def testDeviceConnectCircuitBreaker(self):
+        attempts = []
+
+        class UnreachableDevice(device.Device):
+
+            def _connect(self, **kwargs):
+                attempts.append(kwargs['address'])
+                raise OSError(errno.EHOSTUNREACH, 'No route to host')
+
+        dev = UnreachableDevice(name='rtr1', addresses=['10.0.0.1'])
+        dev.circuit_breaker = circuit_breaker.CircuitBreaker(
+            None, failure_threshold=2, initial_backoff=60.0)
+        for _ in range(3):
+            self.assertRaises(errors.ConnectError, dev.connect)
+        # The circuit opened after the second attempt.
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(dev.circuit_breaker.stats()['rejected'], 1)
+        dev.circuit_breaker.reset()
+
+    def testDeviceConnectChargesRateLimitOnce(self):
+        dev = device.Device(name='rtr1', addresses=['10.0.0.1', '10.0.0.2'])
+        dev.connect_limiter = connect_limiter.ConnectLimiter(
+            device_rate=0.01, device_burst=1)
+        self.mock.StubOutWithMock(dev, '_connect')
+        dev._connect(address=mox.IgnoreArg(), credential=None,
+                     connect_method=None).AndRaise(
+            OSError(errno.ECONNREFUSED, 'Connection refused'))
+        dev._connect(address=mox.IgnoreArg(), credential=None,
+                     connect_method=None)
+        self.mock.ReplayAll()
+        dev.connect()
+        self.mock.VerifyAll()
+        stats = dev.connect_limiter.stats()
+        self.assertEqual(stats['granted'], 2)
+        self.assertEqual(stats['rate_limited'], 0)
+        self.assertEqual(stats['connecting'], 0)
+
+    def testParamikoReconnectLimited(self):
+        dev = dev_paramiko.ParamikoDevice(name='rtr1', addresses=['10.0.0.1'])
+        dev.connect_limiter = connect_limiter.ConnectLimiter()
+        dev.circuit_breaker = circuit_breaker.CircuitBreaker(
+            None, failure_threshold=1, initial_backoff=60.0)
+        self.mock.StubOutWithMock(dev, '_connect')
+        dev._connect(address=mox.IgnoreArg(), credential=None,
+                     connect_method='sshv2')
+        dev._connect(address=mox.IgnoreArg(), credential=None,
+                     connect_method='sshv2').AndRaise(
+            errors.ConnectError('Connection refused'))
+        self.mock.ReplayAll()
+        dev.connect()
+        self.assertRaises(errors.ConnectError, dev._reconnect)
+        # The circuit is open; reconnection fails without connecting.
+        self.assertRaises(errors.ConnectError, dev._reconnect)
+        self.mock.VerifyAll()
+        self.assertEqual(dev.connect_limiter.stats()['granted'], 2)
+        self.assertEqual(dev.circuit_breaker.stats()['rejected'], 1)
+        dev.circuit_breaker.reset()
+
+    def _stubChannel(self, dev, channel):
+        self.mock.StubOutWithMock(dev, '_exec_command')
+        dev._exec_command('sh ver', combine_stderr=True).AndReturn(
+            (channel.makefile(), channel.makefile(), channel.makefile()))
+        self.mock.ReplayAll()
+
+    def testParamikoOutputGreen(self):
+        dev = dev_paramiko.ParamikoDevice(name='rtr1', addresses=['10.0.0.1'])
+        channel = FakeChannel()
+        self._stubChannel(dev, channel)
+        reader = eventlet.spawn(list, dev._command_iter('sh ver'))
+        # Other greenthreads run whilst the reader waits for output.
+        eventlet.sleep(0.01)
+        self.assertFalse(reader.dead)
+        os.write(channel.write_fd, 'output')
+        os.close(channel.write_fd)
+        self.assertEqual(reader.wait(), ['output'])
+        self.assertTrue(channel.closed)
+        os.close(channel.read_fd)
+        self.mock.VerifyAll()
+
+    def testParamikoOutputTimeout(self):
+        dev = dev_paramiko.ParamikoDevice(name='rtr1', addresses=['10.0.0.1'])
+        channel = FakeChannel(timeout=0.01)
+        self._stubChannel(dev, channel)
+        self.assertRaises(socket.timeout, dev._command, 'sh ver')
+        self.assertTrue(channel.closed)
+        os.close(channel.read_fd)
+        os.close(channel.write_fd)
+        self.mock.VerifyAll()
+
+    def testPipelineOnlyCisco(self):
+        # Other devices are not known to buffer commands typed ahead.
+        for vendor, device_class in device_factory.VENDOR_MAP.items():
+            self.assertEqual(device_class.PIPELINE_COMMANDS,
+                             vendor == 'cisco', vendor)
+
 
 if __name__ == '__main__':
     unittest.main()
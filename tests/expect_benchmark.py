@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark for finding the CLI prompt after large command outputs.
+
+Reports the cost per megabyte of output of expecting the prompt with
+pexpect's expect() (which searches the whole buffer after every read) and
+with DeviceTransport._expect_spawn() (which searches incrementally). The
+latter's cost per megabyte should not grow with the output size.
+
+Usage:
+  $ python -m tests.expect_benchmark [kilobytes ...]
+"""
+
+import re
+import sys
+import time
+
+import pexpect
+
+from notch.agent.devices import dev_ios
+from notch.agent.devices import trans
+
+
+DEFAULT_SIZES = (64, 256, 1024)
+# Bytes returned by each read (a typical read from a socket).
+CHUNK_SIZE = 4096
+PROMPT = 'router1.syd#'
+LINE = ' ip address 10.0.0.1 255.255.255.0\r\n'
+
+
+class ChunkSpawn(pexpect.spawn):
+    """A pexpect spawn which reads from a list of strings."""
+
+    def __init__(self, chunks):
+        pexpect.spawn.__init__(self, None)
+        self._chunks = list(reversed(chunks))
+
+    def read_nonblocking(self, size=-1, timeout=-1):
+        if not self._chunks:
+            raise pexpect.EOF('End of chunks.')
+        return self._chunks.pop()
+
+
+def chunked_output(kilobytes):
+    """Returns a command output of the given size and prompt, in chunks."""
+    lines = (kilobytes * 1024) // len(LINE)
+    data = LINE * lines + PROMPT
+    return [data[i:i + CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)]
+
+
+def bench_pexpect(chunks, pattern):
+    """Returns the seconds taken by pexpect to find the prompt."""
+    spawn = ChunkSpawn(chunks)
+    start = time.time()
+    assert spawn.expect([pattern, pexpect.EOF], timeout=None) == 0
+    return time.time() - start
+
+
+def bench_incremental(chunks, pattern):
+    """Returns the seconds taken by the incremental search."""
+    spawn = ChunkSpawn(chunks)
+    transport = trans.DeviceTransport()
+    start = time.time()
+    assert transport._expect_spawn(spawn, [pattern, pexpect.EOF]) == 0
+    return time.time() - start
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+    patterns = (('prompt', trans.compile_pattern(re.escape(PROMPT),
+                                                 anchor=True)),
+                ('regexp', dev_ios.IosDevice.PROMPT),
+                ('anchored', trans.compile_pattern(dev_ios.IosDevice.PROMPT,
+                                                   anchor=True)))
+    print 'Cost per MB of output (ms)'
+    print '%10s %9s %12s %12s' % ('size (kB)', 'pattern', 'pexpect',
+                                  'incremental')
+    for size in sizes:
+        chunks = chunked_output(size)
+        for name, pattern in patterns:
+            megabytes = size / 1024.0
+            print '%10d %9s %12.2f %12.2f' % (
+                size, name,
+                bench_pexpect(chunks, pattern) * 1e3 / megabytes,
+                bench_incremental(chunks, pattern) * 1e3 / megabytes)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the handlers module."""
+
+
+import eventlet
+import eventlet.event
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib
+import urllib2
+
+import tornado.httpserver
+import tornado.web
+
+from notch.agent import errors
+from notch.agent import handlers
+from notch.agent import tp
+
+
+class ImmediateIOLoop(object):
+    """An IOLoop stand-in, calling callbacks at once."""
+
+    def add_callback(self, callback):
+        callback()
+
+
+class BatchQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = tp.ThreadPool(max_threads=8)
+        self.results = []
+        self.events = {}
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def task(self, name):
+        self.events[name] = eventlet.event.Event()
+
+        def work():
+            return self.events[name].wait()
+
+        return work
+
+    def submit(self, queue, lane, name):
+        queue.submit(lane, self.task(name), self.results.append)
+
+    def testSameDeviceInOrder(self):
+        queue = handlers.BatchQueue(self.pool, 4, io_loop=ImmediateIOLoop())
+        self.submit(queue, 'rtr1', 'a')
+        self.submit(queue, 'rtr1', 'b')
+        eventlet.sleep(0)
+        self.assertEqual(queue.running, 1)
+        self.events['a'].send('a')
+        eventlet.sleep(0.01)
+        self.assertEqual(self.results, ['a'])
+        self.assertEqual(queue.running, 1)
+        self.events['b'].send('b')
+        eventlet.sleep(0.01)
+        self.assertEqual(self.results, ['a', 'b'])
+        self.assertEqual(queue.running, 0)
+
+    def testDevicesConcurrentWithinLimit(self):
+        queue = handlers.BatchQueue(self.pool, 2, io_loop=ImmediateIOLoop())
+        for lane in ('rtr1', 'rtr2', 'rtr3'):
+            self.submit(queue, lane, lane)
+        eventlet.sleep(0)
+        self.assertEqual(queue.running, 2)
+        self.events['rtr2'].send('rtr2')
+        eventlet.sleep(0.01)
+        self.assertEqual(self.results, ['rtr2'])
+        self.assertEqual(queue.running, 2)
+        self.events['rtr3'].send('rtr3')
+        self.events['rtr1'].send('rtr1')
+        eventlet.sleep(0.01)
+        self.assertEqual(sorted(self.results), ['rtr1', 'rtr2', 'rtr3'])
+        self.assertEqual(queue.running, 0)
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.close_callback = None
+        self.is_closed = False
+
+    def set_close_callback(self, callback):
+        self.close_callback = callback
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeConnection(object):
+    """An HTTP connection recording what is written."""
+
+    xheaders = False
+
+    def __init__(self):
+        self.stream = FakeStream()
+        self.written = []
+        self.write_callback = None
+
+    def write(self, chunk, callback=None):
+        self.written.append(chunk)
+        self.write_callback = callback
+
+    def sent(self):
+        """Completes the last write."""
+        callback, self.write_callback = self.write_callback, None
+        callback()
+
+
+class StreamHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        request = tornado.httpserver.HTTPRequest(
+            'GET', '/stream/command', connection=self.connection)
+        self.handler = handlers.StreamHandler(
+            tornado.web.Application(), request)
+        # As get() and tornado.web.RequestHandler._execute() would set.
+        self.handler._transforms = []
+        self.handler._client_closed = False
+        self.handler._flushing = False
+        self.handler._after_flush = None
+
+    def send(self, method, *args):
+        done = eventlet.event.Event()
+        method(done, *args)
+        return done
+
+    def testPieceSentAfterLast(self):
+        self.assertTrue(self.send(self.handler._send_piece, 'a').wait())
+        done = self.send(self.handler._send_piece, 'b')
+        self.assertFalse(done.ready())
+        self.assertEqual(len(self.connection.written), 1)
+        self.connection.sent()
+        self.assertTrue(done.wait())
+        self.assertTrue(self.connection.written[-1].endswith('b'))
+
+    def testClientClosedWhilstSending(self):
+        self.send(self.handler._send_piece, 'a')
+        done = self.send(self.handler._send_piece, 'b')
+        self.connection.stream.close()
+        self.connection.stream.close_callback()
+        self.assertFalse(done.wait())
+
+    def testAbortAfterLastPieceSent(self):
+        self.send(self.handler._send_piece, 'a')
+        done = self.send(self.handler._abort)
+        self.assertFalse(self.connection.stream.closed())
+        self.connection.sent()
+        self.assertTrue(done.wait())
+        self.assertTrue(self.connection.stream.closed())
+
+
+def command_call(request_id, device_name, command, method='command'):
+    """Returns a JSON-RPC call of the command method."""
+    return {'jsonrpc': '2.0', 'id': request_id, 'method': method,
+            'params': {'device_name': device_name, 'command': command,
+                       'encoding': 'raw'}}
+
+
+class HttpServerTestCase(unittest.TestCase):
+    """Base class for tests of the handlers in the standalone server.
+
+    The server (see testserver.py) runs in another process, patched for
+    eventlet as the standalone server is, with the devices in DEVICES.
+    """
+
+    DEVICES = ('127.0.0.1', '127.0.0.2')
+    # Options for the server's configuration.
+    OPTIONS = {}
+    # Seconds to wait for a response.
+    TIMEOUT = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.root, 'group'))
+        router_db = open(os.path.join(cls.root, 'group', 'router.db'), 'w')
+        for device_name in cls.DEVICES:
+            router_db.write('%s:fake:up\n' % device_name)
+        router_db.close()
+        top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        cls.server = subprocess.Popen(
+            [sys.executable, '-m', 'tests.testserver', cls.root,
+             json.dumps(cls.OPTIONS)],
+            cwd=top, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        cls.url = 'http://127.0.0.1:%d' % int(cls.server.stdout.readline())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.kill()
+        cls.server.wait()
+        shutil.rmtree(cls.root)
+
+    def call(self, request):
+        """Returns the response to a JSON-RPC request (a dict or list)."""
+        response = urllib2.urlopen(self.url + '/JSONRPC2',
+                                   json.dumps(request), timeout=self.TIMEOUT)
+        return json.loads(response.read())
+
+    def get(self, path, **kwargs):
+        return urllib2.urlopen('%s%s?%s' % (self.url, path,
+                                            urllib.urlencode(kwargs)),
+                               timeout=self.TIMEOUT)
+
+
+class HttpServerTest(HttpServerTestCase):
+
+    def testCommand(self):
+        response = self.call({'jsonrpc': '2.0', 'id': 1, 'method': 'command',
+                              'params': {'device_name': '127.0.0.1',
+                                         'command': 'show version',
+                                         'encoding': 'raw'}})
+        self.assertEqual(response['id'], 1)
+        self.assertEqual(response['result'], 'show version')
+
+    def testBatch(self):
+        responses = self.call([
+            command_call(1, '127.0.0.1', 'sleep 0.2'),
+            command_call(2, '127.0.0.2', 'show version'),
+            command_call(3, '127.0.0.2', 'show version',
+                         method='no_such_method'),
+            command_call(4, '127.0.0.2', 'bogus'),
+            command_call(5, '127.0.0.1', 'show clock'),
+            {'jsonrpc': '2.0', 'id': 6, 'method': 'devices_matching',
+             'params': {'regexp': '127.*'}}])
+        # Responses are in the order of the calls, not of completion.
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(responses[0]['result'], 'slept 0.2')
+        self.assertEqual(responses[1]['result'], 'show version')
+        self.assertEqual(responses[2]['error']['code'], -32601)
+        self.assertEqual(responses[3]['error']['code'],
+                         errors.error_dictionary['CommandError'])
+        self.assertEqual(responses[4]['result'], 'show clock')
+        self.assertEqual(sorted(responses[5]['result']), list(self.DEVICES))
+
+    def testStream(self):
+        response = self.get('/stream/command', device_name='127.0.0.1',
+                            command='pieces 3')
+        self.assertEqual(response.read(), 'piece 0\npiece 1\npiece 2\n')
+
+    def testStreamError(self):
+        try:
+            self.get('/stream/command', device_name='127.0.0.1',
+                     command='bogus')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 502)
+            self.assertEqual(e.read(), 'CommandError: Invalid input\n')
+        else:
+            self.fail('HTTPError not raised')
+
+
+class AdmissionHttpServerTest(HttpServerTestCase):
+    """Tests shedding, in a server with a short target queueing delay."""
+
+    OPTIONS = {'admission': {'target_delay': 0.05, 'interval': 0.1}}
+
+    def testBatchToOneDeviceNotShed(self):
+        # Each call waits behind the last, but not in the managed queue.
+        responses = self.call([command_call(i, '127.0.0.2', 'sleep 0.1')
+                               for i in range(4)])
+        self.assertEqual([r.get('result') for r in responses],
+                         ['slept 0.1'] * 4)
+
+    def testSheddingQueuedForSession(self):
+        responses = []
+
+        def call(i):
+            # Distinct commands, so that the requests are not coalesced.
+            responses.append(self.call(
+                command_call(i, '127.0.0.1', 'sleep 0.1 %d' % i)))
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        codes = [r['error']['code'] for r in responses if 'error' in r]
+        self.assert_(codes, responses)
+        self.assertEqual(set(codes),
+                         set([errors.error_dictionary['OverloadedError']]))
+        stats = self.call({'jsonrpc': '2.0', 'id': 1,
+                           'method': 'admission_stats', 'params': {}})
+        self.assertEqual(stats['result']['shed'], len(codes))
+
+
+if __name__ == '__main__':
+    unittest.main()
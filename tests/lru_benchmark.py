@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Micro-benchmark for the lru module.
+
+Reports the mean cost of cache hits, misses (populations) and evictions
+at a range of cache sizes. Costs should not grow with the cache size.
+
+Usage:
+  $ python -m tests.lru_benchmark [size ...]
+"""
+
+import sys
+import time
+
+from notch.agent import lru
+
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+# Number of operations timed for each measurement.
+OPERATIONS = 100000
+
+
+def _populate(key):
+    return key
+
+
+def _filled_lru(size):
+    cache = lru.LruDict(_populate, maximum_size=size)
+    for i in xrange(size):
+        cache[i]
+    return cache
+
+
+def bench_hit(size):
+    """Returns the mean cost of a cache hit, in seconds."""
+    cache = _filled_lru(size)
+    step = max(1, size // OPERATIONS)
+    keys = [(i * step) % size for i in xrange(OPERATIONS)]
+    start = time.time()
+    for key in keys:
+        cache[key]
+    return (time.time() - start) / OPERATIONS
+
+
+def bench_miss(size):
+    """Returns the mean cost of a miss on a cache with free space."""
+    cache = lru.LruDict(_populate, maximum_size=size + OPERATIONS)
+    for i in xrange(size):
+        cache[i]
+    start = time.time()
+    for key in xrange(size, size + OPERATIONS):
+        cache[key]
+    return (time.time() - start) / OPERATIONS
+
+
+def bench_eviction(size):
+    """Returns the mean cost of a miss which evicts the LRU item."""
+    cache = _filled_lru(size)
+    start = time.time()
+    for key in xrange(size, size + OPERATIONS):
+        cache[key]
+    return (time.time() - start) / OPERATIONS
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+    print '%10s %12s %12s %12s' % ('entries', 'hit (us)', 'miss (us)',
+                                   'evict (us)')
+    for size in sizes:
+        print '%10d %12.3f %12.3f %12.3f' % (size,
+                                             bench_hit(size) * 1e6,
+                                             bench_miss(size) * 1e6,
+                                             bench_eviction(size) * 1e6)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -19,6 +19,7 @@
 
 import eventlet
 from eventlet.green import time
+import time as blocking_time
 import unittest
 
 from notch.agent import lru
@@ -187,6 +188,55 @@ class LruTest(unittest.TestCase):
         self.assertEqual('4040', test_lru.expire_item())
         self.assertEqual('5050', test_lru.expire_item())
 
+    def testLruHitRefreshesRecency(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=3)
+        test_lru[10]
+        test_lru[20]
+        test_lru[30]
+        # A hit on the oldest key makes it the most-recently used.
+        test_lru[10]
+        test_lru[40]
+        self.assert_(20 not in test_lru)
+        self.assert_(10 in test_lru)
+        self.assertEqual(60, test_lru.expire_item())
+        self.assertEqual(20, test_lru.expire_item())
+        self.assertEqual(80, test_lru.expire_item())
+
+    def testLruSetItemRefreshesRecency(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=2)
+        test_lru[10]
+        test_lru[20]
+        test_lru[10] = 'foo'
+        test_lru[30]
+        self.assert_(20 not in test_lru)
+        self.assertEqual('foo', test_lru.expire_item())
+        self.assertEqual(60, test_lru.expire_item())
+
+    def testLruDelItem(self):
+        expired = []
+        def callback(input):
+            return input*2
+
+        def expire(key, value):
+            expired.append(key)
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=2)
+        test_lru[10]
+        test_lru[20]
+        del test_lru[10]
+        self.assert_(10 not in test_lru)
+        self.assertEqual(len(test_lru), 1)
+        self.assertEqual(40, test_lru.expire_item())
+        self.assertEqual([20], expired)
+        self.assertRaises(IndexError, test_lru.expire_item)
+
     def testExpireItemReturnCopy(self):
         def callback(input):
             return input*2
@@ -232,6 +282,243 @@ class LruTest(unittest.TestCase):
         time.sleep(0.2)
         self.assert_(100 not in test_lru)
 
+    def testLruAgeExpiryUsesOneReaper(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=1000, maximum_age=0.1)
+        test_lru[0]
+        reaper = test_lru._reaper
+        self.assert_(reaper is not None)
+        for i in xrange(1, 500):
+            test_lru[i]
+        self.assert_(test_lru._reaper is reaper)
+        time.sleep(0.2)
+        self.assertEqual(len(test_lru), 0)
+        self.assert_(test_lru._reaper is None)
+        self.assertEqual(test_lru._deadlines, [])
+
+    def testLruAgeExpiryOnAccess(self):
+        populated = []
+        def callback(input):
+            populated.append(input)
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_age=0.05)
+        self.assertEqual(test_lru[100], 200)
+        # Block without yielding to the hub, so the reaper cannot run.
+        blocking_time.sleep(0.1)
+        self.assert_(100 not in test_lru)
+        self.assertEqual(test_lru[100], 200)
+        self.assertEqual(populated, [100, 100])
+
+    def testLruAgeExpiryResetBySetItem(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_age=0.15)
+        test_lru[100]
+        time.sleep(0.1)
+        test_lru[100] = 'foo'
+        time.sleep(0.1)
+        self.assertEqual(test_lru.get(100), 'foo')
+        time.sleep(0.1)
+        self.assert_(100 not in test_lru)
+
+    def testLruConcurrentMissPopulatesOnce(self):
+        populated = []
+        def callback(input):
+            populated.append(input)
+            time.sleep(0.05)
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(test_lru.__getitem__, [10] * 20))
+        self.assertEqual(results, [20] * 20)
+        self.assertEqual(populated, [10])
+        self.assertEqual(len(test_lru), 1)
+
+    def testLruConcurrentMissSharesException(self):
+        populated = []
+        def callback(input):
+            populated.append(input)
+            time.sleep(0.05)
+            raise ValueError(input)
+
+        def get(key):
+            try:
+                return test_lru[key]
+            except ValueError, e:
+                return e
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(get, [10] * 5))
+        self.assertEqual(populated, [10])
+        for result in results:
+            self.assert_(isinstance(result, ValueError))
+        self.assert_(10 not in test_lru)
+        # A later miss tries again.
+        self.assertRaises(ValueError, test_lru.__getitem__, 10)
+        self.assertEqual(populated, [10, 10])
+
+    def testLruInterruptedPopulation(self):
+        def callback(input):
+            time.sleep(0.05)
+            return input*2
+
+        def get(key):
+            try:
+                return test_lru[key]
+            except eventlet.Timeout, e:
+                return e
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        timer = eventlet.Timeout(0.01)
+        waiter = eventlet.spawn(get, 10)
+        try:
+            self.assertRaises(eventlet.Timeout, test_lru.__getitem__, 10)
+        finally:
+            timer.cancel()
+        # The waiter is released, and a later miss populates the key.
+        self.assert_(eventlet.with_timeout(1.0, waiter.wait) is timer)
+        self.assertEqual(test_lru._populating, {})
+        self.assertEqual(test_lru[10], 20)
+
+    def testLruMaximumSizeWithYieldingExpiry(self):
+        sizes = []
+        def callback(input):
+            time.sleep(0.01)
+            return input*2
+
+        def expire(key, value):
+            # Yield to the hub, as when disconnecting a session.
+            time.sleep(0.01)
+            sizes.append(len(test_lru))
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=4)
+        pool = eventlet.GreenPool()
+        list(pool.imap(test_lru.__getitem__, range(50)))
+        self.assert_(sizes)
+        self.assert_(max(sizes) <= 4)
+        self.assertEqual(len(test_lru), 4)
+
+    def testLruSetItemDuringExpiry(self):
+        expired = []
+        def expire(key, value):
+            expired.append((key, value))
+            time.sleep(0.01)
+
+        test_lru = lru.LruDict(expire_callback=expire, maximum_size=2)
+        test_lru['a'] = 1
+        expiry = eventlet.spawn(test_lru.expire_item)
+        eventlet.sleep(0)
+        test_lru['a'] = 2
+        expiry.wait()
+        self.assertEqual(expired, [('a', 1)])
+        self.assertEqual(test_lru.get('a'), 2)
+        self.assertEqual(test_lru.stats()['expired'][lru.EXPIRED_EXPLICIT], 1)
+        # The new value is linked in, so it is expired in turn.
+        test_lru.expire_item()
+        self.assertEqual(expired, [('a', 1), ('a', 2)])
+        self.failIf('a' in test_lru)
+
+    def testLruStats(self):
+        def callback(input):
+            if input == 'bad':
+                raise ValueError(input)
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=2)
+        test_lru[10]
+        test_lru[10]
+        test_lru[20]
+        test_lru.get(20)
+        test_lru.get(30)
+        test_lru[30]
+        self.assertRaises(ValueError, test_lru.__getitem__, 'bad')
+        test_lru.expire_item()
+        stats = test_lru.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['get_misses'], 1)
+        self.assertEqual(stats['populations'], 4)
+        self.assertEqual(stats['population_errors'], 1)
+        self.assert_(stats['population_time'] >= 0.0)
+        self.assert_(stats['population_time_max'] <= stats['population_time'])
+        self.assertEqual(stats['expired'], {lru.EXPIRED_SIZE: 1,
+                                            lru.EXPIRED_AGE: 0,
+                                            lru.EXPIRED_EXPLICIT: 1})
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['maximum_size'], 2)
+        test_lru.reset_stats()
+        self.assertEqual(test_lru.stats()['hits'], 0)
+
+    def testLruStatsAgeAndRefusedExpiry(self):
+        def callback(input):
+            return input*2
+
+        def expire(key, value):
+            if key == 10:
+                raise lru.DontExpireError
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=1, maximum_age=0.1)
+        test_lru[10]
+        test_lru[20]
+        self.assertEqual(test_lru.stats()['expiry_refused'], 1)
+        time.sleep(0.15)
+        stats = test_lru.stats()
+        self.assertEqual(stats['expired'][lru.EXPIRED_AGE], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def testLruEvictionCostCallback(self):
+        def callback(input):
+            return input*2
+
+        def cost(key, value):
+            return costs[key]
+
+        costs = {10: 5.0, 20: 1.0, 30: float('inf'), 40: 0.5}
+        test_lru = lru.LruDict(callback, maximum_size=3,
+                               eviction_cost_callback=cost,
+                               eviction_sample_size=2)
+        test_lru[10]
+        test_lru[20]
+        test_lru[30]
+        # Of the two least-recently used items, 20 is cheapest.
+        test_lru[40]
+        self.assert_(20 not in test_lru)
+        self.assertEqual(sorted(test_lru.keys()), [10, 30, 40])
+        costs[10] = float('inf')
+        # 10 and 30 cannot be evicted, so the LRU item is offered anyway.
+        test_lru[50]
+        self.assert_(10 not in test_lru)
+
+    def testLruMaximumWeight(self):
+        test_lru = lru.LruDict(maximum_size=10, maximum_weight=10,
+                               weight_callback=lambda k, v: len(v))
+        test_lru['a'] = 'xxxx'
+        test_lru['b'] = 'xxxx'
+        self.assertEqual(test_lru.weight, 8)
+        # Room is made for 'c' by expiring the least-recently used item.
+        test_lru['c'] = 'xxxx'
+        self.assertEqual(sorted(test_lru.keys()), ['b', 'c'])
+        self.assertEqual(test_lru.weight, 8)
+        # Replacing an item accounts for the weight it replaces.
+        test_lru['c'] = 'xxxxxx'
+        self.assertEqual(sorted(test_lru.keys()), ['b', 'c'])
+        self.assertEqual(test_lru.weight, 10)
+        test_lru.pop('b')
+        del test_lru['c']
+        self.assertEqual(test_lru.weight, 0)
+        stats = test_lru.stats()
+        self.assertEqual(stats['weight'], 0)
+        self.assertEqual(stats['maximum_weight'], 10)
+        self.assertEqual(stats['expired'][lru.EXPIRED_SIZE], 1)
+
     def testLruDontExpireSignal(self):
         def callback(input):
             return input*3
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the result_cache module."""
+
+
+import time
+import unittest
+
+from notch.agent import result_cache
+
+
+def key(device_name='rtr1', command='show version'):
+    return result_cache.CacheKey(device_name=device_name, command=command,
+                                 mode=None, encoding=None,
+                                 scope=(None, None, None))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = result_cache.ResultCache(
+            [('^show version$', 60), {'pattern': '^show inv', 'ttl': 0.05}],
+            maximum_bytes=10)
+
+    def testTtl(self):
+        self.assertEqual(self.cache.ttl('show version'), 60.0)
+        self.assertEqual(self.cache.ttl('show inventory'), 0.05)
+        self.assertEqual(self.cache.ttl('show run'), None)
+
+    def testInvalidRule(self):
+        self.assertRaises(ValueError, result_cache.ResultCache,
+                          [('show (', 60)])
+        self.assertRaises(ValueError, result_cache.ResultCache,
+                          [('show version', 'soon')])
+
+    def testGetPut(self):
+        self.assertEqual(self.cache.get(key()), None)
+        self.cache.put(key(), 'v1')
+        self.assertEqual(self.cache.get(key()), 'v1')
+        self.assertEqual(self.cache.get(key(device_name='rtr2')), None)
+        # Uncached commands are not stored.
+        self.cache.put(key(command='show run'), 'cfg')
+        self.assertEqual(self.cache.get(key(command='show run')), None)
+
+    def testMaxAge(self):
+        self.cache.put(key(), 'v1')
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get(key(), max_age=0), None)
+        self.assertEqual(self.cache.get(key(), max_age=60), 'v1')
+
+    def testTtlExpiry(self):
+        self.cache.put(key(command='show inv'), 'inv')
+        time.sleep(0.06)
+        self.assertEqual(self.cache.get(key(command='show inv')), None)
+        self.assertEqual(self.cache.stats()['devices'], 0)
+
+    def testByteWeightedEviction(self):
+        self.cache.put(key('rtr1'), 'xxxx')
+        self.cache.put(key('rtr2'), 'xxxx')
+        self.cache.put(key('rtr3'), 'xxxx')
+        self.assertEqual(self.cache.get(key('rtr1')), None)
+        self.assertEqual(self.cache.get(key('rtr3')), 'xxxx')
+        self.assertEqual(self.cache.stats()['weight'], 8)
+        # Responses larger than the cache are not stored.
+        self.cache.put(key('rtr4'), 'x' * 11)
+        self.assertEqual(self.cache.get(key('rtr4')), None)
+        self.assertEqual(self.cache.stats()['devices'], 2)
+
+    def testInvalidate(self):
+        self.cache.put(key('rtr1'), 'v1')
+        self.cache.put(key('rtr2'), 'v2')
+        self.cache.invalidate('rtr1')
+        self.assertEqual(self.cache.get(key('rtr1')), None)
+        self.assertEqual(self.cache.get(key('rtr2')), 'v2')
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def testGeneration(self):
+        generation = self.cache.generation('rtr1')
+        self.cache.invalidate('rtr1')
+        # The response was read before the device changed.
+        self.cache.put(key('rtr1'), 'v1', generation)
+        self.assertEqual(self.cache.get(key('rtr1')), None)
+        self.cache.put(key('rtr1'), 'v2', self.cache.generation('rtr1'))
+        self.assertEqual(self.cache.get(key('rtr1')), 'v2')
+        self.assertEqual(self.cache.generation('rtr2'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,16 +18,140 @@
 
 
 import base64
+import cStringIO
+import gzip
 import unittest
+import zlib
 
+import eventlet
 import mox
 
+from notch.agent import admission
 from notch.agent import credential
 from notch.agent import errors
 from notch.agent import session
 from notch.agent.devices import device
 
 
+class FakeDevice(device.Device):
+    """A device which takes a little time to run commands."""
+
+    # Connections beyond this many raise SessionLimitError.
+    session_limit = None
+    connections = 0
+
+    def _connect(self, address=None, port=None,
+                 connect_method=None, credential=None):
+        if (self.session_limit is not None and
+            FakeDevice.connections >= self.session_limit):
+            raise errors.SessionLimitError('Sorry, session limit reached')
+        FakeDevice.connections += 1
+
+    def _disconnect(self):
+        FakeDevice.connections -= 1
+
+    def _command(self, command, mode=None):
+        eventlet.sleep(0.02)
+        if command == 'bogus':
+            raise errors.CommandError('Invalid input')
+        return '%s on %d' % (command, id(self))
+
+
+class TestRequestLock(unittest.TestCase):
+
+    def _hold(self, lock, name, order, hold_time=0.01, timeout=None):
+        try:
+            lock.acquire(timeout=timeout)
+        except errors.ApiError, e:
+            order.append((name, e.__class__.__name__))
+            return
+        order.append(name)
+        eventlet.sleep(hold_time)
+        lock.release()
+
+    def testFifoOrder(self):
+        lock = session.RequestLock()
+        order = []
+        pool = eventlet.GreenPool()
+        for name in range(5):
+            pool.spawn(self._hold, lock, name, order)
+        pool.waitall()
+        self.assertEqual(order, range(5))
+        self.assertFalse(lock.locked())
+        stats = lock.stats()
+        self.assertEqual(stats['acquisitions'], 5)
+        self.assertEqual(stats['waits'], 4)
+        self.assertEqual(stats['waiting_max'], 4)
+        self.assertEqual(stats['waiting'], 0)
+        self.assert_(stats['wait_time_max'] > 0.0)
+
+    def testWaitDoesNotBlockHub(self):
+        lock = session.RequestLock()
+        lock.acquire()
+        ran = []
+        waiter = eventlet.spawn(lock.acquire)
+        eventlet.spawn(ran.append, True)
+        eventlet.sleep(0.01)
+        self.assertEqual(ran, [True])
+        self.assertEqual(lock.waiting, 1)
+        lock.release()
+        waiter.wait()
+        self.assertTrue(lock.locked())
+        lock.release()
+        self.assertFalse(lock.locked())
+
+    def testQueueFull(self):
+        lock = session.RequestLock(max_waiters=1)
+        order = []
+        pool = eventlet.GreenPool()
+        for name in range(3):
+            pool.spawn(self._hold, lock, name, order)
+        pool.waitall()
+        self.assertEqual(order, [0, (2, 'SessionQueueFullError'), 1])
+        self.assertEqual(lock.stats()['rejections'], 1)
+
+    def testTimeout(self):
+        lock = session.RequestLock()
+        order = []
+        pool = eventlet.GreenPool()
+        pool.spawn(self._hold, lock, 0, order, hold_time=0.1)
+        pool.spawn(self._hold, lock, 1, order, timeout=0.02)
+        pool.spawn(self._hold, lock, 2, order)
+        pool.waitall()
+        self.assertEqual(order, [0, (1, 'SessionQueueTimeoutError'), 2])
+        self.assertEqual(lock.stats()['timeouts'], 1)
+        self.assertFalse(lock.locked())
+
+    def testKilledWaiterLeavesQueue(self):
+        lock = session.RequestLock()
+        lock.acquire()
+        waiter = eventlet.spawn(lock.acquire)
+        eventlet.sleep(0)
+        self.assertEqual(lock.waiting, 1)
+        waiter.kill()
+        self.assertEqual(lock.waiting, 0)
+        lock.release()
+        self.assertFalse(lock.locked())
+
+    def testCapacity(self):
+        lock = session.RequestLock(capacity=2)
+        lock.acquire()
+        self.assertFalse(lock.locked())
+        lock.acquire()
+        self.assertTrue(lock.locked())
+        self.assertEqual(lock.holders, 2)
+        waiter = eventlet.spawn(lock.acquire)
+        eventlet.sleep(0)
+        self.assertEqual(lock.waiting, 1)
+        lock.release()
+        waiter.wait()
+        self.assertEqual(lock.holders, 2)
+        lock.release()
+        lock.release()
+        self.assertEqual(lock.holders, 0)
+        self.assertEqual(lock.stats()['capacity'], 2)
+
+
 class TestSessionWithoutDevice(unittest.TestCase):
 
     def setUp(self):
@@ -53,6 +177,36 @@ class TestSessionWithoutDevice(unittest.TestCase):
         self.assertRaises(errors.InvalidRequestError, self.session.request,
                           'not_a_valid_method_name')
 
+    def testInvalidMaxWaitTime(self):
+        self.assertRaises(errors.InvalidRequestError, self.session.request,
+                          'command', max_wait_time='soon')
+        self.assertFalse(self.session.busy)
+
+    def testRequestWaitTimeout(self):
+        self.session._exclusive.acquire()
+        self.assertRaises(errors.SessionQueueTimeoutError,
+                          self.session.request, 'command', max_wait_time=0.01)
+        self.session._exclusive.release()
+
+    def testRequestNoWait(self):
+        self.session._exclusive.acquire()
+        self.session.max_wait_time = 10.0
+        # A max_wait_time of 0 does not wait for a busy session.
+        timer = eventlet.Timeout(1.0)
+        try:
+            self.assertRaises(errors.SessionQueueTimeoutError,
+                              self.session.request, 'command', max_wait_time=0)
+        finally:
+            timer.cancel()
+        self.session._exclusive.release()
+
+    def testRequestQueueFull(self):
+        s = session.Session(max_queue_length=0)
+        s._exclusive.acquire()
+        self.assertRaises(errors.SessionQueueFullError, s.request, 'command')
+        s._exclusive.release()
+        self.assertEqual(s.stats()['queue']['rejections'], 1)
+
 
 class TestSessionAbstractDevice(unittest.TestCase):
 
@@ -69,6 +223,25 @@ class TestSessionAbstractDevice(unittest.TestCase):
         self.assertTrue(self.device.vendor is None)
         self.assertFalse(self.device.connected)
 
+    def testRequestShedOnAcquire(self):
+        control = admission.AdmissionControl()
+        ticket = control.admit('test1.popname')
+        self.mock = mox.Mox()
+        self.mock.StubOutWithMock(control, '_should_shed')
+        control._should_shed(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(True)
+        self.mock.ReplayAll()
+        admission.bind(ticket)
+        try:
+            self.assertRaises(errors.OverloadedError,
+                              self.session.request, 'command', 'sh run')
+        finally:
+            admission.bind(None)
+        self.mock.UnsetStubs()
+        self.mock.VerifyAll()
+        # The session was released.
+        self.assertFalse(self.session.busy)
+        self.assertEqual(control.stats()['pending'], 0)
+
     def testRequestOnAbstractDevice(self):
         self.assertRaises(NotImplementedError,
                           self.session.request, 'command', None)
@@ -97,6 +270,28 @@ class TestSessionMockDevice(unittest.TestCase):
         self.assertTrue(s.connected)
         self.mock.VerifyAll()
 
+    def testConnectRecordsCost(self):
+        dev = self.mock.CreateMock(device.Device)
+        dev.connect(credential=self.credential,
+                    connect_method='foo').AndReturn(None)
+        self.mock.ReplayAll()
+        s = session.Session(device=dev)
+        s.credential = self.credential
+        self.assertTrue(s.connect_cost is None)
+        s.connect()
+        self.assertTrue(s.connect_cost >= 0.0)
+        self.assertFalse(s.busy)
+        self.mock.VerifyAll()
+
+    def testBusy(self):
+        s = session.Session()
+        self.assertFalse(s.busy)
+        s._exclusive.acquire()
+        self.assertTrue(s.busy)
+        s._exclusive.release()
+        s.idle = False
+        self.assertTrue(s.busy)
+
     def testDisconnect(self):
         dev = self.mock.CreateMock(device.Device)
         dev.connect(credential=self.credential,
@@ -128,6 +323,19 @@ class TestSessionMockDevice(unittest.TestCase):
         self.assertEqual(base64.b64decode(result), '# Config data')
         self.mock.VerifyAll()
 
+    def testRequestCallback(self):
+        called = []
+        dev = self.mock.CreateMock(device.Device)
+        dev.connect(credential=self.credential,
+                    connect_method='foo').AndReturn(None)
+        dev.command('show version').AndReturn('# Config data')
+        self.mock.ReplayAll()
+        s = session.Session(device=dev, request_callback=called.append)
+        s.credential = self.credential
+        s.request('command', 'show version')
+        self.assertEqual(called, [s])
+        self.mock.VerifyAll()
+
     def testCommandRequestInShellMode(self):
         dev = self.mock.CreateMock(device.Device)
         dev.connect(credential=self.credential,
@@ -142,5 +350,373 @@ class TestSessionMockDevice(unittest.TestCase):
 
 
 
+class TestSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeDevice.connections = 0
+        FakeDevice.session_limit = None
+        self.credential = credential.Credential(regexp='.*',
+                                                connect_method='foo')
+
+    def _new_pool(self, max_sessions, **kwargs):
+        new_device = lambda: FakeDevice(name='xr1.foo', addresses='10.0.0.1')
+        pool = session.SessionPool(new_device, max_sessions, **kwargs)
+        pool.credential = self.credential
+        return pool
+
+    def _run(self, pool, count):
+        gt_pool = eventlet.GreenPool()
+        return list(gt_pool.imap(
+            lambda i: base64.b64decode(pool.request('command', 'sh ver')),
+            range(count)))
+
+    def testSequentialRequestsUseOneMember(self):
+        pool = self._new_pool(3)
+        pool.request('command', 'sh ver')
+        pool.request('command', 'sh ver')
+        self.assertEqual(len(pool.members), 1)
+        self.assertTrue(pool.connected)
+        self.assertFalse(pool.busy)
+
+    def testConcurrentRequestsGrowPool(self):
+        pool = self._new_pool(3)
+        results = self._run(pool, 6)
+        self.assertEqual(len(pool.members), 3)
+        self.assertEqual(FakeDevice.connections, 3)
+        # Requests were spread over the three member devices.
+        self.assertEqual(len(set(results)), 3)
+        stats = pool.stats()
+        self.assertEqual(stats['max_sessions'], 3)
+        self.assertEqual(len(stats['members']), 3)
+
+    def testSessionLimitStopsGrowth(self):
+        FakeDevice.session_limit = 2
+        pool = self._new_pool(4)
+        results = self._run(pool, 6)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(pool.members), 2)
+        self.assertEqual(pool.stats()['device_limit'], 2)
+        self.assertEqual(pool.max_sessions, 4)
+
+    def testSessionLimitExpires(self):
+        FakeDevice.session_limit = 2
+        pool = self._new_pool(4)
+        pool.limit_backoff = 0.2
+        self._run(pool, 6)
+        self.assertEqual(len(pool.members), 2)
+        # The device has room again once the limit expires.
+        FakeDevice.session_limit = None
+        eventlet.sleep(0.25)
+        self.assertEqual(pool.stats()['device_limit'], None)
+        self._run(pool, 8)
+        self.assertEqual(len(pool.members), 4)
+
+    def testDisconnectedMembersRemoved(self):
+        pool = self._new_pool(3)
+        self._run(pool, 3)
+        self.assertEqual(len(pool.members), 3)
+        pool.members[1].disconnect()
+        pool.members[2].disconnect()
+        pool.request('command', 'sh ver')
+        self.assertEqual(len(pool.members), 1)
+        pool.disconnect()
+        self.assertFalse(pool.connected)
+        self.assertEqual(FakeDevice.connections, 0)
+
+
+class PipelineDevice(FakeDevice):
+    """A device which runs command sequences pipelined."""
+
+    PIPELINE_COMMANDS = True
+
+    def __init__(self, *args, **kwargs):
+        super(PipelineDevice, self).__init__(*args, **kwargs)
+        self.pipelined = []
+
+    def _commands(self, commands, mode=None):
+        self.pipelined.append(commands)
+        responses = []
+        for command in commands:
+            if command == 'bogus':
+                exc = errors.CommandError('Invalid input')
+                exc.responses = responses
+                raise exc
+            responses.append('%s pipelined' % command)
+        return responses
+
+
+class TestSessionBatch(unittest.TestCase):
+
+    def setUp(self):
+        FakeDevice.connections = 0
+        FakeDevice.session_limit = None
+        self.credential = credential.Credential(regexp='.*',
+                                                connect_method='foo')
+        self.session = session.Session(
+            device=FakeDevice(name='xr1.foo', addresses='10.0.0.1'))
+        self.session.credential = self.credential
+        self.arguments = [{'command': 'sh ver'}, {'command': 'bogus'},
+                          {'command': 'sh clock'}]
+
+    def testBatchStopsOnError(self):
+        results = self.session.request_batch('command', self.arguments)
+        self.assertEqual(len(results), 2)
+        self.assert_(base64.b64decode(results[0]['result']).startswith(
+            'sh ver on'))
+        self.assertEqual(results[1], {'error': 'CommandError',
+                                      'message': 'Invalid input'})
+        self.assertEqual(self.session.stats()['queue']['acquisitions'], 1)
+
+    def testBatchContinuesOnError(self):
+        results = self.session.request_batch('command', self.arguments,
+                                             stop_on_error=False)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[1]['error'], 'CommandError')
+        self.assert_(base64.b64decode(results[2]['result']).startswith(
+            'sh clock on'))
+        self.assertEqual(self.session.stats()['queue']['acquisitions'], 1)
+        self.assertFalse(self.session.busy)
+
+    def testBatchConnectError(self):
+        FakeDevice.session_limit = 0
+        self.assertRaises(errors.SessionLimitError,
+                          self.session.request_batch, 'command',
+                          self.arguments)
+        self.assertFalse(self.session.busy)
+
+    def testBatchPipelined(self):
+        self.session.device = PipelineDevice(name='xr1.foo',
+                                             addresses='10.0.0.1')
+        results = self.session.request_batch(
+            'command', [{'command': 'sh ver'}, {'command': 'sh clock'}])
+        self.assertEqual([base64.b64decode(r['result']) for r in results],
+                         ['sh ver pipelined', 'sh clock pipelined'])
+        self.assertEqual(self.session.device.pipelined,
+                         [['sh ver', 'sh clock']])
+
+    def testBatchPipelinedContinuesOnError(self):
+        self.session.device = PipelineDevice(name='xr1.foo',
+                                             addresses='10.0.0.1')
+        results = self.session.request_batch('command', self.arguments,
+                                             stop_on_error=False)
+        self.assertEqual(base64.b64decode(results[0]['result']),
+                         'sh ver pipelined')
+        self.assertEqual(results[1]['error'], 'CommandError')
+        # The command after the error ran on its own.
+        self.assert_(base64.b64decode(results[2]['result']).startswith(
+            'sh clock on'))
+        self.assertEqual(len(self.session.device.pipelined), 1)
+
+    def testBatchMixedModesNotPipelined(self):
+        self.session.device = PipelineDevice(name='xr1.foo',
+                                             addresses='10.0.0.1')
+        results = self.session.request_batch(
+            'command', [{'command': 'sh ver'},
+                        {'command': 'sh clock', 'mode': 'shell'}])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.session.device.pipelined, [])
+
+    def testPoolBatch(self):
+        new_device = lambda: FakeDevice(name='xr1.foo', addresses='10.0.0.1')
+        pool = session.SessionPool(new_device, 2)
+        pool.credential = self.credential
+        results = pool.request_batch('command', self.arguments[:1])
+        self.assertEqual(results[0].keys(), ['result'])
+
+
+class ChannelDevice(FakeDevice):
+    """A device which executes concurrent requests on one connection."""
+
+    MAX_CHANNELS = 3
+
+    def __init__(self, *args, **kwargs):
+        super(ChannelDevice, self).__init__(*args, **kwargs)
+        self.running = 0
+        self.running_max = 0
+
+    def _connect(self, *args, **kwargs):
+        eventlet.sleep(0.01)
+        super(ChannelDevice, self)._connect(*args, **kwargs)
+
+    def _command(self, command, mode=None):
+        self.running += 1
+        self.running_max = max(self.running_max, self.running)
+        try:
+            return super(ChannelDevice, self)._command(command, mode=mode)
+        finally:
+            self.running -= 1
+
+
+class TestSessionChannels(unittest.TestCase):
+
+    def setUp(self):
+        FakeDevice.connections = 0
+        FakeDevice.session_limit = None
+        self.device = ChannelDevice(name='mx1.foo', addresses='10.0.0.1')
+        self.credential = credential.Credential(regexp='.*',
+                                                connect_method='foo')
+
+    def _run(self, sess, count):
+        gt_pool = eventlet.GreenPool()
+        return list(gt_pool.imap(
+            lambda i: sess.request('command', 'sh ver'), range(count)))
+
+    def testConcurrentRequestsShareConnection(self):
+        sess = session.Session(device=self.device)
+        sess.credential = self.credential
+        self.assertEqual(len(self._run(sess, 6)), 6)
+        self.assertEqual(FakeDevice.connections, 1)
+        self.assertEqual(self.device.running_max, 3)
+        self.assertTrue(sess.idle)
+        self.assertFalse(sess.busy)
+        self.assertEqual(sess.stats()['queue']['acquisitions'], 6)
+
+    def testErrorKeepsSharedConnection(self):
+        sess = session.Session(device=self.device)
+        sess.credential = self.credential
+        gt_pool = eventlet.GreenPool()
+        failed = gt_pool.spawn(sess.request, 'command', 'bogus')
+        others = [gt_pool.spawn(sess.request, 'command', 'sh ver')
+                  for _ in range(2)]
+        self.assertRaises(errors.CommandError, failed.wait)
+        # The other requests' channels are still running.
+        self.assertEqual(FakeDevice.connections, 1)
+        for gt in others:
+            self.assertTrue(gt.wait())
+        self.assertTrue(sess.connected)
+        # Without other requests active, the error disconnects.
+        self.assertRaises(errors.CommandError, sess.request, 'command',
+                          'bogus')
+        self.assertEqual(FakeDevice.connections, 0)
+        self.assertFalse(sess.connected)
+
+    def testChannelLimitOverride(self):
+        sess = session.Session(device=self.device, max_channels=1)
+        sess.credential = self.credential
+        self._run(sess, 3)
+        self.assertEqual(self.device.running_max, 1)
+
+    def testSerialDeviceDefault(self):
+        sess = session.Session(
+            device=FakeDevice(name='xr1.foo', addresses='10.0.0.1'))
+        self.assertEqual(sess.stats()['queue']['capacity'], 1)
+
+
+class TestSessionEncoding(unittest.TestCase):
+
+    def setUp(self):
+        FakeDevice.connections = 0
+        FakeDevice.session_limit = None
+        self.session = session.Session(
+            device=FakeDevice(name='xr1.foo', addresses='10.0.0.1'))
+        self.session.credential = credential.Credential(regexp='.*',
+                                                        connect_method='foo')
+        self.expected = 'sh ver on %d' % id(self.session.device)
+
+    def testEncodings(self):
+        request = lambda e: self.session.request('command', 'sh ver',
+                                                 encoding=e)
+        self.assertEqual(base64.b64decode(request(None)), self.expected)
+        self.assertEqual(base64.b64decode(request('base64')), self.expected)
+        self.assertEqual(request('raw'), self.expected)
+        self.assertEqual(zlib.decompress(base64.b64decode(
+            request('zlib+base64'))), self.expected)
+        gzipped = cStringIO.StringIO(base64.b64decode(request('gzip')))
+        self.assertEqual(gzip.GzipFile(fileobj=gzipped).read(),
+                         self.expected)
+
+    def testDecode(self):
+        for encoding in (None, 'raw') + session.ENCODINGS:
+            self.assertEqual(session.decode(self.session.request(
+                'command', 'sh ver', encoding=encoding), encoding),
+                             self.expected)
+
+    def testInvalidEncoding(self):
+        self.assertRaises(errors.InvalidRequestError, self.session.request,
+                          'command', 'sh ver', encoding='rot13')
+        self.assertEqual(self.session.stats()['queue']['acquisitions'], 0)
+
+    def testRawRequiresUtf8(self):
+        self.assertEqual(self.session._encode('caf\xc3\xa9', 'raw'),
+                         u'caf\xe9')
+        self.assertRaises(errors.EncodingError, self.session._encode,
+                          '\xff\xfe', 'raw')
+
+    def testBatchEncoding(self):
+        results = self.session.request_batch(
+            'command', [{'command': 'sh ver'}], encoding='raw')
+        self.assertEqual(results, [{'result': self.expected}])
+
+
+class StreamDevice(FakeDevice):
+    """A device which streams command output in pieces."""
+
+    def __init__(self, *args, **kwargs):
+        super(StreamDevice, self).__init__(*args, **kwargs)
+        self.attempts = 0
+
+    def _command_iter(self, command, mode=None):
+        self.attempts += 1
+        if command == 'flaky' and self.attempts == 1:
+            exc = errors.CommandError('EOF')
+            exc.retry = True
+            raise exc
+        for i in range(3):
+            yield '%s %d\n' % (command, i)
+        if command == 'broken':
+            exc = errors.CommandError('EOF')
+            exc.retry = True
+            raise exc
+
+
+class TestSessionStream(unittest.TestCase):
+
+    def setUp(self):
+        FakeDevice.connections = 0
+        FakeDevice.session_limit = None
+        self.session = session.Session(
+            device=StreamDevice(name='xr1.foo', addresses='10.0.0.1'))
+        self.session.credential = credential.Credential(regexp='.*',
+                                                        connect_method='foo')
+
+    def testStream(self):
+        stream = self.session.request_iter('command', 'sh ver')
+        self.assert_(self.session.busy)
+        self.assertEqual(list(stream), ['sh ver 0\n', 'sh ver 1\n',
+                                        'sh ver 2\n'])
+        self.assertFalse(self.session.busy)
+        self.assert_(self.session.connected)
+
+    def testCloseReleasesSessionAndDisconnects(self):
+        stream = self.session.request_iter('command', 'sh ver')
+        self.assertEqual(stream.next(), 'sh ver 0\n')
+        stream.close()
+        self.assertFalse(self.session.busy)
+        self.assertFalse(self.session.connected)
+        self.assertRaises(StopIteration, stream.next)
+
+    def testRetriedBeforeFirstPiece(self):
+        self.assertEqual(len(list(self.session.request_iter('command',
+                                                            'flaky'))), 3)
+        self.assertEqual(self.session.device.attempts, 2)
+
+    def testNotRetriedOnceStreaming(self):
+        stream = self.session.request_iter('command', 'broken')
+        self.assertEqual(len([stream.next() for _ in range(3)]), 3)
+        self.assertRaises(errors.CommandError, stream.next)
+        self.assertEqual(self.session.device.attempts, 1)
+        self.assertFalse(self.session.busy)
+
+    def testNotStreamable(self):
+        self.assertRaises(errors.InvalidRequestError,
+                          self.session.request_iter, 'set_config', 'foo', '')
+        self.assertFalse(self.session.busy)
+
+    def testWholeResponseByDefault(self):
+        self.session.device = FakeDevice(name='xr1.foo', addresses='10.0.0.1')
+        stream = self.session.request_iter('command', 'sh ver')
+        self.assertEqual(len(list(stream)), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
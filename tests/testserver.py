@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A Notch agent HTTP server with fake devices, for end-to-end tests.
+
+Run as 'python -m tests.testserver <router.db root> [<options JSON>]'
+from the top of the source tree. Like the standalone server (see
+notch.agent.__main__), it patches socket, select and threads for eventlet,
+then serves the Tornado application on an unused port, which it prints.
+
+Devices of type 'fake' run these commands:
+  sleep <seconds>: Waits, then responds 'slept <seconds>'.
+  pieces <n>: Responds with n lines, yielded one at a time when streamed.
+  bogus: Raises CommandError.
+Anything else is echoed back.
+"""
+
+import eventlet
+
+eventlet.monkey_patch(all=False, os=False, socket=True, select=True,
+                      thread=True)
+
+
+import json
+import os
+import sys
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+from notch.agent import applications
+from notch.agent import device_factory
+from notch.agent import errors
+from notch.agent.devices import device
+
+
+class FakeDevice(device.Device):
+    """A device which runs commands without connecting anywhere."""
+
+    def _connect(self, address=None, port=None,
+                 connect_method=None, credential=None):
+        pass
+
+    def _disconnect(self):
+        pass
+
+    def _command(self, command, mode=None):
+        return ''.join(self._command_iter(command, mode=mode))
+
+    def _command_iter(self, command, mode=None):
+        words = command.split()
+        if command == 'bogus':
+            raise errors.CommandError('Invalid input')
+        elif words[0] == 'sleep':
+            eventlet.sleep(float(words[1]))
+            yield 'slept %s' % words[1]
+        elif words[0] == 'pieces':
+            for i in range(int(words[1])):
+                eventlet.sleep(0)
+                yield 'piece %d\n' % i
+        else:
+            yield command
+
+
+def main(root, options=None):
+    device_factory.VENDOR_MAP['fake'] = FakeDevice
+    credentials = os.path.join(os.path.dirname(__file__), 'testdata',
+                               'credentials1.yaml')
+    config = {'device_sources': {'fake': {'provider': 'router.db',
+                                          'root': root}},
+              'options': dict(options or {}, credentials=credentials)}
+    application = applications.NotchTornadoApplication(config)
+    server = tornado.httpserver.HTTPServer(application)
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server.add_sockets(sockets)
+    print sockets[0].getsockname()[1]
+    sys.stdout.flush()
+    tornado.ioloop.IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        main(sys.argv[1], json.loads(sys.argv[2]))
+    else:
+        main(sys.argv[1])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the tp module."""
+
+
+import eventlet
+import eventlet.event
+import unittest
+
+from notch.agent import tp
+
+
+class ThreadPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = tp.ThreadPool(max_threads=2, idle_timeout=0.05)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def testResult(self):
+        future = self.pool.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(future.result(), 3)
+        self.assert_(future.done())
+        self.assertEqual(future.exception(), None)
+
+    def testException(self):
+        def fail():
+            raise ValueError('bad value')
+
+        future = self.pool.submit(fail)
+        self.assertRaises(ValueError, future.result)
+        self.assert_(isinstance(future.exception(), ValueError))
+        self.assertEqual(self.pool.stats()['failed'], 1)
+
+    def testBaseException(self):
+        def abort():
+            raise SystemExit(1)
+
+        future = self.pool.submit(abort)
+        self.assert_(isinstance(future.exception(1.0), SystemExit))
+        self.assertRaises(SystemExit, future.result)
+        # The thread ended, but the pool carries on.
+        self.assertEqual(self.pool.submit(lambda: 'x').result(1.0), 'x')
+        self.assertEqual(self.pool.stats()['failed'], 1)
+
+    def testResultTimeout(self):
+        release = eventlet.event.Event()
+        future = self.pool.submit(release.wait)
+        self.assertRaises(tp.TimeoutError, future.result, 0.01)
+        release.send('done')
+        self.assertEqual(future.result(1.0), 'done')
+
+    def testDoneCallback(self):
+        done = []
+        future = self.pool.submit(lambda: 'x')
+        future.add_done_callback(lambda f: done.append(f.result()))
+        future.result()
+        future.add_done_callback(lambda f: done.append('again'))
+        self.assertEqual(done, ['x', 'again'])
+
+    def testGrowsToMaxThreads(self):
+        self.assertEqual(self.pool.stats()['threads'], 0)
+        release = eventlet.event.Event()
+        futures = [self.pool.submit(release.wait) for _ in xrange(4)]
+        eventlet.sleep(0)
+        stats = self.pool.stats()
+        self.assertEqual(stats['threads'], 2)
+        self.assertEqual(stats['threads_running'], 2)
+        self.assertEqual(stats['queue_depth'], 2)
+        release.send(None)
+        for future in futures:
+            future.result()
+        stats = self.pool.stats()
+        self.assertEqual(stats['completed'], 4)
+        self.assert_(stats['queue_depth_max'] >= 2)
+        self.assertEqual(stats['threads_max'], 2)
+        self.assert_(stats['wait_time_max'] > 0)
+
+    def testIdleThreadsExit(self):
+        self.pool.resize(min_threads=1)
+        self.pool.submit(eventlet.sleep, 0).result()
+        self.pool.submit(eventlet.sleep, 0).result()
+        eventlet.sleep(0.2)
+        self.assertEqual(self.pool.stats()['threads'], 1)
+
+    def testResize(self):
+        self.assertRaises(ValueError, self.pool.resize, 3, 2)
+        self.assertRaises(ValueError, self.pool.resize, None, 0)
+        release = eventlet.event.Event()
+        futures = [self.pool.submit(release.wait) for _ in xrange(4)]
+        eventlet.sleep(0)
+        self.pool.resize(max_threads=4)
+        eventlet.sleep(0.01)
+        self.assertEqual(self.pool.stats()['threads_running'], 4)
+        self.pool.resize(max_threads=1)
+        release.send(None)
+        for future in futures:
+            future.result()
+        eventlet.sleep(0)
+        self.assertEqual(self.pool.stats()['threads'], 1)
+
+    def testQueueFull(self):
+        pool = tp.ThreadPool(max_threads=1, max_queue_depth=1)
+        release = eventlet.event.Event()
+        pool.submit(release.wait)
+        eventlet.sleep(0)
+        pool.submit(release.wait)
+        self.assertRaises(tp.Full, pool.submit_nowait, release.wait)
+        blocked = eventlet.spawn(pool.submit, lambda: 'queued')
+        eventlet.sleep(0)
+        self.assertEqual(pool.queue_depth, 1)
+        release.send(None)
+        self.assertEqual(blocked.wait().result(), 'queued')
+        self.assertEqual(pool.stats()['rejected'], 1)
+        pool.stop()
+
+    def testStop(self):
+        release = eventlet.event.Event()
+        future = self.pool.submit(release.wait)
+        eventlet.spawn_after(0.01, release.send, 'done')
+        self.pool.stop()
+        self.assertEqual(future.result(), 'done')
+        self.assertEqual(self.pool.stats()['threads'], 0)
+        self.assertRaises(tp.StoppedError, self.pool.submit, len, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark for command execution over a simulated high-latency link.
+
+Compares the time taken to run a sequence of commands one at a time
+(DeviceTransport.command) and pipelined (DeviceTransport.commands) on a
+simulated IOS-like CLI. Time is simulated, so results are exact and the
+benchmark runs quickly.
+
+Usage:
+  $ python -m tests.trans_benchmark [rtt_seconds [count ...]]
+"""
+
+import heapq
+import re
+import sys
+
+import pexpect
+
+from notch.agent.devices import device
+from notch.agent.devices import trans
+
+
+DEFAULT_RTT = 0.6
+DEFAULT_COUNTS = (1, 5, 30)
+
+
+class SimulatedTransport(trans.DeviceTransport):
+    """A transport to a simulated CLI, over a link with the given latency.
+
+    The CLI buffers input typed ahead of its prompt, and answers each line
+    in turn after processing_time seconds. It echoes the line, then (for
+    non-empty lines) the command's output, then the prompt. Commands with
+    an output of None hang the CLI.
+
+    Attributes:
+      clock: A float, the simulated time, in seconds. It advances only
+        when waiting for data from the device.
+      lines: A list of strings, the lines received by the device.
+    """
+
+    def __init__(self, rtt=DEFAULT_RTT, prompt='router#', outputs=None,
+                 processing_time=0.01, **kwargs):
+        timeouts = device.Timeouts(connect=30.0, resp_short=12.0,
+                                   resp_long=180.0, disconnect=10.0)
+        super(SimulatedTransport, self).__init__(timeouts=timeouts, **kwargs)
+        self.rtt = rtt
+        self.prompt = prompt
+        self.outputs = outputs or {}
+        self.processing_time = processing_time
+        self.clock = 0.0
+        self.lines = []
+        self._device_free = 0.0
+        self._hung = False
+        # (arrival time, sequence number, data) tuples, a heap.
+        self._pending = []
+        self._buffer = ''
+        self._before = None
+        self._after = None
+        self._match = None
+
+    @property
+    def match(self):
+        return self._match
+
+    @property
+    def before(self):
+        return self._before
+
+    @property
+    def after(self):
+        return self._after
+
+    def _output(self, line):
+        if line in self.outputs:
+            return self.outputs[line]
+        return 'Output of %s\r\n' % line
+
+    def write(self, s):
+        arrival = self.clock + self.rtt / 2
+        for line in s.splitlines():
+            self.lines.append(line)
+            if self._hung or self.outputs.get(line, '') is None:
+                self._hung = True
+                continue
+            done = max(arrival, self._device_free) + self.processing_time
+            self._device_free = done
+            response = line + '\r\n'
+            if line:
+                response += self._output(line)
+            response += self.prompt
+            heapq.heappush(self._pending, (done + self.rtt / 2,
+                                           len(self.lines), response))
+
+    def expect(self, re_list, timeout=None):
+        patterns = []
+        for pattern in re_list:
+            if pattern in (pexpect.EOF, pexpect.TIMEOUT):
+                patterns.append(None)
+            elif isinstance(pattern, basestring):
+                patterns.append(re.compile(pattern))
+            else:
+                patterns.append(pattern)
+        deadline = self.clock + (timeout or self.timeouts.resp_long)
+        while True:
+            best = None
+            for i, pattern in enumerate(patterns):
+                if pattern is None:
+                    continue
+                m = pattern.search(self._buffer)
+                if m and (best is None or m.start() < best[1].start()):
+                    best = (i, m)
+            if best is not None:
+                i, m = best
+                self._match = m
+                self._before = self._buffer[:m.start()]
+                self._after = m.group(0)
+                self._buffer = self._buffer[m.end():]
+                return i
+            if not self._pending or self._pending[0][0] > deadline:
+                self.clock = deadline
+                self._match = None
+                self._before = self._buffer
+                return list(re_list).index(pexpect.TIMEOUT)
+            arrival, _, data = heapq.heappop(self._pending)
+            self.clock = max(self.clock, arrival)
+            self._buffer += data
+
+
+def bench_sequential(rtt, commands):
+    """Returns the simulated seconds to run commands one at a time."""
+    transport = SimulatedTransport(rtt=rtt)
+    for command in commands:
+        transport.command(command, transport.prompt)
+    return transport.clock
+
+
+def bench_pipelined(rtt, commands):
+    """Returns the simulated seconds to run commands pipelined."""
+    transport = SimulatedTransport(rtt=rtt)
+    transport.commands(commands, transport.prompt)
+    return transport.clock
+
+
+def main(argv):
+    rtt = DEFAULT_RTT
+    if len(argv) > 1:
+        rtt = float(argv[1])
+    counts = [int(arg) for arg in argv[2:]] or DEFAULT_COUNTS
+    print 'Round trip time: %.3f sec' % rtt
+    print '%10s %16s %16s' % ('commands', 'sequential (s)', 'pipelined (s)')
+    for count in counts:
+        commands = ['show command %d' % i for i in xrange(count)]
+        print '%10d %16.3f %16.3f' % (count,
+                                      bench_sequential(rtt, commands),
+                                      bench_pipelined(rtt, commands))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
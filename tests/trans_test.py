@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the abstract device transport."""
+
+
+import re
+import unittest
+
+import pexpect
+
+from notch.agent import errors
+from notch.agent.devices import dev_ios
+from notch.agent.devices import dev_netscreen
+from notch.agent.devices import dev_nortel_esr
+from notch.agent.devices import trans
+from tests import expect_benchmark
+from tests import trans_benchmark
+
+
+class TestStreamSearcher(unittest.TestCase):
+
+    def testMatchSplitAcrossFeeds(self):
+        searcher = trans.StreamSearcher(['router#', pexpect.EOF])
+        self.assertEqual(searcher.feed('output\r\nrou'), None)
+        index, match, before, after, rest = searcher.feed('ter# more')
+        self.assertEqual(index, 0)
+        self.assertEqual(match.group(0), 'router#')
+        self.assertEqual((before, after, rest),
+                         ('output\r\n', 'router#', ' more'))
+        self.assertEqual(searcher.eof_index, 1)
+        self.assertEqual(searcher.timeout_index, -1)
+
+    def testEarliestMatchWins(self):
+        searcher = trans.StreamSearcher(['--More--', 'router#'])
+        self.assertEqual(searcher.feed('x router# y --More--')[0], 1)
+
+    def testOnlyWindowIsSearchedAgain(self):
+        searcher = trans.StreamSearcher(['abc'], window=4)
+        for chunk in ('ab', 'x' * 10, 'c'):
+            self.assertEqual(searcher.feed(chunk), None)
+        self.assertEqual(searcher.feed('xabc')[2], 'ab' + 'x' * 10 + 'cx')
+
+    def testRelease(self):
+        searcher = trans.StreamSearcher(['router#'], window=8)
+        lines = ['line %d\r\n' % i for i in range(10)]
+        released = []
+        for line in lines:
+            self.assertEqual(searcher.feed(line), None)
+            released.append(searcher.release())
+        # Whole lines are released, up to the window.
+        self.assert_(''.join(released).endswith('\n'))
+        self.assert_(len(searcher.data) < 2 * len(lines[0]) + 8)
+        self.assertEqual(searcher.feed('rout'), None)
+        index, _, before, after, _ = searcher.feed('er# ')
+        self.assertEqual(''.join(released) + before, ''.join(lines))
+        self.assertEqual(after, 'router#')
+
+    def testAnchoredPrompt(self):
+        prompt = trans.compile_pattern('router#', anchor=True)
+        self.assert_(prompt is trans.compile_pattern('router#', anchor=True))
+        searcher = trans.StreamSearcher([prompt])
+        self.assertEqual(searcher.feed('remote-router# is not a prompt'),
+                         None)
+        # The byte before the window is kept to check the anchor.
+        self.assertEqual(searcher.feed('x' * trans.SEARCH_WINDOW), None)
+        self.assertEqual(searcher.feed('router#'), None)
+        self.assertEqual(searcher.feed('\r\nrouter#')[3], 'router#')
+        # The start of the stream starts a line.
+        self.assert_(trans.StreamSearcher([prompt]).feed('router#'))
+
+
+class TestOutputNormaliser(unittest.TestCase):
+
+    def _multi_pass(self, data, strip_ansi, dos2unix, strip_chars):
+        # The original, one pass per removal, normalisation.
+        for strip_char in strip_chars:
+            data = data.replace(strip_char, '')
+        if dos2unix:
+            data = data.replace('\r\n', '\n')
+            data = data.replace('\r\n', '\n')
+        if strip_ansi:
+            for reg in (trans.STRIP_ANSI, trans.STRIP_ANSI,
+                        re.compile(r'[\x03\x1a]')):
+                data = reg.sub('', data)
+        return data
+
+    def testSameAsMultiplePasses(self):
+        data = ('\x1b[2K\x1b[1;24r--More--\x08\x08 \x08\x08 line 1\r\n'
+                'line 2\r\r\nline 3\r\r\r\n\x03\x1a|pipe|\x08\x08  end\r')
+        for strip_ansi in (False, True):
+            for dos2unix in (False, True):
+                for strip_chars in ([], ['\x08 ', '\x08']):
+                    normaliser = trans.OutputNormaliser(
+                        strip_ansi=strip_ansi, dos2unix=dos2unix,
+                        strip_chars=strip_chars)
+                    self.assertEqual(
+                        normaliser(data),
+                        self._multi_pass(data, strip_ansi, dos2unix,
+                                         strip_chars))
+
+    def testNothingToDo(self):
+        normaliser = trans.get_normaliser()
+        data = 'line\r\n'
+        self.assert_(normaliser(data) is data)
+        self.assertEqual(normaliser(None), None)
+
+    def testNormalisersAreShared(self):
+        a = trans.get_normaliser(strip_ansi=True, strip_chars=['\x08'])
+        self.assert_(a is trans.get_normaliser(strip_ansi=1,
+                                               strip_chars=('\x08',)))
+        self.assert_(a is not trans.get_normaliser(strip_ansi=True))
+
+    def testCommandOutputIsNormalised(self):
+        t = trans_benchmark.SimulatedTransport(
+            outputs={'show ip': '\x1b[1mbold\x1b[0m\r\r\n'})
+        t.strip_ansi = True
+        t.dos2unix = True
+        self.assertEqual(t.command('show ip', t.prompt), 'bold\n')
+
+
+class TestExpectSpawn(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = trans.DeviceTransport()
+
+    def testExpect(self):
+        spawn = expect_benchmark.ChunkSpawn(['show ver\r\nIOS', ' 12.4\r\nr',
+                                             'outer#show'])
+        prompt = trans.compile_pattern('router#', anchor=True)
+        self.assertEqual(self.transport._expect_spawn(
+            spawn, [prompt, pexpect.EOF]), 0)
+        self.assertEqual(spawn.before, 'show ver\r\nIOS 12.4\r\n')
+        self.assertEqual(spawn.after, 'router#')
+        self.assertEqual(spawn.match.group(0), 'router#')
+        # Data after the match is searched by the next expect.
+        self.assertEqual(self.transport._expect_spawn(
+            spawn, ['show', pexpect.EOF]), 0)
+        self.assertEqual(spawn.before, '')
+
+    def testVendorPrompts(self):
+        # Each vendor's prompt, after typical output of a command.
+        for device_class, prompt, output in (
+            (dev_ios.CiscoIosDevice, 'router#', 'show clock\r\n12:00:00\r\n'),
+            (dev_nortel_esr.EsrDevice, 'esr1:5#',
+             'show sys info\r\nok\r\n\x1b[2K\x1b[1;24r'),
+            (dev_netscreen.ScreenosDevice, 'ns1->',
+             'get clock\r\n12:00:00\r\n\x1b[K')):
+            transport = trans.DeviceTransport(
+                anchor_prompt=device_class.ANCHOR_PROMPT)
+            spawn = expect_benchmark.ChunkSpawn([output[:-2], output[-2:],
+                                                 prompt])
+            self.assertEqual(transport._expect_spawn(
+                spawn, [transport._escape_prompt(prompt), pexpect.EOF]), 0)
+            self.assertEqual(spawn.before, output)
+        # An anchored prompt is not found after escape sequences.
+        transport = trans.DeviceTransport(anchor_prompt=True)
+        spawn = expect_benchmark.ChunkSpawn(['ok\r\n\x1b[K', 'ns1->'])
+        self.assertEqual(transport._expect_spawn(
+            spawn, [transport._escape_prompt('ns1->'), pexpect.EOF]), 1)
+
+    def testExpectIter(self):
+        output = ''.join('line %d\r\n' % i for i in range(1000))
+        spawn = expect_benchmark.ChunkSpawn(
+            [output[i:i + 1000] for i in range(0, len(output), 1000)] +
+            ['router#'])
+        pieces = list(self.transport._expect_spawn_iter(
+            spawn, ['router#', pexpect.EOF]))
+        index, before = pieces.pop()
+        self.assertEqual(index, 0)
+        self.assertEqual(before, spawn.before)
+        self.assert_(len(before) < 2 * trans.SEARCH_WINDOW)
+        self.assert_(len(pieces) > 1)
+        for i, piece in pieces:
+            self.assertEqual(i, None)
+            self.assert_(piece.endswith('\r\n'))
+        self.assertEqual(''.join(p for _, p in pieces) + before, output)
+
+    def testEof(self):
+        spawn = expect_benchmark.ChunkSpawn(['no prompt'])
+        self.assertEqual(self.transport._expect_spawn(
+            spawn, ['router#', pexpect.EOF]), 1)
+        self.assertEqual(spawn.before, 'no prompt')
+        spawn = expect_benchmark.ChunkSpawn(['no prompt'])
+        self.assertRaises(pexpect.EOF, self.transport._expect_spawn,
+                          spawn, ['router#'])
+
+    def testTimeout(self):
+        spawn = expect_benchmark.ChunkSpawn([])
+        spawn.buffer = 'partial'
+        self.assertEqual(self.transport._expect_spawn(
+            spawn, ['router#', pexpect.TIMEOUT], timeout=-1), 1)
+        self.assertEqual(spawn.buffer, 'partial')
+
+
+class TestDeviceTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.outputs = {'show version': 'IOS 12.4\r\nUptime 3 days\r\n',
+                        'show clock': '12:00:00 UTC\r\n',
+                        'show hang': None}
+
+    def testCommand(self):
+        t = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        self.assertEqual(t.command('show clock', t.prompt), '12:00:00 UTC\r\n')
+        self.assertEqual(t.lines, ['', 'show clock'])
+
+    def testCommandIter(self):
+        t = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        self.assertEqual(list(t.command_iter('show version', t.prompt)),
+                         ['IOS 12.4\r\nUptime 3 days\r\n'])
+
+    def testCommandsPipelined(self):
+        commands = ['show version', 'show clock', 'show foo']
+        t = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        responses = t.commands(commands, t.prompt)
+        self.assertEqual(responses, ['IOS 12.4\r\nUptime 3 days\r\n',
+                                     '12:00:00 UTC\r\n',
+                                     'Output of show foo\r\n'])
+        # One round trip to find the prompt and one for all the commands.
+        self.assertEqual(t.lines, [''] + commands)
+        self.assert_(t.clock < 3 * t.rtt)
+
+    def testCommandsMatchSequentialResults(self):
+        commands = ['show version', 'show clock'] * 3
+        sequential = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        expected = [sequential.command(c, sequential.prompt)
+                    for c in commands]
+        pipelined = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        self.assertEqual(pipelined.commands(commands, pipelined.prompt),
+                         expected)
+        self.assert_(pipelined.clock < sequential.clock / 3)
+
+    def testCommandsErrorKeepsEarlierResponses(self):
+        t = trans_benchmark.SimulatedTransport(outputs=self.outputs)
+        try:
+            t.commands(['show clock', 'show hang', 'show version'], t.prompt,
+                       timeout=5.0)
+        except errors.CommandError, e:
+            self.assertEqual(e.responses, ['12:00:00 UTC\r\n'])
+        else:
+            self.fail('CommandError not raised')
+
+    def testNoCommands(self):
+        t = trans_benchmark.SimulatedTransport()
+        self.assertEqual(t.commands([], t.prompt), [])
+        self.assertEqual(t.lines, [])
+
+
+if __name__ == '__main__':
+    unittest.main()